@@ -3,9 +3,11 @@ from . import tune_reviewer
 from . import col_note_type
 from . import load_from_session_ui
 from . import welcome_wizard
+from . import timing
 
 tune_overview.setup()
 tune_reviewer.setup()
 col_note_type.setup()
 load_from_session_ui.setup()
 welcome_wizard.setup()
+timing.setup()
@@ -48,6 +48,12 @@ def answer(addon_package: str) -> str:
 	).substitute(addon_package=addon_package)
 
 
+def template_text() -> Tuple[str, str]:
+	"(question, answer) of the Tune template, without going to the backend."
+	addon_package = AddonManager.addonFromModule(cast(AddonManager, None), __name__)
+	return question, answer(addon_package)
+
+
 class TemplateMigrator:
 	mn: ModelManager
 
@@ -55,11 +61,7 @@ class TemplateMigrator:
 		self.mn = mn
 
 	def build_template(self) -> AnkiTemplate:
-
-		addon_package = AddonManager.addonFromModule(cast(AddonManager, None), __name__)
-
 		t = self.mn.new_template(TEMPLATE_NAME)
-		t["qfmt"] = question
-		t["afmt"] = answer(addon_package)
+		t["qfmt"], t["afmt"] = template_text()
 		t["other"] = {TPL_VER_KEY: True}  # type: ignore
 		return t
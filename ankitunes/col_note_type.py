@@ -7,14 +7,16 @@ if TYPE_CHECKING:
 import anki
 import re
 import functools
+import hashlib
 
-from anki.collection import Collection as AnkiCollection
+from anki.collection import OpChanges, Collection as AnkiCollection
 from anki.models import NoteType, ModelManager
-from anki.notes import Note
+from anki.notes import Note, NoteId
 import aqt
 import aqt.gui_hooks
 
-from .col_card_type import TemplateMigrator, TPL_VER_KEY
+from .col_card_type import TemplateMigrator, TPL_VER_KEY, template_text
+from .timing import timed
 from .util import mw
 from .errors import ErrorMode, error
 
@@ -67,6 +69,18 @@ _VersionErr = Union[VersionErr.ExistsUnmanaged, VersionErr.ExistsUnknown]
 
 NT_KEY = "ankitunes_nt"
 NT_VER_KEY = "ankitunes_nt_version"
+# collection config key for the id of the managed note type, to save looking for it
+NT_ID_CONFIG_KEY = "ankitunes_nt_id"
+# collection config key for [count, latest mtime] of all note types when they were
+# last looked through for clones of ours. Until it changes, there can't be a new one.
+NT_STAMP_CONFIG_KEY = "ankitunes_nt_stamp"
+# hash of the version and template text the note type was last set up with
+NT_FINGERPRINT_KEY = "ankitunes_nt_fingerprint"
+
+
+def _fingerprint(version: int, qfmt: str, afmt: str) -> str:
+	text = "\x1f".join([str(version), qfmt, afmt])
+	return hashlib.sha1(text.encode("utf-8")).hexdigest()
 
 
 class MigrationErr:
@@ -109,11 +123,46 @@ def migration(migrateFn: F) -> F:
 	return migrateFn
 
 
+# notes rewritten (and committed) at a time by migrations that touch every note
+MIGRATION_CHUNK_SIZE = 500
+
+# (notes done, notes in total)
+MigrationProgress = Callable[[int, int], None]
+
+# note type "other" key recording how far a migration that rewrites every note got:
+# {"version": version being migrated to, "last_nid": last note id done}
+NT_CHECKPOINT_KEY = "ankitunes_nt_checkpoint"
+
+# The note rewrites for migrations that need one. Each gets a note's fields and
+# the field ords, and returns the new fields, or None if the note needs no change.
+# A note that's already been done must come back as None, so rerunning is harmless.
+NoteRewrite = Callable[[List[str], Dict[str, int]], Optional[List[str]]]
+
+
+def _split_v1_tune_type(fields: List[str], ords: Dict[str, int]) -> Optional[List[str]]:
+	"v1 had the key in the tune type field, e.g. 'Edor reel'. v2 has its own Key field."
+	key_ord, tt_ord = ords["Key"], ords["Tune Type"]
+	if fields[key_ord] != "":
+		return None
+	key_and_type = fields[tt_ord].split(" ", 1)
+	if len(key_and_type) == 1:
+		return None
+	fields[key_ord], fields[tt_ord] = key_and_type
+	return fields
+
+
+_note_rewrites: Dict[TNTVersion, NoteRewrite] = {
+	TNTVersion.V2: _split_v1_tune_type,
+}
+
+
 class TNTMigrator:
 	mn: ModelManager
+	progress: Optional[MigrationProgress]
 
-	def __init__(self, mn: ModelManager):
+	def __init__(self, mn: ModelManager, progress: Optional[MigrationProgress] = None):
 		self.mn = mn
+		self.progress = progress
 
 	@staticmethod
 	def _get_version(
@@ -146,11 +195,45 @@ class TNTMigrator:
 		except ValueError:
 			return Err(VersionErr.ExistsUnknown(version))
 
+	def _note_types_stamp(self) -> List[int]:
+		col: AnkiCollection = self.mn.col
+		assert col.db is not None
+		row = col.db.first("select count(), max(mtime_secs) from notetypes")
+		count, mtime = row or (0, 0)
+		return [count, mtime or 0]
+
 	def get_current_version(self) -> Result[VersionResult, _VersionErr]:
-		return TNTMigrator._get_version(self.mn.all())
+		col: AnkiCollection = self.mn.col
+		nt_id = col.get_config(NT_ID_CONFIG_KEY, None)
+		# only while no note type has been added or changed since they were all looked
+		# through, so a clone still gets complained about
+		stamp = col.get_config(NT_STAMP_CONFIG_KEY, None)
+		if nt_id is not None and stamp == self._note_types_stamp():
+			nt = self.mn.get(nt_id)
+			if nt is not None and nt.get("other", {}).get(NT_KEY) == True:
+				return TNTMigrator._get_version([nt])
+
+		# not remembered yet, it's been deleted, or note types have changed since the
+		# last look: look through all of them
+		version_res = TNTMigrator._get_version(self.mn.all())
+		if isinstance(version_res, Ok) and version_res.value[1] is not None:
+			self._remember(version_res.value[1])
+		return version_res
+
+	def _remember(self, nt: NoteType) -> None:
+		"Saves nt's id, and the note types' stamp. Only call when there's no clone of nt."
+		col: AnkiCollection = self.mn.col
+		if col.get_config(NT_ID_CONFIG_KEY, None) != nt["id"]:
+			col.set_config(NT_ID_CONFIG_KEY, nt["id"])
+		stamp = self._note_types_stamp()
+		if col.get_config(NT_STAMP_CONFIG_KEY, None) != stamp:
+			col.set_config(NT_STAMP_CONFIG_KEY, stamp)
 
 	def migrate(self, vr: VersionResult) -> Result[NoteType, _MigrationErr]:
 		version, nt = vr
+		if nt is not None:
+			# finish off anything an earlier run didn't get through
+			self.rewrite_notes(nt)
 		for target_version in sorted(TNTVersion):
 			logger.debug(f"target version is {target_version}")
 			logger.debug(f"current version is {version}")
@@ -172,7 +255,12 @@ class TNTMigrator:
 			version = target_version
 
 			self.mn.save(nt)
+			# mtimes are in seconds, so the save might not have moved it
+			forget_nt_checks()
 
+		if nt is not None:
+			# a brand new note type only has an id once it's saved
+			self._remember(nt)
 		return Ok(cast(NoteType, nt))
 
 	@migration
@@ -222,34 +310,95 @@ class TNTMigrator:
 
 		nt["other"][NT_VER_KEY] = 2
 
+		# the notes are split after this save. If that gets interrupted, the
+		# checkpoint says where to pick up next time.
+		nt["other"][NT_CHECKPOINT_KEY] = {"version": 2, "last_nid": 0}
 		self.mn.save(nt)
+		self.rewrite_notes(nt)
 
-		def split_tune_type(v1_tune_type: str) -> Tuple[str, str]:
-			"returns (key, tune type)"
-			key_and_type = v1_tune_type.split(" ", 1)
-			if len(key_and_type) == 1:
-				return "", key_and_type[0]
+		return Ok(nt)
 
-			elif len(key_and_type) == 2:
-				return tuple(key_and_type)  # type: ignore
+	def rewrite_notes(self, nt: NoteType) -> None:
+		"""Finishes the note rewrite nt's checkpoint is for, if it has one.
 
-			else:
-				raise Exception("unreachable")
+		Notes are rewritten straight in the db in id order, a chunk at a time, and
+		each chunk is committed along with the checkpoint. So if Anki's closed or
+		crashes part way, the next run only does the notes that are left."""
+		checkpoint = nt["other"].get(NT_CHECKPOINT_KEY)
+		if checkpoint is None:
+			return
+		rewrite = _note_rewrites[TNTVersion(checkpoint["version"])]
 
 		col: AnkiCollection = self.mn.col
-		for note in [col.getNote(nid) for nid in self.mn.nids(nt["id"])]:
-			key, tt = split_tune_type(note["Tune Type"])
-			note["Key"] = key
-			note["Tune Type"] = tt
-			note.flush()
+		assert col.db is not None
+		ords = {f["name"]: f["ord"] for f in nt["flds"]}
+		last_nid = checkpoint["last_nid"]
+		total = col.db.scalar("select count() from notes where mid = ?", nt["id"])
+		done = col.db.scalar(
+			"select count() from notes where mid = ? and id <= ?", nt["id"], last_nid
+		)
+
+		while True:
+			rows = col.db.all(
+				"select id, flds from notes where mid = ? and id > ? order by id limit ?",
+				nt["id"],
+				last_nid,
+				MIGRATION_CHUNK_SIZE,
+			)
+			if len(rows) == 0:
+				break
+
+			updates = []
+			for nid, flds in rows:
+				fields = rewrite(flds.split("\x1f"), ords)
+				if fields is not None:
+					updates.append(("\x1f".join(fields), nid))
+			if len(updates) > 0:
+				col.db.executemany("update notes set flds = ? where id = ?", updates)
+				# sort fields, checksums, mtimes and usns
+				col.after_note_updates(
+					[NoteId(nid) for _, nid in updates],
+					mark_modified=True,
+					generate_cards=False,
+				)
+
+			last_nid = rows[-1][0]
+			done += len(rows)
+			nt["other"][NT_CHECKPOINT_KEY] = {**checkpoint, "last_nid": last_nid}
+			self.mn.save(nt)
+			col.save()
 
+			if self.progress is not None:
+				self.progress(done, total)
+
+		del nt["other"][NT_CHECKPOINT_KEY]
+		self.mn.save(nt)
+		self._remember(nt)
 		col.save()
+		forget_nt_checks()
 
-		return Ok(nt)
+	@staticmethod
+	def is_up_to_date(nt: NoteType) -> bool:
+		"If nt is the latest version, with the current template, so needs no saving."
+		other = nt.get("other") or {}
+		version = other.get(NT_VER_KEY)
+		if version != max(TNTVersion) or NT_CHECKPOINT_KEY in other:
+			return False
+		ours = [t for t in nt["tmpls"] if t.get("other", {}).get(TPL_VER_KEY) == True]
+		if len(ours) != 1:
+			return False
+		expected = _fingerprint(version, *template_text())
+		# the template might have been edited by hand since the fingerprint was saved
+		actual = _fingerprint(version, ours[0]["qfmt"], ours[0]["afmt"])
+		return other.get(NT_FINGERPRINT_KEY) == expected == actual
 
 	def migrate_template(self, nt: NoteType) -> None:
 		"""Updates the template in nt to be our Tune renderer. nt is assumed to be our Tune."""
 
+		if self.is_up_to_date(nt):
+			# saving would bump the mtime, and make the next sync send it all again
+			return
+
 		# Search templates for any managed by us.
 		existing_templates = [
 			(i, t)
@@ -273,8 +422,17 @@ class TNTMigrator:
 			self.mn.add_template(nt, our_template)
 			nt["tmpls"][0]["ord"] = 0
 
+		nt["other"][NT_FINGERPRINT_KEY] = _fingerprint(
+			nt["other"][NT_VER_KEY],
+			cast(str, our_template["qfmt"]),
+			cast(str, our_template["afmt"]),
+		)
 		self.mn.save(nt)
+		forget_nt_checks()
+		# our own save can't have made a clone
+		self._remember(nt)
 
+	@timed("setup_tune_note_type")
 	def setup_tune_note_type(self) -> NoteType:
 
 		# if not exist, create
@@ -292,6 +450,10 @@ class TNTMigrator:
 				mode=ErrorMode.RAISE,
 			)
 
+		_, existing_nt = current_version_res.value
+		if existing_nt is not None and self.is_up_to_date(existing_nt):
+			return existing_nt
+
 		migrate_res = self.migrate(current_version_res.value)
 
 		if not isinstance(migrate_res, Ok):
@@ -315,19 +477,39 @@ for ver in TNTVersion:
 		raise Exception(f"missing migration for {ver}")
 
 
-def migrate(col: AnkiCollection) -> NoteType:
+def migrate(
+	col: AnkiCollection, progress: Optional[MigrationProgress] = None
+) -> NoteType:
 	mn = col.models
-	return TNTMigrator(mn).setup_tune_note_type()
+	return TNTMigrator(mn, progress).setup_tune_note_type()
+
+
+# (note type id, mtime) -> is_ankitunes_nt, as this gets asked for every card shown
+_nt_checks: Dict[Tuple[int, int], bool] = {}
+
+
+def forget_nt_checks() -> None:
+	_nt_checks.clear()
 
 
 def is_ankitunes_nt(note_type: NoteType) -> "TypeGuard[NoteFields]":
 	"tests if note_type is a fully migrated ankitunes notetype"
+	key = (note_type["id"], note_type["mod"])
+	checked = _nt_checks.get(key)
+	if checked is not None:
+		return checked
+
 	ver_result = TNTMigrator._get_version([note_type])
 	if isinstance(ver_result, Ok):
 		ver, nt = ver_result.value
-		return ver is max(v for v in TNTVersion)
+		checked = ver is max(v for v in TNTVersion)
 	else:
-		return False
+		checked = False
+
+	# note types that haven't been saved yet don't have an id
+	if note_type["id"]:
+		_nt_checks[key] = checked
+	return checked
 
 
 def get_ankitunes_nt(mn: Optional[ModelManager] = None) -> NoteType:
@@ -337,9 +519,29 @@ def get_ankitunes_nt(mn: Optional[ModelManager] = None) -> NoteType:
 
 def _hook() -> None:
 	col = mw().col
-	migrate(col)
+	started = False
+
+	def progress(done: int, total: int) -> None:
+		nonlocal started
+		if not started:
+			mw().progress.start(max=total, label="Updating AnkiTunes notes...")
+			started = True
+		mw().progress.update(value=done, max=total)
+
+	try:
+		migrate(col, progress)
+	finally:
+		if started:
+			mw().progress.finish()
 	return None
 
 
+def _on_operation_did_execute(changes: OpChanges, handler: Optional[object]) -> None:
+	if changes.notetype:
+		forget_nt_checks()
+
+
 def setup() -> None:
 	aqt.gui_hooks.profile_did_open.append(_hook)
+	aqt.gui_hooks.operation_did_execute.append(_on_operation_did_execute)
+	aqt.gui_hooks.collection_did_load.append(lambda col: forget_nt_checks())
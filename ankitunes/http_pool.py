@@ -0,0 +1,278 @@
+"""
+A small HTTP client that keeps connections alive between requests.
+
+urllib.request.urlopen does a fresh TCP + TLS handshake for every request,
+which is most of the cost of fetching a tune. HTTPPool keeps idle
+connections around per host, asks for gzip, and has separate connect and
+read timeouts so that a stalled server can't hang a worker thread forever.
+
+Bodies are read (and decompressed) in chunks, and given up on as soon as
+they get bigger than max_body_bytes, so a captive portal or a confused
+proxy can't fill up memory.
+
+Like urlopen, it follows redirects (TheSession redirects merged tunes), and
+goes through the proxies in HTTP(S)_PROXY or the system settings.
+"""
+
+import base64
+import http.client
+import threading
+import urllib.parse
+import urllib.request
+import zlib
+from email.message import Message
+from typing import *
+
+DEFAULT_CONNECT_TIMEOUT = 10.0  # seconds
+DEFAULT_READ_TIMEOUT = 30.0  # seconds
+DEFAULT_MAX_IDLE_PER_HOST = 4
+# the biggest tunes on TheSession are a few hundred KB
+DEFAULT_MAX_BODY_BYTES = 8 * 1024 * 1024
+
+READ_CHUNK_BYTES = 64 * 1024
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+
+USER_AGENT = "AnkiTunes (https://github.com/akdor1154/ankitunes)"
+
+# (scheme, hostname, port, proxy URL or None)
+_Host = Tuple[str, str, Optional[int], Optional[str]]
+
+
+class HTTPResponse(NamedTuple):
+	status: int
+	headers: Message
+	body: bytes
+
+
+class HTTPStatusError(Exception):
+	"HTTPPool.get doesn't raise this itself, it's for callers that treat a bad status as an error."
+
+	status: int
+	url: str
+
+	def __init__(self, url: str, status: int) -> None:
+		super().__init__(f"HTTP {status} from {url}")
+		self.url = url
+		self.status = status
+
+
+class ResponseTooLarge(Exception):
+	url: str
+	limit: int
+
+	def __init__(self, url: str, limit: int) -> None:
+		super().__init__(f"Response from {url} is bigger than {limit} bytes")
+		self.url = url
+		self.limit = limit
+
+
+class TooManyRedirects(Exception):
+	url: str
+
+	def __init__(self, url: str) -> None:
+		super().__init__(f"More than {MAX_REDIRECTS} redirects from {url}")
+		self.url = url
+
+
+class HTTPPool:
+	connect_timeout: float
+	read_timeout: float
+	max_idle_per_host: int
+	max_body_bytes: int
+	# scheme -> proxy URL, plus "no" for hosts to go to directly, as getproxies() gives
+	proxies: Mapping[str, str]
+
+	_idle: Dict[_Host, List[http.client.HTTPConnection]]
+	_lock: threading.Lock
+
+	def __init__(
+		self,
+		connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+		read_timeout: float = DEFAULT_READ_TIMEOUT,
+		max_idle_per_host: int = DEFAULT_MAX_IDLE_PER_HOST,
+		max_body_bytes: int = DEFAULT_MAX_BODY_BYTES,
+		proxies: Optional[Mapping[str, str]] = None,
+	) -> None:
+		self.connect_timeout = connect_timeout
+		self.read_timeout = read_timeout
+		self.max_idle_per_host = max_idle_per_host
+		self.max_body_bytes = max_body_bytes
+		self.proxies = urllib.request.getproxies() if proxies is None else proxies
+		self._idle = {}
+		self._lock = threading.Lock()
+
+	def get(self, url: str, headers: Optional[Mapping[str, str]] = None) -> HTTPResponse:
+		"""GETs url and returns the whole (decompressed) response, following redirects.
+
+		Raises on network errors, but not on HTTP error statuses - check response.status.
+		Raises ResponseTooLarge if the (decompressed) body is over max_body_bytes,
+		and TooManyRedirects after MAX_REDIRECTS of them."""
+
+		request_headers = {
+			"Accept-Encoding": "gzip",
+			"User-Agent": USER_AGENT,
+			**(headers or {}),
+		}
+
+		current_url = url
+		for _ in range(MAX_REDIRECTS + 1):
+			response = self._get_one(current_url, request_headers)
+			location = response.headers.get("Location")
+			if response.status not in REDIRECT_STATUSES or location is None:
+				return response
+			current_url = urllib.parse.urljoin(current_url, location)
+		raise TooManyRedirects(url)
+
+	def _get_one(self, url: str, request_headers: Mapping[str, str]) -> HTTPResponse:
+		parsed = urllib.parse.urlsplit(url)
+		if parsed.scheme not in {"http", "https"}:
+			raise ValueError(f"Unsupported URL scheme in {url}")
+		hostname = parsed.hostname or ""
+		host: _Host = (parsed.scheme, hostname, parsed.port, self._proxy_for(parsed))
+		path = parsed.path or "/"
+		if parsed.query:
+			path += "?" + parsed.query
+		if host[3] is not None and parsed.scheme == "http":
+			# plain HTTP proxies want the whole URL
+			path = urllib.parse.urlunsplit(parsed._replace(path=path, query="", fragment=""))
+			request_headers = {**request_headers, **_proxy_auth_headers(host[3])}
+
+		conn, reused = self._checkout(host)
+		try:
+			response = self._request(conn, url, path, request_headers)
+		except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+			conn.close()
+			if not reused:
+				raise
+			# the server closed an idle keep-alive connection on us, that's fine, try once more.
+			conn = self._connect(host)
+			try:
+				response = self._request(conn, url, path, request_headers)
+			except BaseException:
+				conn.close()
+				raise
+		except BaseException:
+			conn.close()
+			raise
+
+		status, response_headers, body, will_close = response
+		if will_close:
+			conn.close()
+		else:
+			self._checkin(host, conn)
+
+		return HTTPResponse(status, response_headers, body)
+
+	def _proxy_for(self, parsed: urllib.parse.SplitResult) -> Optional[str]:
+		proxy = self.proxies.get(parsed.scheme)
+		if proxy is None:
+			return None
+		host = parsed.netloc.rsplit("@", 1)[-1]
+		if urllib.request.proxy_bypass_environment(host, self.proxies):  # type: ignore
+			return None
+		# HTTP_PROXY=proxy:3128 is allowed, and means http://
+		return proxy if "://" in proxy else f"http://{proxy}"
+
+	def _request(
+		self,
+		conn: http.client.HTTPConnection,
+		url: str,
+		path: str,
+		headers: Mapping[str, str],
+	) -> Tuple[int, Message, bytes, bool]:
+		conn.request("GET", path, headers=dict(headers))
+		response = conn.getresponse()
+		limit = self.max_body_bytes
+
+		# don't bother reading something we already know is too big
+		if response.length is not None and response.length > limit:
+			raise ResponseTooLarge(url, limit)
+
+		decompressor = None
+		if response.headers.get("Content-Encoding", "").lower() == "gzip":
+			decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+		# must be read fully before the connection can be reused
+		chunks: List[bytes] = []
+		raw_size = 0
+		size = 0
+		while True:
+			chunk = response.read(READ_CHUNK_BYTES)
+			if chunk == b"":
+				break
+			raw_size += len(chunk)
+			if raw_size > limit:
+				raise ResponseTooLarge(url, limit)
+			if decompressor is not None:
+				# a tiny gzip can inflate to something enormous, stop at one byte over
+				chunk = decompressor.decompress(chunk, limit - size + 1)
+				if decompressor.unconsumed_tail:
+					raise ResponseTooLarge(url, limit)
+			size += len(chunk)
+			if size > limit:
+				raise ResponseTooLarge(url, limit)
+			chunks.append(chunk)
+
+		if decompressor is not None:
+			chunks.append(decompressor.flush())
+
+		return response.status, response.headers, b"".join(chunks), response.will_close
+
+	def _connect(self, host: _Host) -> http.client.HTTPConnection:
+		scheme, hostname, port, proxy = host
+		conn_host, conn_port = hostname, port
+		if proxy is not None:
+			parsed_proxy = urllib.parse.urlsplit(proxy)
+			conn_host = parsed_proxy.hostname or ""
+			conn_port = parsed_proxy.port or (443 if parsed_proxy.scheme == "https" else 80)
+
+		conn: http.client.HTTPConnection
+		if scheme == "https":
+			conn = http.client.HTTPSConnection(
+				conn_host, conn_port, timeout=self.connect_timeout
+			)
+			if proxy is not None:
+				# CONNECT through the proxy, then TLS with the real host
+				conn.set_tunnel(hostname, port, headers=_proxy_auth_headers(proxy))
+		else:
+			conn = http.client.HTTPConnection(
+				conn_host, conn_port, timeout=self.connect_timeout
+			)
+		conn.connect()
+		if conn.sock is not None:
+			conn.sock.settimeout(self.read_timeout)
+		return conn
+
+	def _checkout(self, host: _Host) -> Tuple[http.client.HTTPConnection, bool]:
+		with self._lock:
+			idle = self._idle.get(host)
+			if idle:
+				return idle.pop(), True
+		return self._connect(host), False
+
+	def _checkin(self, host: _Host, conn: http.client.HTTPConnection) -> None:
+		with self._lock:
+			idle = self._idle.setdefault(host, [])
+			if len(idle) < self.max_idle_per_host:
+				idle.append(conn)
+				return
+		conn.close()
+
+	def close(self) -> None:
+		with self._lock:
+			idle, self._idle = self._idle, {}
+		for conns in idle.values():
+			for conn in conns:
+				conn.close()
+
+
+def _proxy_auth_headers(proxy: str) -> Dict[str, str]:
+	parsed = urllib.parse.urlsplit(proxy)
+	if parsed.username is None:
+		return {}
+	credentials = f"{urllib.parse.unquote(parsed.username)}:"
+	credentials += urllib.parse.unquote(parsed.password or "")
+	token = base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+	return {"Proxy-Authorization": f"Basic {token}"}
@@ -4,11 +4,15 @@ from .result import Result, Ok, Err
 from typing import *
 import re
 from dataclasses import dataclass
-import urllib.request
 import json
 import random
+import reprlib
 import warnings
 
+from .tune_cache import TuneCache
+from .http_pool import HTTPPool, HTTPStatusError
+from .tune_index import TuneIndex
+
 
 @dataclass
 class GrabbedTune:
@@ -27,6 +31,13 @@ class GrabError:
 		def msg(self) -> str:
 			return f'{self.url} doesn\'t look like a valid tune URL. Tune URLs should look like "https://thesession.org/tunes/2" or "https://thesession.org/tunes/2#setting1".'
 
+	class BadCollectionUrl(NamedTuple):
+		url: str
+
+		@property
+		def msg(self) -> str:
+			return f'{self.url} doesn\'t look like a tunebook or sets URL. These should look like "https://thesession.org/members/1/tunebook", "https://thesession.org/members/1/sets" or "https://thesession.org/members/1/sets/2".'
+
 	class NetworkError(NamedTuple):
 		url: str
 		exception: Exception
@@ -37,11 +48,22 @@ class GrabError:
 
 	class JSONError(NamedTuple):
 		url: str
+		# only the start of the body, see json_error()
 		body: bytes
+		# the size of the whole body
+		size: Optional[int] = None
 
 		@property
 		def msg(self) -> str:
-			return f"TheSession.org gave a dodgy response that I couldn't parse. This might be a network problem, try again. Body: {self.body!r}"
+			truncated = ""
+			if self.size is not None and self.size > len(self.body):
+				truncated = f" (first {len(self.body)} of {self.size} bytes)"
+			return f"TheSession.org gave a dodgy response that I couldn't parse. This might be a network problem, try again. Body{truncated}: {self.body!r}"
+
+	@staticmethod
+	def json_error(url: str, body: bytes) -> "GrabError.JSONError":
+		"Errors hang around and get shown to people, so don't keep all of a huge body."
+		return GrabError.JSONError(url, body[:MAX_ERROR_BODY_BYTES], len(body))
 
 	class APISpecError(NamedTuple):
 		url: str
@@ -50,9 +72,8 @@ class GrabError:
 
 		@property
 		def msg(self) -> str:
-			from pprint import pformat
-
-			tuneStr = pformat(self.tune)
+			# a tune can have hundreds of settings, only show the start of each bit
+			tuneStr = _error_repr.repr(self.tune)
 			return (
 				f"TheSession.org gave a confusing response that I couldn't understand. Please raise this as a GitHub issue at https://github.com/akdor1154/ankitunes ."
 				f"The response in question: {tuneStr}\n"
@@ -69,8 +90,18 @@ class GrabError:
 			return f"There is no such setting {self.setting_id} for the tune {self.tune.name} at {url} ."
 
 
+MAX_ERROR_BODY_BYTES = 1024
+
+_error_repr = reprlib.Repr()
+_error_repr.maxlevel = 4
+_error_repr.maxdict = 10
+_error_repr.maxlist = 10
+_error_repr.maxstring = 200
+_error_repr.maxother = 200
+
 _GrabError = Union[
 	GrabError.BadUrl,
+	GrabError.BadCollectionUrl,
 	GrabError.NetworkError,
 	GrabError.JSONError,
 	GrabError.APISpecError,
@@ -79,6 +110,9 @@ _GrabError = Union[
 
 GrabResult = Result[GrabbedTune, _GrabError]
 
+# where the API lives. Tests point this at a stand-in server.
+THESESSION = "https://thesession.org"
+
 PATH_REGEX = re.compile(r"/tunes/(\d+)/?")
 FRAGMENT_REGEX = re.compile(r"setting(\d+)")
 
@@ -127,22 +161,34 @@ def get_from_thesession(url: str) -> Result[GrabbedTune, _GrabError]:
 def _get_from_thesession(
 	tune_id: int, setting_id: Optional[int]
 ) -> Result[GrabbedTune, _GrabError]:
+	local_tune = _lookup_local_tune(tune_id, [setting_id])
+	if local_tune is not None:
+		return _grab_setting(local_tune, setting_id)
+
 	tune_result = _retrieve_thesession_tune(tune_id)
 
 	if isinstance(tune_result, Err):
 		return tune_result
 
-	tune = tune_result.value
+	return _grab_setting(tune_result.value, setting_id)
+
 
+def _grab_setting(
+	tune: "TheSessionTune", setting_id: Optional[int]
+) -> Result[GrabbedTune, _GrabError]:
 	if setting_id is None:
-		i, setting = random.choice(list(enumerate(tune.settings)))
+		i = random.randrange(len(tune))
 	else:
-		try:
-			i, setting = next(
-				(i, s) for (i, s) in enumerate(tune.settings) if s.id == setting_id
-			)
-		except StopIteration:
+		position = tune.position(setting_id)
+		if position is None:
 			return Err(GrabError.NoSuchSetting(tune, setting_id))
+		i = position
+
+	try:
+		setting = tune.setting_at(i)
+	except (KeyError, ValueError, TypeError) as e:
+		url = f"{THESESSION}/tunes/{tune.id}?format=json"
+		return Err(GrabError.APISpecError(url, {"id": tune.id, "name": tune.name}, e))
 
 	uri = f"https://thesession.org/tunes/{tune.id}#setting{setting.id}"
 	abc = _process_sessionapi_abc(tune, setting, i)
@@ -152,60 +198,323 @@ def _get_from_thesession(
 	)
 
 
-@dataclass
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+def get_from_thesession_many(
+	urls: Sequence[str], max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+) -> List[GrabResult]:
+	"""Like get_from_thesession, but for lots of urls at once.
+
+	Tunes are fetched in parallel by at most max_concurrency threads, and each tune is
+	only fetched once no matter how many of its settings are asked for.
+	Returns one result per url, in the same order as urls."""
+
+	if max_concurrency < 1:
+		raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+
+	parse_results = [_parse_thesession_url(url) for url in urls]
+
+	# dicts keep insertion order, so tunes get fetched in the order they were asked for
+	wanted_settings: Dict[int, List[Optional[int]]] = {}
+	for r in parse_results:
+		if isinstance(r, Ok):
+			tune_id, setting_id = r.value
+			wanted_settings.setdefault(tune_id, []).append(setting_id)
+
+	tune_results: Dict[int, Result[TheSessionTune, _GrabError]] = {}
+	tune_ids: List[int] = []
+	for tune_id, setting_ids in wanted_settings.items():
+		local_tune = _lookup_local_tune(tune_id, setting_ids)
+		if local_tune is not None:
+			tune_results[tune_id] = Ok(local_tune)
+		else:
+			tune_ids.append(tune_id)
+
+	if len(tune_ids) > 0:
+		from concurrent.futures import ThreadPoolExecutor
+
+		workers = min(max_concurrency, len(tune_ids))
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			for tune_id, tune_result in zip(
+				tune_ids, pool.map(_retrieve_thesession_tune, tune_ids)
+			):
+				tune_results[tune_id] = tune_result
+
+	results: List[GrabResult] = []
+	for parse_result in parse_results:
+		if isinstance(parse_result, Err):
+			results.append(parse_result)
+			continue
+
+		tune_id, setting_id = parse_result.value
+		tune_result = tune_results[tune_id]
+		if isinstance(tune_result, Err):
+			results.append(tune_result)
+		else:
+			results.append(_grab_setting(tune_result.value, setting_id))
+
+	return results
+
+
+def _assert_str(s: Any) -> str:
+	if not isinstance(s, str):
+		raise ValueError(f"{s} is not a string!")
+	return s
+
+
+def _assert_int(s: Any) -> int:
+	if not isinstance(s, int):
+		raise ValueError(f"{s} is not an int!")
+	return s
+
+
 class TheSessionTune:
-	id: int
-	name: str
-	type: str
+	"""A tune and all of its settings.
+
+	Popular tunes have hundreds of settings and we only ever want one of them, so
+	settings parsed from the API are kept as their raw JSON and only turned into
+	Setting records (and checked) when they're asked for."""
 
-	@dataclass
-	class Setting:
+	__slots__ = ("id", "name", "type", "_settings", "_positions")
+
+	class Setting(NamedTuple):
 		id: int
 		key: str
 		abc: str
 
-	settings: List["TheSessionTune.Setting"]
+		@staticmethod
+		def from_json(setting_json: Any) -> "TheSessionTune.Setting":
+			return TheSessionTune.Setting(
+				id=_assert_int(setting_json["id"]),
+				key=_assert_str(setting_json["key"]),
+				abc=_assert_str(setting_json["abc"]),
+			)
 
+	id: int
+	name: str
+	type: str
+	# raw JSON until it's been asked for, then a Setting
+	_settings: List[Any]
+	# setting id -> its position in _settings
+	_positions: Dict[int, int]
+
+	def __init__(
+		self, id: int, name: str, type: str, settings: Sequence["TheSessionTune.Setting"]
+	) -> None:
+		self.id = id
+		self.name = name
+		self.type = type
+		self._settings = list(settings)
+		self._positions = {s.id: i for i, s in enumerate(settings)}
+
+	@classmethod
+	def from_json(cls, tune_json: Any) -> "TheSessionTune":
+		"Only checks the settings' ids, the rest of each setting is checked when it's used."
+		tune = cls.__new__(cls)
+		tune.id = _assert_int(tune_json["id"])
+		tune.name = _assert_str(tune_json["name"])
+		tune.type = _assert_str(tune_json["type"])
+		tune._settings = list(tune_json["settings"])
+		tune._positions = {
+			_assert_int(setting_json["id"]): i for i, setting_json in enumerate(tune._settings)
+		}
+		if len(tune._settings) == 0:
+			raise ValueError("tune has no settings")
+		return tune
+
+	def __len__(self) -> int:
+		return len(self._settings)
+
+	def __eq__(self, other: object) -> bool:
+		if not isinstance(other, TheSessionTune):
+			return NotImplemented
+		return (self.id, self.name, self.type, self.settings) == (
+			other.id,
+			other.name,
+			other.type,
+			other.settings,
+		)
 
-def _retrieve_thesession_tune(tune_id: int) -> Result[TheSessionTune, _GrabError]:
-	url = f"https://thesession.org/tunes/{tune_id}?format=json"
+	def __repr__(self) -> str:
+		return f"TheSessionTune(id={self.id!r}, name={self.name!r}, settings={len(self)})"
+
+	@property
+	def setting_ids(self) -> List[int]:
+		return list(self._positions)
+
+	def position(self, setting_id: int) -> Optional[int]:
+		return self._positions.get(setting_id)
+
+	def setting_at(self, position: int) -> "TheSessionTune.Setting":
+		"Raises ValueError or KeyError if the setting's JSON doesn't make sense."
+		setting = self._settings[position]
+		if isinstance(setting, TheSessionTune.Setting):
+			return setting
+		parsed = TheSessionTune.Setting.from_json(setting)
+		self._settings[position] = parsed
+		return parsed
+
+	@property
+	def settings(self) -> List["TheSessionTune.Setting"]:
+		return [self.setting_at(i) for i in range(len(self))]
+
+
+_tune_cache: Optional[TuneCache] = None
+
+
+def set_tune_cache(cache: Optional[TuneCache]) -> None:
+	"Sets the cache used by _retrieve_thesession_tune. None disables caching."
+	global _tune_cache
+	_tune_cache = cache
+
+
+_tune_index: Optional[TuneIndex] = None
+
+
+def set_tune_index(index: Optional[TuneIndex]) -> None:
+	"Sets the local tune index, which is checked before going to the network."
+	global _tune_index
+	_tune_index = index
+
+
+def _lookup_local_tune(
+	tune_id: int, setting_ids: Iterable[Optional[int]]
+) -> Optional[TheSessionTune]:
+	"Returns the tune from the local index, if it's there and has all of setting_ids."
+	index = _tune_index
+	if index is None:
+		return None
+
+	indexed = index.get_tune(tune_id)
+	if indexed is None:
+		return None
+
+	known_settings = {s.id for s in indexed.settings}
+	if any(s is not None and s not in known_settings for s in setting_ids):
+		# probably a setting newer than the dump, let the network sort it out
+		return None
+
+	return TheSessionTune(
+		id=indexed.id,
+		name=indexed.name,
+		type=indexed.type,
+		settings=[
+			TheSessionTune.Setting(id=s.id, key=s.key, abc=s.abc) for s in indexed.settings
+		],
+	)
+
+
+_http_pool = HTTPPool()
+
+
+def set_http_pool(pool: HTTPPool) -> None:
+	"Sets the HTTP client used to talk to TheSession, e.g. to change timeouts."
+	global _http_pool
+	_http_pool.close()
+	_http_pool = pool
+
+
+class _FetchedTune(NamedTuple):
+	body: bytes
+	etag: Optional[str]
+	last_modified: Optional[str]
+	from_cache: bool
+
+
+def _fetch_thesession_tune(
+	tune_id: int, url: str, cache: Optional[TuneCache]
+) -> Result[_FetchedTune, GrabError.NetworkError]:
+	cached = cache.get(tune_id) if cache is not None else None
+
+	if cached is not None and cached.fresh:
+		return Ok(_FetchedTune(cached.body, cached.etag, cached.last_modified, True))
+
+	headers: Dict[str, str] = {}
+	if cached is not None:
+		if cached.etag is not None:
+			headers["If-None-Match"] = cached.etag
+		if cached.last_modified is not None:
+			headers["If-Modified-Since"] = cached.last_modified
 
 	try:
-		with urllib.request.urlopen(url) as response:
-			body: bytes = response.read()
+		response = _http_pool.get(url, headers)
 	except Exception as e:
 		return Err(GrabError.NetworkError(url, e))
 
+	if response.status == 304 and cache is not None and cached is not None:
+		cache.refresh(tune_id)
+		return Ok(_FetchedTune(cached.body, cached.etag, cached.last_modified, True))
+
+	if response.status != 200:
+		return Err(GrabError.NetworkError(url, HTTPStatusError(url, response.status)))
+
+	return Ok(
+		_FetchedTune(
+			response.body,
+			response.headers.get("ETag"),
+			response.headers.get("Last-Modified"),
+			False,
+		)
+	)
+
+
+def _resolve_tune(
+	tune_id: int, setting_ids: Iterable[Optional[int]]
+) -> Result[TheSessionTune, _GrabError]:
+	"Gets a tune from the local index if it's there, or else from TheSession."
+	local_tune = _lookup_local_tune(tune_id, setting_ids)
+	if local_tune is not None:
+		return Ok(local_tune)
+	return _retrieve_thesession_tune(tune_id)
+
+
+def _get_thesession_json(url: str) -> Result[Any, _GrabError]:
+	"GETs some JSON from TheSession's API, without any caching."
 	try:
-		tune_json = json.loads(body)
+		response = _http_pool.get(url)
 	except Exception as e:
-		return Err(GrabError.JSONError(url, body))
+		return Err(GrabError.NetworkError(url, e))
+
+	if response.status != 200:
+		return Err(GrabError.NetworkError(url, HTTPStatusError(url, response.status)))
+
+	try:
+		return Ok(json.loads(response.body))
+	except Exception:
+		return Err(GrabError.json_error(url, response.body))
+
 
-	def assert_str(s: Any) -> str:
-		if not isinstance(s, str):
-			raise ValueError(f"{s} is not a string!")
-		return s
+def _retrieve_thesession_tune(tune_id: int) -> Result[TheSessionTune, _GrabError]:
+	url = f"{THESESSION}/tunes/{tune_id}?format=json"
+	cache = _tune_cache
+
+	fetch_result = _fetch_thesession_tune(tune_id, url, cache)
+	if isinstance(fetch_result, Err):
+		return fetch_result
+
+	fetched = fetch_result.value
+
+	tune_result = _parse_thesession_tune(url, fetched.body)
+	if isinstance(tune_result, Err):
+		return tune_result
+
+	# only cache responses we could make sense of
+	if cache is not None and not fetched.from_cache:
+		cache.put(tune_id, fetched.body, fetched.etag, fetched.last_modified)
 
-	def assert_int(s: Any) -> int:
-		if not isinstance(s, int):
-			raise ValueError(f"{s} is not an int!")
-		return s
+	return tune_result
 
+
+def _parse_thesession_tune(url: str, body: bytes) -> Result[TheSessionTune, _GrabError]:
 	try:
-		tune = TheSessionTune(
-			id=assert_int(tune_json["id"]),
-			name=assert_str(tune_json["name"]),
-			type=assert_str(tune_json["type"]),
-			settings=[
-				TheSessionTune.Setting(
-					id=assert_int(setting_json["id"]),
-					key=assert_str(setting_json["key"]),
-					abc=assert_str(setting_json["abc"]),
-				)
-				for setting_json in tune_json["settings"]
-			],
-		)
-	except (KeyError, ValueError) as e:
+		tune_json = json.loads(body)
+	except Exception as e:
+		return Err(GrabError.json_error(url, body))
+
+	try:
+		tune = TheSessionTune.from_json(tune_json)
+	except (KeyError, ValueError, TypeError) as e:
 		return Err(GrabError.APISpecError(url, tune_json, e))
 
 	return Ok(tune)
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 from PyQt5.QtCore import (
+	QStringListModel,
 	QMetaObject,
+	QModelIndex,
 	QObject,
 	QRegExp,
 	QRunnable,
@@ -12,7 +14,15 @@ from PyQt5.QtCore import (
 	Qt,
 )
 from PyQt5.QtGui import QRegExpValidator
-from PyQt5.QtWidgets import QHBoxLayout, QLabel, QLineEdit, QSizePolicy, QWidget
+from PyQt5.QtWidgets import (
+	QAction,
+	QHBoxLayout,
+	QLabel,
+	QLineEdit,
+	QSizePolicy,
+	QWidget,
+	QCompleter,
+)
 from .vendor import qtwaitingspinner
 
 from anki.notes import Note
@@ -21,12 +31,22 @@ from aqt.main import AnkiQt
 from aqt.addcards import AddCards
 
 from . import col_note_type
-from .col_note_type import TNTMigrator, NoteFields
+from .col_note_type import TNTMigrator
 from . import load_from_session
-from .load_from_session import GrabResult
-from .util import mw
+from . import tunebook
+from .load_from_session import GrabResult, GrabError
+from .http_pool import HTTPStatusError, ResponseTooLarge
+from .tune_cache import TuneCache
+from .tune_index import TuneIndex, TuneMatch, ImportStats
+from .errors import ErrorMode, error
+from .util import mw, user_files_dir
 from .result import Result, Ok, Err
 
+import os.path
+import random
+import sqlite3
+import threading
+from dataclasses import dataclass
 from typing import *
 
 if TYPE_CHECKING:
@@ -127,8 +147,129 @@ class URIContainer(QWidget):
 		self._update()
 
 
+class TuneSearchContainer(QWidget):
+	searchField: QLineEdit
+	completer: QCompleter
+	completerModel: QStringListModel
+
+	gotTuneURI = pyqtSignal(str, name="gotTuneURI")
+	_searchRequested = pyqtSignal(int, str, name="_searchRequested")
+
+	DEBOUNCE_MS = 150
+
+	_debounce: QTimer
+	_worker: "TuneSearchWorker"
+	_thread: QThread
+	_matches: List[TuneMatch]
+	_generation: int = 0
+
+	def __init__(self, index: TuneIndex, parent: Optional[QWidget] = None):
+		super().__init__(parent)
+
+		# widgets
+		searchLayout = QHBoxLayout()
+
+		searchLabel = QLabel(self)
+		searchLabel.setText("Search TheSession.org tunes")
+
+		searchField = QLineEdit(self)
+		searchField.setPlaceholderText("e.g. cup of tea")
+
+		completerModel = QStringListModel(self)
+		completer = QCompleter(completerModel, self)
+		# the index has already done the filtering
+		completer.setCompletionMode(QCompleter.CompletionMode.UnfilteredPopupCompletion)
+		searchField.setCompleter(completer)
+
+		searchLayout.addWidget(searchLabel)
+		searchLayout.addWidget(searchField)
+
+		self.setLayout(searchLayout)
+
+		# save widgets
+		self.searchField = searchField
+		self.completer = completer
+		self.completerModel = completerModel
+		self._matches = []
+
+		# searching happens on its own thread so typing never waits on the index
+		self._thread = QThread(mw())
+		self._worker = TuneSearchWorker(index)
+		self._worker.moveToThread(self._thread)
+		self._searchRequested.connect(self._worker.search)  # type: ignore
+		self._worker.found.connect(self.onFound)  # type: ignore
+		self._thread.finished.connect(self._worker.deleteLater)  # type: ignore
+		self._thread.finished.connect(self._thread.deleteLater)  # type: ignore
+		self.destroyed.connect(self._thread.quit)  # type: ignore
+		self._thread.start()
+
+		self._debounce = QTimer(self)
+		self._debounce.setSingleShot(True)
+		self._debounce.setInterval(self.DEBOUNCE_MS)
+		self._debounce.timeout.connect(self._search)  # type: ignore
+
+		searchField.textEdited.connect(self.onTextEdited)  # type: ignore
+		completer.activated[QModelIndex].connect(self.onActivated)  # type: ignore
+
+	@pyqtSlot()
+	def onTextEdited(self) -> None:
+		self._debounce.start()
+
+	def _search(self) -> None:
+		self._generation += 1
+		self._worker.latestGeneration = self._generation
+		self._searchRequested.emit(self._generation, self.searchField.text())
+
+	@pyqtSlot(int, object)
+	def onFound(self, generation: int, matches: List[TuneMatch]) -> None:
+		if generation != self._generation:
+			# the user has kept typing since
+			return
+
+		def describe(m: TuneMatch) -> str:
+			if m.matched == m.name:
+				return f"{m.name} ({m.type})"
+			return f"{m.matched} - {m.name} ({m.type})"
+
+		self._matches = matches
+		self.completerModel.setStringList([describe(m) for m in matches])
+		if len(matches) > 0:
+			self.completer.complete()
+
+	@pyqtSlot(QModelIndex)
+	def onActivated(self, index: QModelIndex) -> None:
+		# drop any searches still in flight, they'd reopen the popup
+		self._debounce.stop()
+		self._generation += 1
+
+		# unfiltered completion, so rows line up with self._matches
+		row = index.row()
+		if 0 <= row < len(self._matches):
+			self.gotTuneURI.emit(self._matches[row].uri)
+
+
+class TuneSearchWorker(QObject):
+	found = pyqtSignal(int, object, name="found")
+
+	# written by the GUI thread, so that searches that are already stale can be skipped
+	latestGeneration: int = 0
+
+	_index: TuneIndex
+
+	def __init__(self, index: TuneIndex) -> None:
+		super().__init__()
+		self._index = index
+
+	@pyqtSlot(int, str)
+	def search(self, generation: int, query: str) -> None:
+		if generation < self.latestGeneration:
+			return
+		self.found.emit(generation, self._index.search(query))
+
+
 class MyAddCards(AddCards):
 	uriContainer: Optional[URIContainer] = None
+	searchContainer: Optional[TuneSearchContainer] = None
 	tuneGrabber: "TuneGrabber"
 
 	def __init__(self, mw: AnkiQt) -> None:
@@ -144,6 +285,14 @@ class MyAddCards(AddCards):
 
 		self.tuneGrabber = TuneGrabber(self.mw, self)
 		self.uriContainer.gotTuneURI.connect(self.onNewTuneInput)  # type: ignore
+
+		index = load_from_session._tune_index
+		if index is not None:
+			searchContainer = TuneSearchContainer(index, self)
+			self.form.verticalLayout.insertWidget(modelAndDeckIndex + 2, searchContainer)
+			self.searchContainer = searchContainer
+			self.searchContainer.gotTuneURI.connect(self.onNewTuneInput)  # type: ignore
+
 		self.tuneGrabber.done.connect(self.onNewTuneLoaded)  # type: ignore
 
 		# this gets called in super() but we need to call it again to hide/show the uricontainer.
@@ -158,11 +307,14 @@ class MyAddCards(AddCards):
 			return
 
 		nt = self.editor.note.note_type()
+		is_tune = nt is not None and col_note_type.is_ankitunes_nt(nt)
 
-		if nt is not None and col_note_type.is_ankitunes_nt(nt):
-			self.uriContainer.show()
-		else:
-			self.uriContainer.hide()
+		self.uriContainer.setVisible(is_tune)
+
+		if self.searchContainer is not None:
+			index = load_from_session._tune_index
+			has_tunes = index is not None and not index.is_empty()
+			self.searchContainer.setVisible(is_tune and has_tunes)
 
 	@pyqtSlot(str)
 	def onNewTuneInput(self, uri: str) -> None:
@@ -195,84 +347,326 @@ class MyAddCards(AddCards):
 				print("Got a tune, but the Editor's note wasn't of the Ankitunes note type")
 				return
 
-			# protect us from ourselves - we need to update this if note schema changes
-			fieldsToWrite: NoteFields = {
-				"Name": tune.name,
-				"Key": tune.key,
-				"Tune Type": tune.type,
-				"ABC": tune.abc.replace("\n", "<br />\n"),
-				"Link": tune.uri,
-			}
-
-			for field, value in fieldsToWrite.items():
+			for field, value in tunebook.note_fields(tune).items():
 				assert isinstance(value, str)
 				note[field] = value
 
 			self.editor.loadNote()
 
 
+@dataclass
+class GrabStats:
+	requested: int = 0
+	# asked for a tune that was already on its way
+	coalesced: int = 0
+	# replaced by a newer grab before finishing
+	superseded: int = 0
+	# superseded grabs that were stopped before they hit the network
+	cancelled: int = 0
+	retries: int = 0
+	succeeded: int = 0
+	failed: int = 0
+
+
 class TuneGrabber(QObject):
-	_thread: Optional[QThread]
-	_grabber: Optional["TuneGrabRunnable"]
-	_grabConnection: Optional[QMetaObject.Connection]
+	_current: Optional["TuneGrabRunnable"]
+	_inflight: Dict[Hashable, "TuneGrabRunnable"]
 	_mw: AnkiQt
 
+	stats: GrabStats
+
 	done = pyqtSignal(object, name="done")
 
 	def __init__(self, mw: AnkiQt, parent: QObject) -> None:
 		super().__init__(parent)
 
-		self._thread = None
+		self._current = None
+		self._inflight = {}
 		self._mw = mw
+		self.stats = GrabStats()
+
+	@staticmethod
+	def _key(uri: str) -> Hashable:
+		"Different spellings of the same tune and setting get the same key."
+		parsed = load_from_session._parse_thesession_url(uri)
+		return parsed.value if isinstance(parsed, Ok) else uri
 
 	def grab(self, uri: str) -> None:
-		print("tg.grab")
-		if self._thread is not None:
-			print("abandoning old grab thread!")
-			self._clearThread()
-
-		self._thread = QThread(self._mw)
-		self._grabber = TuneGrabRunnable(uri)
-		self._grabber.moveToThread(self._thread)
-		self._thread.started.connect(self._grabber.run)  # type: ignore
-		self._thread.finished.connect(self._thread.deleteLater)  # type: ignore
-		self._thread.finished.connect(self._grabber.deleteLater)  # type: ignore
-		self._grabConnection = self._grabber.done.connect(self._grabDone)  # type: ignore
-		self._grabber.done.connect(self._thread.exit)
+		self.stats.requested += 1
+		key = self._key(uri)
+
+		existing = self._inflight.get(key)
+		if existing is not None:
+			# already on its way - make sure it's still wanted, and wait for it
+			self.stats.coalesced += 1
+			self._supersede(keep=existing)
+			existing.uncancel()
+			self._current = existing
+			return
 
-		self._thread.start()
+		self._supersede(keep=None)
+		self._start(uri, key)
+
+	def _start(self, uri: str, key: Hashable) -> None:
+		grabber = TuneGrabRunnable(uri, key)
+		grabber.done.connect(self._grabDone)  # type: ignore
+		grabber.cancelled.connect(self._grabCancelled)  # type: ignore
+
+		self._inflight[key] = grabber
+		self._current = grabber
+
+		self._launch(grabber)
+
+	def _launch(self, grabber: "TuneGrabRunnable") -> None:
+		"Runs grabber on a thread of its own."
+		thread = QThread(self._mw)
+		grabber.moveToThread(thread)
+		thread.started.connect(grabber.run)  # type: ignore
+		thread.finished.connect(thread.deleteLater)  # type: ignore
+		thread.finished.connect(grabber.deleteLater)  # type: ignore
+		grabber.done.connect(thread.exit)
+		grabber.cancelled.connect(thread.exit)
+		thread.start()
+
+	def _supersede(self, keep: Optional["TuneGrabRunnable"]) -> None:
+		"Cancels every in flight grab apart from keep."
+		for grabber in self._inflight.values():
+			if grabber is not keep and not grabber.isCancelled():
+				if not grabber.superseded:
+					# it might have been wanted again since, but it's still one grab
+					grabber.superseded = True
+					self.stats.superseded += 1
+				grabber.cancel()
+
+	@pyqtSlot(object, object)
+	def _grabDone(self, grabber: "TuneGrabRunnable", result: GrabResult) -> None:
+		self._inflight.pop(grabber.key, None)
+		self.stats.retries += grabber.retries
+
+		if grabber is not self._current:
+			# superseded, nobody wants this any more
+			return
 
-	def _clearThread(self) -> None:
-		if self._grabber is not None and self._grabConnection is not None:
-			self._grabber.disconnect(self._grabConnection)  # type: ignore
-		self._thread = None
-		self._grabber = None
-		self._grabConnection = None
+		self._current = None
+		if isinstance(result, Ok):
+			self.stats.succeeded += 1
+		else:
+			self.stats.failed += 1
+		self.done.emit(result)
 
 	@pyqtSlot(object)
-	def _grabDone(self, result: GrabResult) -> None:
-		self._clearThread()
+	def _grabCancelled(self, grabber: "TuneGrabRunnable") -> None:
+		self._inflight.pop(grabber.key, None)
+		self.stats.retries += grabber.retries
+		self.stats.cancelled += 1
 
-		self.done.emit(result)
+		if grabber is self._current:
+			# it was wanted again after all, but gave up before it noticed. Start over.
+			self._start(grabber.uri, grabber.key)
 
 
 class TuneGrabRunnable(QObject):
 	uri: str
-	done = pyqtSignal(object, name="done")
+	key: Hashable
+	retries: int
+	# set by TuneGrabber the first time a newer grab cancels this one
+	superseded: bool
+
+	MAX_RETRIES = 3
+	BACKOFF_BASE = 0.5  # seconds
+	BACKOFF_CAP = 8.0  # seconds
+
+	done = pyqtSignal(object, object, name="done")
+	cancelled = pyqtSignal(object, name="cancelled")
 
-	def __init__(self, uri: str) -> None:
+	_cancel: threading.Event
+
+	def __init__(self, uri: str, key: Hashable) -> None:
 		super().__init__()
 		self.uri = uri
+		self.key = key
+		self.retries = 0
+		self.superseded = False
+		self._cancel = threading.Event()
+
+	# cancel()/uncancel() are called from the GUI thread, everything else runs on our own.
+	def cancel(self) -> None:
+		self._cancel.set()
+
+	def uncancel(self) -> None:
+		self._cancel.clear()
+
+	def isCancelled(self) -> bool:
+		return self._cancel.is_set()
+
+	@staticmethod
+	def isTransient(result: GrabResult) -> bool:
+		if not isinstance(result, Err):
+			return False
+		err = result.err_value
+		if isinstance(err, GrabError.JSONError):
+			return True
+		if isinstance(err, GrabError.NetworkError):
+			# 404s and friends won't get better by asking again, and neither will huge responses
+			e = err.exception
+			if isinstance(e, ResponseTooLarge):
+				return False
+			return not (isinstance(e, HTTPStatusError) and e.status < 500)
+		return False
+
+	def backoff(self, attempt: int) -> float:
+		# "full jitter", spreads retries out so they don't all land at once
+		return random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2**attempt))
 
 	@pyqtSlot()
 	def run(self) -> None:
-		print("running")
-		result = load_from_session.get_from_thesession(self.uri)
-		print("loaded!")
-		self.done.emit(result)
+		attempt = 0
+		while True:
+			if self.isCancelled():
+				self.cancelled.emit(self)
+				return
+
+			result = load_from_session.get_from_thesession(self.uri)
+
+			if not self.isTransient(result) or attempt >= self.MAX_RETRIES:
+				self.done.emit(self, result)
+				return
+
+			# wait, but wake straight away if we get cancelled
+			if self._cancel.wait(self.backoff(attempt)):
+				self.cancelled.emit(self)
+				return
+
+			attempt += 1
+			self.retries += 1
+
+
+def import_thesession_dump() -> None:
+	from concurrent.futures import Future
+	from aqt.utils import getFile, tooltip, showWarning
+
+	index = load_from_session._tune_index
+	if index is None:
+		showWarning(
+			"The local tune index couldn't be opened, so there's nothing to import into."
+		)
+		return
+
+	def on_progress(stats: ImportStats) -> None:
+		label = f"Imported {stats.rows} rows from TheSession..."
+		mw().taskman.run_on_main(lambda: mw().progress.update(label=label))
+
+	def on_done(fut: Future[ImportStats]) -> None:
+		try:
+			stats: ImportStats = fut.result()
+		except Exception as e:
+			showWarning(f"Couldn't import the TheSession data dump: {e}")
+			return
+		tooltip(
+			f"Imported {stats.rows} rows: {stats.settings_written} settings "
+			f"and {stats.aliases_written} aliases were new or changed."
+		)
+
+	def on_file(path: Union[str, Sequence[str]]) -> None:
+		assert isinstance(path, str)
+		assert index is not None
+		mw().taskman.with_progress(
+			lambda: index.import_dump(path, progress=on_progress),
+			on_done,
+			label="Importing TheSession data dump...",
+		)
+
+	getFile(
+		mw(),
+		"Import TheSession data dump (tunes or aliases)",
+		on_file,
+		filter="*.csv *.json",
+	)
+
+
+def import_thesession_collection() -> None:
+	from aqt.operations import CollectionOp
+	from aqt.utils import getText, tooltip, showWarning
+
+	url, ok = getText(
+		"Tunebook or sets URL, e.g. https://thesession.org/members/1/tunebook",
+		parent=mw(),
+		title="Import from TheSession",
+	)
+	url = url.strip()
+	if not ok or url == "":
+		return
+
+	deck_id = mw().col.decks.get_current_id()
+
+	def on_progress(done: int, total: int) -> None:
+		label = f"Fetched {done} of {total} tunes from TheSession..."
+		mw().taskman.run_on_main(lambda: mw().progress.update(label=label))
+
+	def on_success(imported: tunebook.ImportedCollection) -> None:
+		result = imported.result
+		if isinstance(result, Err):
+			showWarning(result.err_value.msg)
+			return
+		added = result.value
+		message = f"Imported {added.added} tunes."
+		if added.duplicates > 0:
+			message += f" {added.duplicates} were already in your collection."
+		if len(added.errors) > 0:
+			message += f" {len(added.errors)} couldn't be fetched."
+		tooltip(message)
+
+	# fetching and adding is all one op, so there's one progress dialog and one undo step
+	CollectionOp(
+		mw(),
+		lambda col: tunebook.import_collection(col, url, deck_id, on_progress),
+	).success(on_success).run_in_background()
+
+
+def open_tune_cache(path: str) -> Optional[TuneCache]:
+	"Opens the tune cache, starting a fresh one if the file on disk is unreadable."
+	try:
+		return TuneCache(path)
+	except sqlite3.Error:
+		pass
+
+	# it's only a cache, so a corrupt file can just go.
+	try:
+		os.remove(path)
+		return TuneCache(path)
+	except (OSError, sqlite3.Error) as e:
+		error(
+			f"AnkiTunes couldn't open its cache of TheSession tunes ({e}), so every "
+			f"tune will be fetched again. Deleting {path} may fix it.",
+			mode=ErrorMode.HINT,
+		)
+		return None
 
 
 def on_main_window_did_init() -> None:
+	load_from_session.set_tune_cache(
+		open_tune_cache(os.path.join(user_files_dir(), "thesession_cache.sqlite3"))
+	)
+	index_path = os.path.join(user_files_dir(), "thesession_index.sqlite3")
+	try:
+		load_from_session.set_tune_index(TuneIndex(index_path))
+	except sqlite3.Error as e:
+		# e.g. no FTS5 in this SQLite, or a corrupt file. Tunes still come from TheSession.
+		load_from_session.set_tune_index(None)
+		error(
+			f"AnkiTunes couldn't open its local tune index ({e}), so searching tunes "
+			f"offline is turned off. Deleting {index_path} may fix it.",
+			mode=ErrorMode.HINT,
+		)
+
+	action = QAction("Import TheSession data dump...", mw())
+	action.triggered.connect(import_thesession_dump)  # type: ignore
+	mw().form.menuTools.addAction(action)
+
+	action = QAction("Import TheSession tunebook or sets...", mw())
+	action.triggered.connect(import_thesession_collection)  # type: ignore
+	mw().form.menuTools.addAction(action)
+
 	aqt.dialogs.register_dialog("AddCards", MyAddCards)
 
 
@@ -0,0 +1,113 @@
+"""
+An in-memory LRU cache of each card's rendered question and answer HTML.
+
+The same tunes come up in set after set, and the tunes themselves hardly ever
+change, so rendering them again (ABC, script tags and all) is wasted work.
+Entries are keyed on the note's and the note type's modification times as well
+as the card id, so an edited tune or template just misses the cache, and the
+old entry ages out.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import *
+
+from anki.cards import Card
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+
+# card id, note mtime, note type mtime (bumped whenever a template or the css changes)
+RenderKey = Tuple[int, int, int]
+
+
+@dataclass
+class RenderCacheStats:
+	hits: int = 0
+	misses: int = 0
+	evictions: int = 0
+
+	@property
+	def hit_rate(self) -> float:
+		lookups = self.hits + self.misses
+		return self.hits / lookups if lookups else 0.0
+
+
+class RenderedCard(NamedTuple):
+	question: str
+	answer: str
+
+	def size(self) -> int:
+		return sys.getsizeof(self.question) + sys.getsizeof(self.answer)
+
+
+class RenderCache:
+	max_bytes: int
+	stats: RenderCacheStats
+
+	_entries: "OrderedDict[RenderKey, RenderedCard]"
+	_total_bytes: int
+	# sets are rendered from the prefetch thread too
+	_lock: threading.Lock
+
+	def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+		self.max_bytes = max_bytes
+		self.stats = RenderCacheStats()
+		self._entries = OrderedDict()
+		self._total_bytes = 0
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def key(card: Card) -> RenderKey:
+		note = card.note()
+		return (card.id, note.mod, card.note_type()["mod"])
+
+	def render(self, card: Card) -> RenderedCard:
+		"card's question and answer HTML, rendering it only if it's not cached."
+		key = self.key(card)
+		with self._lock:
+			rendered = self._entries.get(key)
+			if rendered is not None:
+				self._entries.move_to_end(key)
+				self.stats.hits += 1
+				return rendered
+			self.stats.misses += 1
+
+		# render outside the lock, it's the slow bit
+		out = card.render_output()
+		rendered = RenderedCard(out.question_and_style(), out.answer_and_style())
+		self._put(key, rendered)
+		return rendered
+
+	def _put(self, key: RenderKey, rendered: RenderedCard) -> None:
+		size = rendered.size()
+		if size > self.max_bytes:
+			return
+		with self._lock:
+			old = self._entries.pop(key, None)
+			if old is not None:
+				self._total_bytes -= old.size()
+			self._entries[key] = rendered
+			self._total_bytes += size
+			while self._total_bytes > self.max_bytes:
+				_, evicted = self._entries.popitem(last=False)
+				self._total_bytes -= evicted.size()
+				self.stats.evictions += 1
+
+	def __contains__(self, key: RenderKey) -> bool:
+		with self._lock:
+			return key in self._entries
+
+	def __len__(self) -> int:
+		with self._lock:
+			return len(self._entries)
+
+	@property
+	def total_bytes(self) -> int:
+		return self._total_bytes
+
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+			self._total_bytes = 0
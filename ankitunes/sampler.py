@@ -0,0 +1,98 @@
+"""
+Weighted random choice from a list that keeps changing, via a Fenwick tree.
+
+Draws, weight updates, appends and pops from the end all cost O(log n), so a
+pool of thousands of tunes can be reweighted after every review without
+rebuilding anything. (An alias table would draw in O(1), but every update
+would mean rebuilding it.) Weights are ints, so sums never drift.
+"""
+
+import random
+from typing import *
+
+
+class FenwickSampler:
+	# _tree[i] is the sum of _weights[i - lowbit(i) : i], 1-based, and as long as
+	# the capacity. Slots past len(self) have weight 0.
+	_tree: List[int]
+	_weights: List[int]
+
+	def __init__(self, weights: Iterable[int] = ()) -> None:
+		self._weights = []
+		self._build(list(weights), 1)
+
+	def _build(self, weights: List[int], capacity: int) -> None:
+		for w in weights:
+			if w < 0:
+				raise ValueError(f"negative weight {w}")
+		capacity = max(capacity, len(weights))
+		tree = [0] * (capacity + 1)
+		tree[1 : len(weights) + 1] = weights
+		for i in range(1, capacity + 1):
+			parent = i + (i & -i)
+			if parent <= capacity:
+				tree[parent] += tree[i]
+		self._tree = tree
+		self._weights = weights
+
+	def _add(self, index: int, delta: int) -> None:
+		i = index + 1
+		while i < len(self._tree):
+			self._tree[i] += delta
+			i += i & -i
+
+	def __len__(self) -> int:
+		return len(self._weights)
+
+	def __getitem__(self, index: int) -> int:
+		return self._weights[index]
+
+	def __setitem__(self, index: int, weight: int) -> None:
+		if weight < 0:
+			raise ValueError(f"negative weight {weight}")
+		self._add(index, weight - self._weights[index])
+		self._weights[index] = weight
+
+	def append(self, weight: int) -> None:
+		if len(self._weights) + 1 >= len(self._tree):
+			# out of room, rebuild at double the size, O(1) amortised
+			self._build([*self._weights, weight], 2 * len(self._tree))
+			return
+		self._weights.append(0)
+		self[len(self._weights) - 1] = weight
+
+	def pop(self) -> int:
+		weight = self._weights[-1]
+		self[len(self._weights) - 1] = 0
+		self._weights.pop()
+		return weight
+
+	@property
+	def total(self) -> int:
+		total = 0
+		i = len(self._weights)
+		while i > 0:
+			total += self._tree[i]
+			i -= i & -i
+		return total
+
+	def find(self, x: int) -> int:
+		"The index i where sum(weights[:i]) <= x < sum(weights[:i+1])."
+		pos = 0
+		step = 1 << (len(self._tree) - 1).bit_length()
+		while step > 0:
+			nxt = pos + step
+			if nxt < len(self._tree) and self._tree[nxt] <= x:
+				pos = nxt
+				x -= self._tree[nxt]
+			step >>= 1
+		if pos >= len(self._weights):
+			raise IndexError("x is past the total weight")
+		return pos
+
+	def sample(self, rng: Optional[random.Random] = None) -> int:
+		"An index, chosen with probability proportional to its weight."
+		total = self.total
+		if total <= 0:
+			raise IndexError("nothing to sample, all weights are 0")
+		return self.find((rng or cast(random.Random, random)).randrange(total))
@@ -0,0 +1,260 @@
+"""
+An in-memory index of AnkiTunes cards by deck and tune type, for picking the
+other tunes in a set.
+
+Searching the collection for "Tune Type:reel deck:Whatever" and sorting the
+matches by RANDOM() for every question gets slow with thousands of tunes.
+Instead the index is built once, with one query. After a review only the
+answered cards are re-read, by id, and after a note is added or edited only its
+cards are. Anything else that might have touched any card (the browser, undo)
+means a rebuild the next time it's used.
+
+Companions aren't picked uniformly: tunes that are overdue, that have a low
+ease, or that haven't been played in a long time get more of a look in.
+"""
+
+import random
+from typing import *
+
+from anki.collection import Collection as AnkiCollection
+from anki.consts import CARD_TYPE_RELEARNING, CARD_TYPE_REV
+
+from .sampler import FenwickSampler
+
+if TYPE_CHECKING:
+	from anki.cards import CardId
+	from anki.decks import DeckId
+	from anki.notes import NoteId
+	from anki.models import NoteType
+
+_PoolKey = Tuple[int, str]  # (deck id, tune type)
+# card id, note id, deck id, original deck id, fields, type, queue, due, interval, ease
+_Row = Tuple[int, int, int, int, str, int, int, int, int, int]
+
+# weights are kept as ints, in thousandths
+WEIGHT_SCALE = 1000
+
+
+class _IndexedCard(NamedTuple):
+	nid: int
+	# every pool the card is in, and where it is in that pool
+	positions: Dict[_PoolKey, int]
+
+
+class _Pool(NamedTuple):
+	card_ids: List[int]
+	# weights[i] is card_ids[i]'s weight
+	weights: FenwickSampler
+
+
+def _tune_type_key(tune_type: str) -> str:
+	# Anki's field searches are case insensitive
+	return tune_type.strip().lower()
+
+
+def companion_weight(
+	ctype: int, queue: int, due: int, ivl: int, factor: int, today: int
+) -> float:
+	"""How much a card would get out of being played as a companion, 1 being average.
+
+	Review cards gain weight for being overdue (relative to their interval), for
+	a low ease, and for not having been played for a long time."""
+	if queue < 0:
+		# suspended or buried, they're out of rotation for a reason
+		return 0.0
+	if ctype != CARD_TYPE_REV and ctype != CARD_TYPE_RELEARNING:
+		# new or learning, due isn't in days
+		return 1.0
+
+	overdue = max(0, today - due)
+	weight = 1.0 + min(overdue / max(ivl, 1), 4.0)
+	if factor > 0:
+		weight += max(0.0, 2.5 - factor / 1000) * 2
+	# (roughly) days since it was last played
+	weight += min((ivl + overdue) / 365, 2.0)
+	return weight
+
+
+class SetIndex:
+	col: AnkiCollection
+	nt_id: int
+
+	_tune_type_ord: int
+	_pools: Dict[_PoolKey, _Pool]
+	_cards: Dict[int, _IndexedCard]
+	# weights depend on the day they were worked out on
+	_today: int
+	# cards, and notes whose cards, to re-read before the next sample
+	_changed: Set[int]
+	_changed_notes: Set[int]
+	# anything might have changed, rebuild before the next sample
+	_invalid: bool
+	_rng: random.Random
+
+	def __init__(
+		self, col: AnkiCollection, nt: "NoteType", seed: Optional[int] = None
+	) -> None:
+		"Pass a seed to get the same samples every time, for tests and benchmarks."
+		self.col = col
+		self.nt_id = nt["id"]
+		self._tune_type_ord = next(f["ord"] for f in nt["flds"] if f["name"] == "Tune Type")
+		self._rng = random.Random(seed)
+		self.rebuild()
+
+	def _rows(self, where: str = "", *args: Any) -> Iterable[_Row]:
+		assert self.col.db is not None
+		return cast(
+			Iterable[_Row],
+			self.col.db.execute(
+				"select c.id, c.nid, c.did, c.odid, n.flds, c.type, c.queue, c.due, c.ivl, "
+				f"c.factor from cards c join notes n on n.id = c.nid where n.mid = ? {where}",
+				self.nt_id,
+				*args,
+			),
+		)
+
+	def rebuild(self) -> None:
+		self._pools = {}
+		self._cards = {}
+		self._today = self.col.sched.today
+		self._changed = set()
+		self._changed_notes = set()
+		self._invalid = False
+		for row in self._rows():
+			self._add(*row)
+
+	def mark_changed(self, card_ids: Iterable[int]) -> None:
+		"These cards (e.g. just answered) get re-read before the next sample."
+		self._changed.update(card_ids)
+
+	def mark_notes_changed(self, note_ids: Iterable[int]) -> None:
+		"These notes' cards (e.g. just added or edited) get re-read before the next sample."
+		self._changed_notes.update(note_ids)
+
+	def invalidate(self) -> None:
+		"Anything could have changed, e.g. after an edit or an undo: rebuild when next used."
+		self._invalid = True
+
+	def sync(self) -> None:
+		"Catches up with changes to the collection, if there might have been any."
+		if self._invalid or self.col.sched.today != self._today:
+			# (a new day moves every review card's weight)
+			self.rebuild()
+			return
+		if len(self._changed) == 0 and len(self._changed_notes) == 0:
+			return
+
+		# O(k log n) for k changed cards: they're looked up by id, not found by mtime
+		changed, self._changed = self._changed, set()
+		changed_notes, self._changed_notes = self._changed_notes, set()
+		where = []
+		if len(changed) > 0:
+			where.append(f"c.id in ({', '.join(str(int(c)) for c in changed)})")
+		if len(changed_notes) > 0:
+			where.append(f"c.nid in ({', '.join(str(int(n)) for n in changed_notes)})")
+		rows = list(self._rows(f"and ({' or '.join(where)})"))
+
+		for cid in changed.union(row[0] for row in rows):
+			self._remove(cid)
+		for row in rows:
+			self._add(*row)
+
+	def _add(
+		self,
+		cid: int,
+		nid: int,
+		did: int,
+		odid: int,
+		flds: str,
+		ctype: int,
+		queue: int,
+		due: int,
+		ivl: int,
+		factor: int,
+	) -> None:
+		fields = flds.split("\x1f")
+		if self._tune_type_ord >= len(fields):
+			return
+		tune_type = _tune_type_key(fields[self._tune_type_ord])
+		weight = companion_weight(ctype, queue, due, ivl, factor, self._today)
+		scaled_weight = int(weight * WEIGHT_SCALE)
+
+		positions: Dict[_PoolKey, int] = {}
+		# deck searches match cards by their home deck too, when they're in a filtered deck
+		for deck_id in (did, odid) if odid else (did,):
+			key = (deck_id, tune_type)
+			pool = self._pools.get(key)
+			if pool is None:
+				pool = self._pools[key] = _Pool([], FenwickSampler())
+			positions[key] = len(pool.card_ids)
+			pool.card_ids.append(cid)
+			pool.weights.append(scaled_weight)
+		self._cards[cid] = _IndexedCard(nid, positions)
+
+	def _remove(self, cid: int) -> None:
+		card = self._cards.pop(cid, None)
+		if card is None:
+			return
+		for key, i in card.positions.items():
+			pool = self._pools[key]
+			last = pool.card_ids.pop()
+			last_weight = pool.weights.pop()
+			if last != cid:
+				# swap the last card into the hole
+				pool.card_ids[i] = last
+				pool.weights[i] = last_weight
+				self._cards[last].positions[key] = i
+			if len(pool.card_ids) == 0:
+				del self._pools[key]
+
+	def __len__(self) -> int:
+		return len(self._cards)
+
+	def sample(
+		self,
+		deck_ids: Iterable[int],
+		tune_type: str,
+		k: int,
+		exclude_nid: Optional["NoteId"] = None,
+		rng: Optional[random.Random] = None,
+	) -> List["CardId"]:
+		"""Up to k cards of tune_type in any of deck_ids, not from exclude_nid, drawn
+		at random by companion_weight.
+
+		Costs O(k * (len(deck_ids) + log n)) for n cards in the pools."""
+		self.sync()
+
+		rng = rng or self._rng
+		tune_type = _tune_type_key(tune_type)
+		pools = [
+			pool for pool in (self._pools.get((d, tune_type)) for d in deck_ids) if pool
+		]
+
+		found: Dict[int, None] = {}
+		# weights zeroed while drawing, so nothing gets drawn twice
+		zeroed: List[Tuple[_Pool, int, int]] = []
+		try:
+			while len(found) < k:
+				totals = [pool.weights.total for pool in pools]
+				total = sum(totals)
+				if total == 0:
+					break
+				x = rng.randrange(total)
+				for pool, pool_total in zip(pools, totals):
+					if x < pool_total:
+						cid = pool.card_ids[pool.weights.find(x)]
+						break
+					x -= pool_total
+
+				# (a card can be in two of the pools if it's in a filtered deck)
+				for key, i in self._cards[cid].positions.items():
+					pool = self._pools[key]
+					zeroed.append((pool, i, pool.weights[i]))
+					pool.weights[i] = 0
+				if self._cards[cid].nid != exclude_nid:
+					found[cid] = None
+		finally:
+			for pool, i, weight in reversed(zeroed):
+				pool.weights[i] = weight
+
+		return cast(List["CardId"], list(found))
@@ -0,0 +1,139 @@
+"""
+Plans the sets for a whole Practice Sets session up front.
+
+Picking companions at random as each card comes up means the same few tunes
+get played over and over, while other due tunes only ever turn up as focus
+cards. Instead, when a session starts, the due cards are split into sets of
+the same tune type (and optionally key), so that every due tune gets played in
+a set with other due tunes.
+
+Anki still decides which card comes next, so the plan is kept by card id, and
+a set is served whenever any of its cards comes up. Each set is only served
+once: the rest of its cards get companions picked the usual way if they come
+up again.
+"""
+
+import random
+from typing import *
+
+from anki.collection import Collection as AnkiCollection
+
+from .set_index import _tune_type_key
+
+if TYPE_CHECKING:
+	from anki.cards import CardId
+	from anki.models import NoteType
+
+# a session is never more than a few hundred cards, don't plan for a whole backlog
+MAX_PLANNED_CARDS = 500
+
+_GroupKey = Tuple[str, str]  # (tune type, key)
+
+
+class SessionPlan:
+	# card id -> every card in its set, itself included
+	_sets: Dict[int, List["CardId"]]
+
+	def __init__(self, sets: Iterable[Sequence["CardId"]] = ()) -> None:
+		self._sets = {}
+		for planned_set in sets:
+			for card_id in planned_set:
+				self._sets[card_id] = list(planned_set)
+
+	def companions(self, card_id: int) -> Optional[List["CardId"]]:
+		"The other cards planned to be in card_id's set, or None if it wasn't planned."
+		planned_set = self._sets.get(card_id)
+		if planned_set is None:
+			return None
+		return [other for other in planned_set if other != card_id]
+
+	def serve(self, card_id: int) -> None:
+		"card_id's set has been played, take it out of the plan."
+		for other in self._sets.get(card_id, ()):
+			self._sets.pop(other, None)
+
+	def sets(self) -> List[List["CardId"]]:
+		seen: Set[int] = set()
+		sets = []
+		for planned_set in self._sets.values():
+			if planned_set[0] not in seen:
+				seen.update(planned_set)
+				sets.append(planned_set)
+		return sets
+
+	def __len__(self) -> int:
+		return len(self._sets)
+
+
+def session_card_ids(col: AnkiCollection) -> Sequence["CardId"]:
+	"The cards the scheduler is going to show this session, as near as we can tell."
+	if col.v3_scheduler():
+		queued = col.sched.get_queued_cards(fetch_limit=MAX_PLANNED_CARDS)  # type: ignore
+		return [cast("CardId", queued_card.card.id) for queued_card in queued.cards]
+
+	# The v1/v2 queues are only filled a bit at a time, so ask the search instead,
+	# and stop where the deck's daily limits would.
+	counts = col.sched.deck_due_tree(col.decks.get_current_id())
+	due = col.find_cards(
+		"deck:current is:due -is:suspended -is:buried", order="c.type desc, c.due asc"
+	)[: counts.review_count + counts.learn_count]
+	new = col.find_cards(
+		"deck:current is:new -is:suspended -is:buried", order="c.due asc"
+	)[: counts.new_count]
+	return [*due, *new][:MAX_PLANNED_CARDS]
+
+
+def plan_session(
+	col: AnkiCollection,
+	nt: "NoteType",
+	card_ids: Sequence["CardId"],
+	set_length: Callable[[], int],
+	by_key: bool = False,
+	rng: Optional[random.Random] = None,
+) -> SessionPlan:
+	"""Splits card_ids into sets of the same tune type, in one pass.
+
+	Each set gets set_length() cards, if there are enough to go around. Cards
+	that end up on their own in a set that wanted company are left out of the
+	plan, so they get companions picked for them the usual way."""
+	rng = rng or cast(random.Random, random)
+	ords = {f["name"]: f["ord"] for f in nt["flds"]}
+	tune_type_ord = ords["Tune Type"]
+	key_ord = ords.get("Key") if by_key else None
+
+	if len(card_ids) == 0:
+		return SessionPlan()
+
+	# the session is all from the current deck, so sets don't need splitting by deck
+	assert col.db is not None
+	groups: Dict[_GroupKey, List["CardId"]] = {}
+	for cid, flds in col.db.execute(
+		"select c.id, n.flds from cards c join notes n on n.id = c.nid "
+		f"where n.mid = ? and c.id in ({', '.join(str(int(cid)) for cid in card_ids)})",
+		nt["id"],
+	):
+		fields = flds.split("\x1f")
+		if tune_type_ord >= len(fields):
+			continue
+		tune_type = fields[tune_type_ord]
+		if " " in tune_type or tune_type.strip() == "":
+			# turn_card_into_set will complain about these
+			continue
+		key = ""
+		if key_ord is not None and key_ord < len(fields):
+			key = fields[key_ord].strip().lower()
+		groups.setdefault((_tune_type_key(tune_type), key), []).append(cid)
+
+	sets: List[List["CardId"]] = []
+	for group_cards in groups.values():
+		rng.shuffle(group_cards)
+		start = 0
+		while start < len(group_cards):
+			length = max(1, set_length())
+			planned_set = group_cards[start : start + length]
+			start += length
+			if len(planned_set) == 1 and length > 1:
+				continue
+			sets.append(planned_set)
+
+	return SessionPlan(sets)
@@ -0,0 +1,151 @@
+"""
+Timings for the reviewer's hot path, to find out what makes a card slow to show.
+
+Switched on by ANKITUNES_TIMING=1 in the environment, or by the
+ankitunes_timing key in the collection's config. When it's off, a timed
+function costs one extra call and an attribute check.
+"""
+
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import *
+
+import aqt
+import aqt.gui_hooks
+import aqt.utils
+from anki.collection import Collection as AnkiCollection
+from aqt.qt import QAction
+
+from .util import mw, user_files_dir
+
+CONFIG_KEY = "ankitunes_timing"
+
+# how many of the latest samples are kept for each timer
+WINDOW = 1000
+# upper bounds of the histogram buckets, in ms. The last bucket is everything slower.
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def _percentile(sorted_samples: Sequence[float], p: float) -> float:
+	pos = (len(sorted_samples) - 1) * p / 100
+	lo = int(pos)
+	hi = min(lo + 1, len(sorted_samples) - 1)
+	return sorted_samples[lo] + (sorted_samples[hi] - sorted_samples[lo]) * (pos - lo)
+
+
+class Timings:
+	enabled: bool
+
+	_samples: Dict[str, Deque[float]]
+	_counts: Dict[str, int]
+	# the prefetcher times things from its own thread
+	_lock: threading.Lock
+
+	def __init__(self, enabled: bool = False) -> None:
+		self.enabled = enabled
+		self._samples = {}
+		self._counts = {}
+		self._lock = threading.Lock()
+
+	def record(self, name: str, seconds: float) -> None:
+		with self._lock:
+			samples = self._samples.get(name)
+			if samples is None:
+				samples = self._samples[name] = deque(maxlen=WINDOW)
+			samples.append(seconds)
+			self._counts[name] = self._counts.get(name, 0) + 1
+
+	def reset(self) -> None:
+		with self._lock:
+			self._samples.clear()
+			self._counts.clear()
+
+	def summary(self) -> Dict[str, Dict[str, Any]]:
+		"For each timer, over the latest WINDOW samples, in ms."
+		with self._lock:
+			snapshot = {name: list(samples) for name, samples in self._samples.items()}
+			counts = dict(self._counts)
+
+		summary = {}
+		for name, samples in sorted(snapshot.items()):
+			ms = sorted(s * 1000 for s in samples)
+			histogram = [0] * (len(BUCKETS_MS) + 1)
+			for sample in ms:
+				histogram[bisect.bisect_left(BUCKETS_MS, sample)] += 1
+			buckets = {f"<={bound}": count for bound, count in zip(BUCKETS_MS, histogram)}
+			buckets[f">{BUCKETS_MS[-1]}"] = histogram[-1]
+			summary[name] = {
+				"calls": counts[name],
+				"n": len(ms),
+				"mean": sum(ms) / len(ms),
+				"p50": _percentile(ms, 50),
+				"p95": _percentile(ms, 95),
+				"p99": _percentile(ms, 99),
+				"max": ms[-1],
+				"histogram": buckets,
+			}
+		return summary
+
+	def dump(self, path: str) -> None:
+		with open(path, "w") as f:
+			json.dump(self.summary(), f, indent=2)
+
+
+timings = Timings(enabled=os.environ.get("ANKITUNES_TIMING") == "1")
+
+
+def timed(name: str) -> Callable[[F], F]:
+	"Records how long every call of the decorated function takes, when timing is on."
+
+	def decorate(fn: F) -> F:
+		@functools.wraps(fn)
+		def wrapper(*args: Any, **kwargs: Any) -> Any:
+			if not timings.enabled:
+				return fn(*args, **kwargs)
+			start = time.perf_counter()
+			try:
+				return fn(*args, **kwargs)
+			finally:
+				timings.record(name, time.perf_counter() - start)
+
+		return cast(F, wrapper)
+
+	return decorate
+
+
+def on_collection_did_load(col: AnkiCollection) -> None:
+	if os.environ.get("ANKITUNES_TIMING") != "1":
+		timings.enabled = bool(col.get_config(CONFIG_KEY, False))
+
+
+def show_timings() -> None:
+	if not timings.enabled:
+		aqt.utils.showInfo(
+			"AnkiTunes timing is off. Start Anki with ANKITUNES_TIMING=1, or set "
+			f"{CONFIG_KEY} to true in the collection's config, to turn it on."
+		)
+		return
+	path = os.path.join(user_files_dir(), "timings.json")
+	timings.dump(path)
+	aqt.utils.showText(
+		f"Saved to {path}\n\n" + json.dumps(timings.summary(), indent=2),
+		title="AnkiTunes Timings",
+	)
+
+
+def on_main_window_did_init() -> None:
+	action = QAction("AnkiTunes Timings...", mw())
+	action.triggered.connect(show_timings)  # type: ignore
+	mw().form.menuTools.addAction(action)
+
+
+def setup() -> None:
+	aqt.gui_hooks.collection_did_load.append(on_collection_did_load)
+	aqt.gui_hooks.main_window_did_init.append(on_main_window_did_init)
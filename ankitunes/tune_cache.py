@@ -0,0 +1,181 @@
+"""
+A persistent cache of tune JSON from TheSession.org, keyed by tune id.
+
+Entries are served straight from disk while they are younger than the TTL.
+Once they go stale they are kept around so that the next fetch can be a
+conditional request (ETag / Last-Modified), which usually comes back as a
+cheap 304. The cache is bounded by total body size, and evicts least
+recently used tunes once it grows past that.
+"""
+
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import *
+
+DEFAULT_TTL = 7 * 24 * 60 * 60  # a week, in seconds
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+SCHEMA_VERSION = 1
+
+
+@dataclass
+class CacheStats:
+	hits: int = 0
+	misses: int = 0
+	stale: int = 0
+	revalidated: int = 0
+	evictions: int = 0
+
+
+class CachedTune(NamedTuple):
+	body: bytes
+	etag: Optional[str]
+	last_modified: Optional[str]
+	fresh: bool
+
+
+class TuneCache:
+	path: str
+	ttl: float
+	max_bytes: int
+	stats: CacheStats
+
+	_db: sqlite3.Connection
+	_lock: threading.Lock
+	_clock: Callable[[], float]
+	_total_bytes: int
+
+	def __init__(
+		self,
+		path: str,
+		ttl: float = DEFAULT_TTL,
+		max_bytes: int = DEFAULT_MAX_BYTES,
+		clock: Callable[[], float] = time.time,
+	) -> None:
+		self.path = path
+		self.ttl = ttl
+		self.max_bytes = max_bytes
+		self.stats = CacheStats()
+
+		self._lock = threading.Lock()
+		self._clock = clock
+
+		# tunes get fetched from worker threads, all access goes through self._lock.
+		self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		try:
+			self._setup_schema()
+			(total,) = self._db.execute(
+				"SELECT COALESCE(SUM(size), 0) FROM tunes"
+			).fetchone()
+		except sqlite3.Error:
+			# don't keep the file open, so the caller can delete it and start again
+			self._db.close()
+			raise
+		self._total_bytes = total
+
+	def _setup_schema(self) -> None:
+		(version,) = self._db.execute("PRAGMA user_version").fetchone()
+		if version == SCHEMA_VERSION:
+			return
+
+		# it's a cache, so on any version mismatch just start again.
+		self._db.executescript(
+			f"""
+			DROP TABLE IF EXISTS tunes;
+			CREATE TABLE tunes (
+				id INTEGER PRIMARY KEY,
+				body BLOB NOT NULL,
+				etag TEXT,
+				last_modified TEXT,
+				fetched_at REAL NOT NULL,
+				accessed_at REAL NOT NULL,
+				size INTEGER NOT NULL
+			);
+			CREATE INDEX tunes_accessed_at ON tunes (accessed_at);
+			PRAGMA user_version = {SCHEMA_VERSION};
+			"""
+		)
+
+	def get(self, tune_id: int) -> Optional[CachedTune]:
+		"Returns the cached tune, if any. Stale entries are returned with fresh=False so they can be revalidated."
+		with self._lock:
+			row = self._db.execute(
+				"SELECT body, etag, last_modified, fetched_at FROM tunes WHERE id = ?",
+				(tune_id,),
+			).fetchone()
+
+			if row is None:
+				self.stats.misses += 1
+				return None
+
+			body, etag, last_modified, fetched_at = row
+			now = self._clock()
+			self._db.execute("UPDATE tunes SET accessed_at = ? WHERE id = ?", (now, tune_id))
+
+			fresh = now - fetched_at < self.ttl
+			if fresh:
+				self.stats.hits += 1
+			else:
+				self.stats.stale += 1
+
+			return CachedTune(bytes(body), etag, last_modified, fresh)
+
+	def put(
+		self,
+		tune_id: int,
+		body: bytes,
+		etag: Optional[str] = None,
+		last_modified: Optional[str] = None,
+	) -> None:
+		with self._lock:
+			now = self._clock()
+			old = self._db.execute("SELECT size FROM tunes WHERE id = ?", (tune_id,)).fetchone()
+			self._db.execute(
+				"INSERT OR REPLACE INTO tunes VALUES (?, ?, ?, ?, ?, ?, ?)",
+				(tune_id, body, etag, last_modified, now, now, len(body)),
+			)
+			self._total_bytes += len(body) - (old[0] if old is not None else 0)
+			self._evict()
+
+	def refresh(self, tune_id: int) -> None:
+		"Marks a stale entry as fresh again, e.g. after the server answered 304 Not Modified."
+		with self._lock:
+			self._db.execute(
+				"UPDATE tunes SET fetched_at = ? WHERE id = ?", (self._clock(), tune_id)
+			)
+			self.stats.revalidated += 1
+
+	def _evict(self) -> None:
+		"Drops least recently used tunes until we fit in max_bytes. Must hold self._lock."
+		if self._total_bytes <= self.max_bytes:
+			return
+
+		victims: List[int] = []
+		freed = 0
+		for tune_id, size in self._db.execute(
+			"SELECT id, size FROM tunes ORDER BY accessed_at ASC"
+		):
+			if self._total_bytes - freed <= self.max_bytes:
+				break
+			victims.append(tune_id)
+			freed += size
+
+		self._db.executemany("DELETE FROM tunes WHERE id = ?", ((v,) for v in victims))
+		self._total_bytes -= freed
+		self.stats.evictions += len(victims)
+
+	def __len__(self) -> int:
+		with self._lock:
+			(count,) = self._db.execute("SELECT COUNT(*) FROM tunes").fetchone()
+			return int(count)
+
+	def clear(self) -> None:
+		with self._lock:
+			self._db.execute("DELETE FROM tunes")
+			self._total_bytes = 0
+
+	def close(self) -> None:
+		with self._lock:
+			self._db.close()
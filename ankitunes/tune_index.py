@@ -0,0 +1,396 @@
+"""
+A local SQLite index of TheSession's tune catalogue, built from their data dumps
+(https://github.com/adactio/TheSession-data).
+
+Both the CSV and the JSON flavours of the tunes and aliases dumps can be
+imported. Dumps are streamed row by row and written in batches, so memory
+use doesn't depend on the size of the dump. Importing a newer dump over an
+older one only writes the rows that changed.
+
+Tune names and aliases are also kept in a full text index, for searching
+by name as you type.
+"""
+
+import csv
+import json
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import *
+
+SCHEMA_VERSION = 2
+
+DEFAULT_BATCH_SIZE = 2000
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS tunes (
+	id INTEGER PRIMARY KEY,
+	name TEXT NOT NULL,
+	type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tunes_type ON tunes (type);
+
+CREATE TABLE IF NOT EXISTS settings (
+	id INTEGER PRIMARY KEY,
+	tune_id INTEGER NOT NULL,
+	key TEXT NOT NULL,
+	meter TEXT,
+	abc TEXT NOT NULL,
+	date TEXT
+);
+CREATE INDEX IF NOT EXISTS settings_tune_id ON settings (tune_id, id);
+CREATE INDEX IF NOT EXISTS settings_key ON settings (key);
+
+CREATE TABLE IF NOT EXISTS aliases (
+	tune_id INTEGER NOT NULL,
+	alias TEXT NOT NULL,
+	PRIMARY KEY (tune_id, alias)
+) WITHOUT ROWID;
+
+"""
+
+# names holds every tune's name and its aliases, and is kept in sync by triggers.
+# Trigram tokenizing lets any part of a name match, but needs SQLite 3.34.
+NAMES_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5(
+	name, tune_id UNINDEXED, alias UNINDEXED, tokenize = '{tokenizer}'
+);
+
+CREATE TRIGGER IF NOT EXISTS tunes_names_insert AFTER INSERT ON tunes BEGIN
+	INSERT INTO names (name, tune_id, alias) VALUES (new.name, new.id, 0);
+END;
+CREATE TRIGGER IF NOT EXISTS tunes_names_update AFTER UPDATE OF name ON tunes BEGIN
+	DELETE FROM names WHERE tune_id = old.id AND alias = 0;
+	INSERT INTO names (name, tune_id, alias) VALUES (new.name, new.id, 0);
+END;
+CREATE TRIGGER IF NOT EXISTS aliases_names_insert AFTER INSERT ON aliases BEGIN
+	INSERT INTO names (name, tune_id, alias) VALUES (new.alias, new.tune_id, 1);
+END;
+"""
+
+DEFAULT_SEARCH_LIMIT = 10
+
+
+class IndexedSetting(NamedTuple):
+	id: int
+	key: str
+	abc: str
+
+
+class IndexedTune(NamedTuple):
+	id: int
+	name: str
+	type: str
+	settings: List[IndexedSetting]
+
+
+class TuneMatch(NamedTuple):
+	id: int
+	name: str
+	type: str
+	matched: str  # the name or alias that matched the query
+	# the tune's first setting, as a tunebook import would take
+	setting_id: Optional[int] = None
+
+	@property
+	def uri(self) -> str:
+		if self.setting_id is None:
+			return f"https://thesession.org/tunes/{self.id}"
+		return f"https://thesession.org/tunes/{self.id}#setting{self.setting_id}"
+
+
+@dataclass
+class ImportStats:
+	rows: int = 0
+	bad_rows: int = 0
+	tunes_written: int = 0
+	settings_written: int = 0
+	aliases_written: int = 0
+
+
+Row = Mapping[str, Any]
+
+
+def iter_dump_rows(path: str) -> Iterator[Row]:
+	"Streams the rows of a TheSession dump file, as dicts keyed by column name."
+	if path.lower().endswith(".json"):
+		with open(path, "r", encoding="utf-8") as f:
+			yield from _iter_json_array(f)
+	else:
+		with open(path, "r", encoding="utf-8", newline="") as f:
+			yield from csv.DictReader(f)
+
+
+def _iter_json_array(f: IO[str], chunk_size: int = 64 * 1024) -> Iterator[Row]:
+	"Yields the objects in a top level JSON array one at a time, as they are read."
+	decoder = json.JSONDecoder()
+	buf = ""
+	pos = 0
+	started = False
+	eof = False
+
+	while True:
+		# skip whitespace and separators
+		while pos < len(buf) and buf[pos] in " \t\r\n,":
+			pos += 1
+
+		if pos < len(buf) and not started:
+			if buf[pos] != "[":
+				raise ValueError("TheSession dump should be a JSON array")
+			started = True
+			pos += 1
+			continue
+
+		if pos < len(buf) and buf[pos] == "]":
+			return
+
+		if pos < len(buf):
+			try:
+				obj, end = decoder.raw_decode(buf, pos)
+			except json.JSONDecodeError:
+				if eof:
+					raise
+				obj, end = None, -1
+			if end != -1 and (end < len(buf) or eof):
+				if isinstance(obj, dict):
+					yield obj
+				pos = end
+				continue
+
+		if eof:
+			if not started:
+				raise ValueError("TheSession dump should be a JSON array")
+			raise ValueError("TheSession dump ended unexpectedly")
+
+		# need more data
+		chunk = f.read(chunk_size)
+		buf = buf[pos:] + chunk
+		pos = 0
+		eof = chunk == ""
+
+
+class TuneIndex:
+	path: str
+
+	trigram: bool
+
+	_db: sqlite3.Connection
+	_lock: threading.Lock
+
+	def __init__(self, path: str) -> None:
+		self.path = path
+		self._lock = threading.Lock()
+		# lookups happen on worker threads, all access goes through self._lock.
+		self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self._setup_schema()
+
+	def _setup_schema(self) -> None:
+		(version,) = self._db.execute("PRAGMA user_version").fetchone()
+		self._db.executescript(SCHEMA)
+
+		try:
+			self._db.executescript(NAMES_SCHEMA.format(tokenizer="trigram"))
+		except sqlite3.OperationalError:
+			self._db.executescript(NAMES_SCHEMA.format(tokenizer="unicode61"))
+
+		# IF NOT EXISTS succeeds whatever tokenizer an existing table has (e.g. one
+		# made by an older SQLite without trigram), so ask the table itself.
+		(names_sql,) = self._db.execute(
+			"SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'names'"
+		).fetchone()
+		self.trigram = "trigram" in names_sql.lower()
+
+		if version < 2:
+			# v1 indexes had no names table, fill it from what's already there
+			self._db.executescript(
+				"""
+				BEGIN;
+				DELETE FROM names;
+				INSERT INTO names (name, tune_id, alias) SELECT name, id, 0 FROM tunes;
+				INSERT INTO names (name, tune_id, alias) SELECT alias, tune_id, 1 FROM aliases;
+				COMMIT;
+				"""
+			)
+
+		self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+	def get_tune(self, tune_id: int) -> Optional[IndexedTune]:
+		with self._lock:
+			tune = self._db.execute(
+				"SELECT id, name, type FROM tunes WHERE id = ?", (tune_id,)
+			).fetchone()
+			if tune is None:
+				return None
+			settings = self._db.execute(
+				"SELECT id, key, abc FROM settings WHERE tune_id = ? ORDER BY id", (tune_id,)
+			).fetchall()
+
+		if len(settings) == 0:
+			return None
+
+		id, name, type = tune
+		return IndexedTune(id, name, type, [IndexedSetting(*s) for s in settings])
+
+	def search(self, query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> List[TuneMatch]:
+		"Finds tunes whose name or one of whose aliases contain all the words in query."
+
+		fts_query = self._fts_query(query)
+		if fts_query is None:
+			return []
+
+		with self._lock:
+			rows = self._db.execute(
+				"""
+				SELECT tunes.id, tunes.name, tunes.type, matches.name,
+					(SELECT MIN(id) FROM settings WHERE settings.tune_id = tunes.id)
+				FROM (
+					SELECT tune_id, name, alias FROM names WHERE names MATCH ?
+					ORDER BY alias, length(name) LIMIT ?
+				) AS matches
+				JOIN tunes ON tunes.id = matches.tune_id
+				ORDER BY matches.alias, length(matches.name)
+				""",
+				# a tune can match more than once through its aliases, leave room for that.
+				(fts_query, limit * 4),
+			).fetchall()
+
+		matches: Dict[int, TuneMatch] = {}
+		for row in rows:
+			match = TuneMatch(*row)
+			if match.id not in matches:
+				matches[match.id] = match
+			if len(matches) == limit:
+				break
+
+		return list(matches.values())
+
+	def _fts_query(self, query: str) -> Optional[str]:
+		def phrase(word: str) -> str:
+			return '"' + word.replace('"', '""') + '"'
+
+		words = query.split()
+		if self.trigram:
+			# trigrams can't match anything shorter than 3 characters
+			words = [w for w in words if len(w) >= 3]
+			if len(words) == 0:
+				return None
+			return " AND ".join(phrase(w) for w in words)
+		else:
+			if len(words) == 0:
+				return None
+			return " AND ".join(phrase(w) + "*" for w in words)
+
+	def is_empty(self) -> bool:
+		with self._lock:
+			return self._db.execute("SELECT 1 FROM tunes LIMIT 1").fetchone() is None
+
+	def __len__(self) -> int:
+		"Number of tunes in the index."
+		with self._lock:
+			(count,) = self._db.execute("SELECT COUNT(*) FROM tunes").fetchone()
+			return int(count)
+
+	def import_dump(
+		self,
+		path: str,
+		batch_size: int = DEFAULT_BATCH_SIZE,
+		progress: Optional[Callable[[ImportStats], None]] = None,
+	) -> ImportStats:
+		"""Imports a tunes or aliases dump file (CSV or JSON).
+
+		Rows are committed in transactions of batch_size rows. Rows that are already
+		in the index unchanged are not rewritten."""
+		return self.import_rows(iter_dump_rows(path), batch_size, progress)
+
+	def import_rows(
+		self,
+		rows: Iterable[Row],
+		batch_size: int = DEFAULT_BATCH_SIZE,
+		progress: Optional[Callable[[ImportStats], None]] = None,
+	) -> ImportStats:
+		stats = ImportStats()
+		batch: List[Row] = []
+		for row in rows:
+			batch.append(row)
+			if len(batch) >= batch_size:
+				self._import_batch(batch, stats)
+				batch = []
+				if progress is not None:
+					progress(stats)
+
+		if len(batch) > 0:
+			self._import_batch(batch, stats)
+			if progress is not None:
+				progress(stats)
+
+		return stats
+
+	def _import_batch(self, batch: Sequence[Row], stats: ImportStats) -> None:
+		tunes: Dict[int, Tuple[int, str, str]] = {}
+		settings: List[Tuple[int, int, str, Optional[str], str, Optional[str]]] = []
+		aliases: List[Tuple[int, str]] = []
+
+		for row in batch:
+			stats.rows += 1
+			try:
+				tune_id = int(row["tune_id"])
+				if "alias" in row:
+					aliases.append((tune_id, str(row["alias"])))
+					continue
+				tunes[tune_id] = (tune_id, str(row["name"]), str(row["type"]))
+				settings.append(
+					(
+						int(row["setting_id"]),
+						tune_id,
+						str(row["mode"]),
+						row.get("meter"),
+						str(row["abc"]),
+						row.get("date"),
+					)
+				)
+			except (KeyError, ValueError, TypeError):
+				stats.bad_rows += 1
+
+		with self._lock:
+			db = self._db
+			db.execute("BEGIN")
+			try:
+				cursor = db.executemany(
+					"""
+					INSERT INTO tunes (id, name, type) VALUES (?, ?, ?)
+					ON CONFLICT (id) DO UPDATE SET name = excluded.name, type = excluded.type
+					WHERE name IS NOT excluded.name OR type IS NOT excluded.type
+					""",
+					tunes.values(),
+				)
+				# rowcount rather than total_changes, which would count the triggers' writes too
+				stats.tunes_written += cursor.rowcount
+
+				cursor = db.executemany(
+					"""
+					INSERT INTO settings (id, tune_id, key, meter, abc, date)
+					VALUES (?, ?, ?, ?, ?, ?)
+					ON CONFLICT (id) DO UPDATE SET
+						tune_id = excluded.tune_id, key = excluded.key, meter = excluded.meter,
+						abc = excluded.abc, date = excluded.date
+					WHERE tune_id IS NOT excluded.tune_id OR key IS NOT excluded.key
+						OR meter IS NOT excluded.meter OR abc IS NOT excluded.abc
+						OR date IS NOT excluded.date
+					""",
+					settings,
+				)
+				stats.settings_written += cursor.rowcount
+
+				cursor = db.executemany(
+					"INSERT OR IGNORE INTO aliases (tune_id, alias) VALUES (?, ?)", aliases
+				)
+				stats.aliases_written += cursor.rowcount
+
+				db.execute("COMMIT")
+			except BaseException:
+				db.execute("ROLLBACK")
+				raise
+
+	def close(self) -> None:
+		with self._lock:
+			self._db.close()
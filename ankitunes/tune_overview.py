@@ -49,10 +49,12 @@ class TuneOverview:
 		# then _linkHandler() call can be removed.
 		if message == "study_sets":
 			tune_reviewer.is_reviewing_tunes = True
+			tune_reviewer.plan_practice_session(mw().col)
 			self.overview._linkHandler("study")
 			return (True, None)
 		elif message == "study":
 			tune_reviewer.is_reviewing_tunes = False
+			tune_reviewer.set_session_plan(None)
 			self.overview._linkHandler("study")
 			return (True, None)
 
@@ -1,40 +1,49 @@
 from __future__ import annotations
 import aqt
 import aqt.gui_hooks
-from aqt.qt import debug
+from aqt.qt import debug, QAction
 import aqt.webview
-from anki.cards import Card
-from anki.collection import SearchNode, Collection as AnkiCollection
-
+from anki.cards import Card, CardId
+from anki.notes import Note
+from anki.collection import OpChanges, Collection as AnkiCollection
+from anki.errors import NotFoundError
+from anki.models import NoteType
+from anki.scheduler.v3 import CardAnswer
+
+import aqt.editor
 import aqt.reviewer
 import anki.collection
 
 import os
 import random
 import json
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 from typing import *
 
 from .errors import error, ErrorMode
+from .result import Ok
 from .util import mw
-from .col_note_type import is_ankitunes_nt, NoteFields
+from .col_note_type import is_ankitunes_nt, NoteFields, TNTMigrator, TNTVersion
+from .set_index import SetIndex
+from .set_planner import SessionPlan, plan_session, session_card_ids
+from .render_cache import RenderCache, RenderedCard
+from .timing import timed
+
+import logging
+
+logger = logging.getLogger(__name__)
 
 if TYPE_CHECKING:
 	import anki.scheduler.v1
+	from anki.scheduler.v3 import Scheduler as V3Scheduler
 	import anki.scheduler.v2
 
 HTML = NewType("HTML", str)
 Scheduler = Union[anki.scheduler.v1.Scheduler, anki.scheduler.v2.Scheduler]
 
 
-class FocusCardProtocol(Protocol):
-	_ankitunes_set: Sequence[Card]
-
-
-# https://github.com/python/typing/issues/213
-class FocusCard(Card, FocusCardProtocol):
-	pass
-
-
 ## Magic Global State
 is_reviewing_tunes = False
 
@@ -52,11 +61,165 @@ def set_up_reviewer_bottom(web_content: aqt.webview.WebContent, context: Any) ->
 	return
 
 
+## Set Index
+
+_set_index: Optional[SetIndex] = None
+
+
+def get_set_index(col: AnkiCollection, nt: NoteType) -> SetIndex:
+	global _set_index
+	if _set_index is None or _set_index.col is not col or _set_index.nt_id != nt["id"]:
+		# for testing and benchmarking, to get the same sets every time
+		seed = os.environ.get("ANKITUNES_SEED")
+		_set_index = SetIndex(col, nt, seed=int(seed) if seed else None)
+	return _set_index
+
+
+# Set by add_cards_did_add_note, which fires just before the add op's changes do.
+_note_just_added = False
+
+
+def on_add_cards_did_add_note(note: Note) -> None:
+	global _note_just_added
+	if _set_index is not None:
+		_set_index.mark_notes_changed([note.id])
+		_note_just_added = True
+
+
+def on_operation_did_execute(changes: OpChanges, handler: Optional[object]) -> None:
+	global _note_just_added
+	note_just_added, _note_just_added = _note_just_added, False
+
+	if changes.card or changes.note_text or changes.deck or changes.notetype:
+		# a prefetched set might not be right any more
+		prefetcher.clear()
+		if _set_index is None or isinstance(handler, aqt.reviewer.Reviewer):
+			# answers get to the index through on_reviewer_did_answer_card, card by card
+			# (the reviewer's other ops are flags and marks)
+			return
+
+		if changes.notetype:
+			_set_index.invalidate()
+		elif isinstance(handler, aqt.editor.Editor) and handler.note is not None:
+			# an edit, e.g. from the reviewer's Edit button or the browser
+			_set_index.mark_notes_changed([handler.note.id])
+		elif not note_just_added:
+			# anything else, like the browser's own ops or an undo, could have touched
+			# any card
+			_set_index.invalidate()
+
+
+def on_state_did_reset() -> None:
+	# changes that don't come through an op (other add-ons, legacy undo) end in a reset
+	if _set_index is not None:
+		_set_index.invalidate()
+
+
+def on_state_did_change(new_state: str, old_state: str) -> None:
+	if old_state == "review" and new_state != "review":
+		# the session's over, and the next might not start from Practice Sets
+		set_registry.clear()
+		set_session_plan(None)
+
+
+def on_collection_will_change(*args: Any) -> None:
+	global _set_index, _session_plan
+	_set_index = None
+	_session_plan = None
+	prefetcher.clear()
+	# card ids only mean anything within one collection
+	render_cache.clear()
+	set_registry.clear()
+
+
+## Set Registry
+# Which cards are in the set shown for each focus card, until the answer's shown.
+
+
+class SetRegistry:
+	max_sets: int
+
+	# focus card id -> the set's card ids, in the order they were shown
+	_sets: "OrderedDict[int, Tuple[CardId, ...]]"
+
+	def __init__(self, max_sets: int = 64) -> None:
+		self.max_sets = max_sets
+		self._sets = OrderedDict()
+
+	def add(self, focus_id: int, card_ids: Iterable[CardId]) -> None:
+		self._sets.pop(focus_id, None)
+		self._sets[focus_id] = tuple(card_ids)
+		while len(self._sets) > self.max_sets:
+			self._sets.popitem(last=False)
+
+	def get(self, focus_id: int) -> Optional[Tuple[CardId, ...]]:
+		return self._sets.get(focus_id)
+
+	def __contains__(self, focus_id: int) -> bool:
+		return focus_id in self._sets
+
+	def __len__(self) -> int:
+		return len(self._sets)
+
+	def clear(self) -> None:
+		self._sets.clear()
+
+
+set_registry = SetRegistry()
+
+
+def get_set(col: AnkiCollection, focus_card: Card) -> Optional[List[Card]]:
+	"The cards in focus_card's set, freshly loaded (but for focus_card itself)."
+	card_ids = set_registry.get(focus_card.id)
+	if card_ids is None:
+		return None
+	others = {card.id: card for card in load_cards(col, card_ids)}
+	others[focus_card.id] = focus_card
+	return [others[card_id] for card_id in card_ids if card_id in others]
+
+
+## Session Plan
+
+_session_plan: Optional[SessionPlan] = None
+
+
+def set_session_plan(plan: Optional[SessionPlan]) -> None:
+	global _session_plan
+	_session_plan = plan
+	prefetcher.clear()
+
+
+def plan_practice_session(col: AnkiCollection, by_key: bool = False) -> None:
+	"Plans sets for everything that's due in the current deck, before it's studied."
+	version_res = TNTMigrator(col.models).get_current_version()
+	if not isinstance(version_res, Ok):
+		set_session_plan(None)
+		return
+	version, nt = version_res.value
+	if nt is None or version != max(TNTVersion):
+		set_session_plan(None)
+		return
+
+	plan = plan_session(col, nt, session_card_ids(col), choose_set_length, by_key)
+	logger.debug(f"planned sets for {len(plan)} cards")
+	set_session_plan(plan)
+
+
+def planned_companions(focus_id: CardId) -> Optional[List[CardId]]:
+	if _session_plan is None:
+		return None
+	return _session_plan.companions(focus_id)
+
+
 ## Question
 
 
+@timed("turn_card_into_set")
 def turn_card_into_set(
-	focus_card: FocusCard, col: anki.collection.Collection, set_length: int
+	focus_card: Card,
+	col: anki.collection.Collection,
+	set_length: int,
+	companions: Optional[Sequence[Card]] = None,
 ) -> Sequence[Card]:
 	""" prerequisite: focus_card has already been tested to be the latest ankitunes notetype."""
 
@@ -76,14 +239,7 @@ def turn_card_into_set(
 		)
 		return [focus_card]
 
-	# readability
-	def join(
-		a: Union[str, SearchNode],
-		op: anki.collection.SearchJoiner,
-		b: Union[str, SearchNode],
-	) -> SearchNode:
-		return col.group_searches(a, b, joiner=op)
-
+	deck_ids: Sequence[int]
 	deck = col.decks.get(focus_card.did)
 	if deck is None:
 		error(
@@ -94,43 +250,78 @@ def turn_card_into_set(
 			"This might be a bug, feel free to whinge/open a github issue.",
 			mode=ErrorMode.SCARY_WARNING,
 		)
-
-	# unsure why type assertion is required here, mypy sucks
-	search_conditions: List[Union[str, SearchNode]] = [
-		f'"Tune Type:{tune_type}"',
-		SearchNode(negated=SearchNode(nid=focus_card.nid)),
-	]
-	if deck is not None:
-		search_conditions.append(SearchNode(deck=deck["name"]))
-
-	search = col.group_searches(
-		*search_conditions,
-		joiner="AND",
-	)
-	search_str = col.build_search_string(search)
-	print(f"searching for {search_str}")
-
-	search_limit = set_length - 1
-
-	other_ids = col.find_cards(search_str, order=f"RANDOM() limit {search_limit}")
-	print(f"found {other_ids=}")
-	others = (col.getCard(card_id) for card_id in other_ids)
+		deck_ids = [d.id for d in col.decks.all_names_and_ids()]
+	else:
+		# like a deck: search, subdecks count too
+		deck_ids = col.decks.deck_and_child_ids(focus_card.did)
+
+	if companions is None:
+		companions = load_cards(
+			col, pick_companions(col, focus_card, tune_type, deck_ids, set_length)
+		)
 
 	# add with focus card and turn into a shuffled set
-	set_cards = [focus_card, *others]
+	set_cards = [focus_card, *companions]
 	random.shuffle(set_cards)
 
-	# attach set to focus card
-	focus_card._ankitunes_set = set_cards
+	# remember the set for the answer
+	set_registry.add(focus_card.id, (card.id for card in set_cards))
 
 	# return set
 	return set_cards
 
 
+@timed("pick_companions")
+def pick_companions(
+	col: AnkiCollection,
+	focus_card: Card,
+	tune_type: str,
+	deck_ids: Sequence[int],
+	set_length: int,
+) -> List[CardId]:
+	search_limit = set_length - 1
+
+	other_ids = get_set_index(col, focus_card.note_type()).sample(
+		deck_ids, tune_type, search_limit, exclude_nid=focus_card.nid
+	)
+	logger.debug(f"found {other_ids=}")
+	return other_ids
+
+
+@timed("load_cards")
+def load_cards(col: AnkiCollection, card_ids: Sequence[CardId]) -> List[Card]:
+	"""Like [col.get_card(id) for id in card_ids], skipping cards that are gone.
+
+	Cards come from the public API (their notes load when first asked for), as
+	building them by hand breaks whenever the backend's card format changes."""
+	cards = []
+	for card_id in card_ids:
+		try:
+			cards.append(col.get_card(card_id))
+		except NotFoundError:
+			# deleted since the set index last looked
+			continue
+	return cards
+
+
+render_cache = RenderCache()
+
+
+@timed("render_set")
+def render_set(cards: Sequence[Card]) -> List[RenderedCard]:
+	"""Renders each card once, for both its question and answer.
+
+	Anki can only render one card at a time, but the output is cached, so showing
+	the answers later (or the same tune in a later set) doesn't render it again."""
+	return [render_cache.render(card) for card in cards]
+
+
+@timed("format_set_question")
 def format_set_question(cards: Sequence[Card]) -> HTML:
-	return HTML("\n".join(card.question() for card in cards))
+	return HTML("\n".join(rendered.question for rendered in render_set(cards)))
 
 
+@timed("on_card_will_show_qn")
 def on_card_will_show_qn(
 	q: str,
 	card: Card,
@@ -149,20 +340,168 @@ def on_card_will_show_qn(
 	# for testing..
 	col = col or mw().col
 
-	# also for testing..
-	# TODO: user accessible configuration?
-	if set_length is None:
-		if os.environ.get("ANKITUNES_TESTING") == "1":
-			set_length = 2
-		else:
-			set_length = random.choices([1, 2, 3], weights=[1, 3, 1], k=1)[0]
-
-	cards = turn_card_into_set(cast(FocusCard, card), col, set_length)
+	companions = None
+	prepared = prefetcher.take(card, col)
+	planned = planned_companions(card.id)
+	if prepared is not None:
+		set_length, companions = prepared
+	elif planned is not None:
+		companions = load_cards(col, planned)
+		set_length = len(companions) + 1
+	elif set_length is None:
+		set_length = choose_set_length()
+
+	cards = turn_card_into_set(card, col, set_length, companions)
+	if planned is not None and _session_plan is not None:
+		# each planned set is played once, not once for every card in it
+		_session_plan.serve(card.id)
 	newQ = format_set_question(cards)
 
 	return newQ
 
 
+def choose_set_length() -> int:
+	# for testing..
+	# TODO: user accessible configuration?
+	if os.environ.get("ANKITUNES_TESTING") == "1":
+		return 2
+	return random.choices([1, 2, 3], weights=[1, 3, 1], k=1)[0]
+
+
+## Prefetch
+# While an answer is on screen, guess which card is next and get its set ready.
+
+
+def predict_next_card_id(col: AnkiCollection) -> Optional[CardId]:
+	"A guess at the card the scheduler will show after the current one."
+	sched = col.sched
+	if col.v3_scheduler():
+		# the queue still starts with the card being answered
+		queued = sched.get_queued_cards(fetch_limit=2)  # type: ignore
+		if len(queued.cards) < 2:
+			return None
+		return CardId(queued.cards[1].card.id)
+
+	# v1/v2 pop from the end of these. They're private, and might be renamed or go
+	# away, hence the getattr. Learning cards can jump in ahead too, so it's only a
+	# guess, but a wrong guess just means the set gets built the slow way.
+	for queue_name in ("_revQueue", "_newQueue"):
+		queue = getattr(sched, queue_name, None)
+		if queue:
+			return CardId(queue[-1])
+	return None
+
+
+class _PreparedSet:
+	focus_id: CardId
+	set_length: int
+	col: AnkiCollection
+	# filled in on the main thread, once they're loaded and rendered
+	companions: Optional[List[Card]] = None
+	# not wanted any more. A job that's started can't be stopped, but this stops
+	# one that hasn't from touching the collection, and its result from being used.
+	cancelled: bool = False
+
+	def __init__(self, focus_id: CardId, set_length: int, col: AnkiCollection) -> None:
+		self.focus_id = focus_id
+		self.set_length = set_length
+		self.col = col
+
+
+# Runs a task in the background, then calls back with its future on the main thread,
+# like mw.taskman.run_in_background.
+BackgroundRunner = Callable[[Callable[[], Any], Callable[["Future[Any]"], None]], None]
+
+
+class SetPrefetcher:
+	hits: int = 0
+	misses: int = 0
+
+	_run: BackgroundRunner
+	_prepared: Optional[_PreparedSet] = None
+
+	def __init__(self, run: BackgroundRunner) -> None:
+		self._run = run
+
+	def prefetch(self, col: AnkiCollection, focus_id: CardId, set_length: int) -> None:
+		"Picks companions for focus_id now, and loads and renders them in the background."
+		self.clear()
+
+		focus_cards = load_cards(col, [focus_id])
+		if len(focus_cards) == 0:
+			return
+		focus_card = focus_cards[0]
+		if not is_ankitunes_nt(focus_card.note_type()):
+			return
+		tune_type = focus_card.note()["Tune Type"]
+		if " " in tune_type:
+			# leave the complaining to turn_card_into_set
+			return
+
+		companion_ids = planned_companions(focus_id)
+		if companion_ids is not None:
+			set_length = len(companion_ids) + 1
+		else:
+			deck_ids = col.decks.deck_and_child_ids(focus_card.did)
+			companion_ids = pick_companions(col, focus_card, tune_type, deck_ids, set_length)
+
+		prepared = _PreparedSet(focus_id, set_length, col)
+
+		def load() -> List[Card]:
+			if prepared.cancelled:
+				return []
+			companions = load_cards(col, companion_ids)
+			render_set(companions)
+			return companions
+
+		def on_done(future: "Future[List[Card]]") -> None:
+			if prepared.cancelled:
+				return
+			try:
+				prepared.companions = future.result()
+			except Exception:
+				logger.warning("prefetching a set failed", exc_info=True)
+
+		self._prepared = prepared
+		self._run(load, on_done)
+
+	def take(
+		self, focus_card: Card, col: AnkiCollection
+	) -> Optional[Tuple[int, List[Card]]]:
+		"The prepared (set length, companions) for focus_card, if they're ready."
+		prepared, self._prepared = self._prepared, None
+		if prepared is None:
+			return None
+
+		# don't wait if it's not finished, that'd be no quicker than starting again.
+		# And the collection might have been closed or swapped since it started.
+		if (
+			prepared.focus_id != focus_card.id
+			or prepared.companions is None
+			or prepared.col is not col
+		):
+			prepared.cancelled = True
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		return prepared.set_length, prepared.companions
+
+	def clear(self) -> None:
+		if self._prepared is not None:
+			self._prepared.cancelled = True
+		self._prepared = None
+
+
+def _run_in_taskman(
+	task: Callable[[], Any], on_done: Callable[["Future[Any]"], None]
+) -> None:
+	mw().taskman.run_in_background(task, on_done)
+
+
+prefetcher = SetPrefetcher(_run_in_taskman)
+
+
 ## Answer
 
 alpha = "abcdefghijklmnopqrstuvwxyz"
@@ -174,12 +513,10 @@ def random_str(len: int = 8) -> str:
 	return "".join(random.choices(alpha, k=len))
 
 
-def get_set_from_base_card(focus_card: FocusCard) -> Sequence[Card]:
-	return focus_card._ankitunes_set
-
-
+@timed("format_set_answers")
 def format_set_answers(cards: Sequence[Card]) -> HTML:
-	answerHtml = (card.answer() for card in cards)
+	# cached html still has the placeholder, so every showing gets its own ids
+	answerHtml = (rendered.answer for rendered in render_set(cards))
 	replacedAnswerHtml = (html.replace("__ABC_ID__", random_str()) for html in answerHtml)
 	return HTML("\n".join(replacedAnswerHtml))
 
@@ -199,39 +536,176 @@ def update_answer_buttons(focus_card: Card) -> None:
 	mw().reviewer.bottom.web.adjustHeightToFit()
 
 
-def on_card_will_show_ans(ans: str, focus_card: Card, show_type: str) -> HTML:
+def on_card_will_show_ans(
+	ans: str,
+	focus_card: Card,
+	show_type: str,
+	/,
+	col: Optional[AnkiCollection] = None,
+) -> HTML:
 	if not is_reviewing_tunes:
 		return HTML(ans)
 
 	if show_type != "reviewAnswer":
 		return HTML(ans)
 
-	if not hasattr(focus_card, "_ankitunes_set"):
+	if focus_card.id not in set_registry:
 		return HTML(ans)
 
-	cards = get_set_from_base_card(cast(FocusCard, focus_card))
+	# for testing..
+	col = col or mw().col
+
+	cards = get_set(col, focus_card)
+	if cards is None:
+		return HTML(ans)
 	newAns = format_set_answers(cards)
 
 	return newAns
 
 
+@timed("on_reviewer_did_show_ans")
 def on_reviewer_did_show_ans(focus_card: Card) -> None:
 	if not is_reviewing_tunes:
 		return
 
-	# if not hasattr(focus_card, '_ankitunes_set'):
-	# 	return
-
 	update_answer_buttons(focus_card)
 
+	col = mw().col
+	next_id = predict_next_card_id(col)
+	if next_id is not None and next_id != focus_card.id:
+		prefetcher.prefetch(col, next_id, choose_set_length())
+
+
+## Set Grading
+# Optionally, the focus card's grade goes to the rest of its set too.
+
+GRADE_WHOLE_SET_KEY = "ankitunes_grade_whole_set"
+
+
+def grades_whole_set(col: AnkiCollection) -> bool:
+	return bool(col.get_config(GRADE_WHOLE_SET_KEY, False))
+
+
+def set_grades_whole_set(checked: bool) -> None:
+	col = mw().col
+	col.set_config(GRADE_WHOLE_SET_KEY, checked)
+	if checked and not col.v3_scheduler():
+		error(
+			"Grading whole sets needs the v3 scheduler.<br />"
+			"Until it's turned on in Anki's preferences, only the first tune gets a grade.",
+			mode=ErrorMode.HINT,
+		)
+
+
+def _next_states_getter(col: AnkiCollection) -> Optional[Callable[[CardId], Any]]:
+	"How to get a card's next scheduling states, as a v3 answer needs, on this Anki."
+	# public since 2.1.55
+	getter = getattr(col.sched, "get_scheduling_states", None)
+	if getter is None:
+		# before that there was only the backend call
+		getter = getattr(col._backend, "get_next_card_states", None)
+	return cast(Optional[Callable[[CardId], Any]], getter)
+
+
+def _rating_from_ease(ease: int) -> "CardAnswer.Rating.V":
+	ratings = {
+		1: CardAnswer.AGAIN,
+		2: CardAnswer.HARD,
+		3: CardAnswer.GOOD,
+		4: CardAnswer.EASY,
+	}
+	return ratings[ease]
+
+
+def grade_set(
+	col: AnkiCollection,
+	focus_card: Card,
+	ease: int,
+	grades: Optional[Mapping[int, int]] = None,
+) -> int:
+	"""Answers the rest of focus_card's set with ease, or with their own ease in grades.
+
+	Call this just after focus_card has been answered: the set's answers are merged
+	into its undo step, so they all get undone together. Returns how many cards
+	were answered."""
+	if not col.v3_scheduler():
+		# v1/v2 can only undo one review at a time
+		return 0
+	sched = cast("V3Scheduler", col.sched)
+	next_states = _next_states_getter(col)
+	if next_states is None:
+		logger.warning("can't grade whole sets, this Anki has no way to get card states")
+		return 0
+	focus_step = col.undo_status().last_step
+
+	card_ids = set_registry.get(focus_card.id)
+	if card_ids is None:
+		return 0
+
+	graded = 0
+	# loaded now, as they might have been answered or suspended since the set was built
+	companion_ids = [card_id for card_id in card_ids if card_id != focus_card.id]
+	for card in load_cards(col, companion_ids):
+		if card.queue < 0:
+			continue
+		# they were all played together
+		card.timer_started = focus_card.timer_started or time.time()
+		card_ease = (grades or {}).get(card.id, ease)
+		sched.answer_card(
+			sched.build_answer(
+				card=card, states=next_states(card.id), rating=_rating_from_ease(card_ease)
+			)
+		)
+		graded += 1
+
+	if graded > 0:
+		col.merge_undo_entries(focus_step)
+		if _set_index is not None:
+			_set_index.mark_changed(companion_ids)
+		# the next card might have been one of these
+		prefetcher.clear()
+	return graded
+
+
+def on_reviewer_did_answer_card(
+	reviewer: aqt.reviewer.Reviewer, card: Card, ease: int
+) -> None:
+	if _set_index is not None:
+		_set_index.mark_changed([card.id])
+	if not is_reviewing_tunes or card.id not in set_registry:
+		return
+	col = mw().col
+	if grades_whole_set(col):
+		try:
+			grade_set(col, card, ease)
+		except Exception:
+			# the focus card's been answered already, don't take the reviewer down too
+			logger.exception("grading the rest of the set failed")
+
 
 def on_main_window_did_init() -> None:
 	mw().addonManager.setWebExports(__name__, r"web/dist/.*")
 
+	action = QAction("Grade Whole Tune Sets", mw())
+	action.setCheckable(True)
+	action.triggered.connect(set_grades_whole_set)  # type: ignore
+	# the setting is kept in the collection, so check it whenever the menu opens
+	mw().form.menuTools.aboutToShow.connect(  # type: ignore
+		lambda: action.setChecked(mw().col is not None and grades_whole_set(mw().col))
+	)
+	mw().form.menuTools.addAction(action)
+
 
 def setup() -> None:
 	aqt.gui_hooks.webview_will_set_content.append(set_up_reviewer_bottom)
 	aqt.gui_hooks.card_will_show.append(on_card_will_show_qn)
 	aqt.gui_hooks.card_will_show.append(on_card_will_show_ans)
 	aqt.gui_hooks.reviewer_did_show_answer.append(on_reviewer_did_show_ans)
+	aqt.gui_hooks.reviewer_did_answer_card.append(on_reviewer_did_answer_card)
 	aqt.gui_hooks.main_window_did_init.append(on_main_window_did_init)
+	aqt.gui_hooks.operation_did_execute.append(on_operation_did_execute)
+	aqt.gui_hooks.state_did_change.append(on_state_did_change)
+	aqt.gui_hooks.state_did_reset.append(on_state_did_reset)
+	aqt.gui_hooks.add_cards_did_add_note.append(on_add_cards_did_add_note)
+	aqt.gui_hooks.collection_did_load.append(on_collection_will_change)
+	aqt.gui_hooks.sync_did_finish.append(on_collection_will_change)
@@ -0,0 +1,388 @@
+"""
+Importing whole collections of tunes from TheSession.org: a member's tunebook,
+all of a member's sets, or a single set.
+
+Collections are paginated. Only the first page is fetched on its own, to
+find out how many pages there are; after that the remaining pages, any sets
+that need fetching and the tunes themselves all share one worker pool, so
+tunes from page 1 are on their way while page 2 is still loading.
+"""
+
+import re
+import threading
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+from typing import *
+
+import anki.notes
+from anki.collection import Collection as AnkiCollection, OpChanges
+
+if TYPE_CHECKING:
+	from anki.decks import DeckId
+
+from . import col_note_type
+from .col_note_type import NoteFields
+from . import load_from_session
+from .load_from_session import (
+	DEFAULT_MAX_CONCURRENCY,
+	GrabbedTune,
+	GrabError,
+	GrabResult,
+	TheSessionTune,
+	_GrabError,
+)
+from .result import Result, Ok, Err
+
+COLLECTION_PATH_REGEX = re.compile(r"/members/(\d+)/(tunebook|sets)(?:/(\d+))?/?")
+
+# the most TheSession will give us in one go
+PER_PAGE = 50
+
+
+class CollectionKind(Enum):
+	TUNEBOOK = "tunebook"
+	SETS = "sets"
+	SET = "set"
+
+
+class TuneCollection(NamedTuple):
+	kind: CollectionKind
+	member_id: int
+	set_id: Optional[int] = None
+
+	def page_url(self, page: int) -> str:
+		base = f"{load_from_session.THESESSION}/members/{self.member_id}"
+		if self.kind == CollectionKind.TUNEBOOK:
+			return f"{base}/tunebook?format=json&perpage={PER_PAGE}&page={page}"
+		elif self.kind == CollectionKind.SETS:
+			return f"{base}/sets?format=json&perpage={PER_PAGE}&page={page}"
+		else:
+			return f"{base}/sets/{self.set_id}?format=json"
+
+
+def parse_collection_url(
+	url: str,
+) -> Result[TuneCollection, GrabError.BadCollectionUrl]:
+	try:
+		parsed = urllib.parse.urlsplit(url)
+	except ValueError:
+		return Err(GrabError.BadCollectionUrl(url))
+
+	if parsed.netloc not in {"thesession.org", "www.thesession.org"}:
+		return Err(GrabError.BadCollectionUrl(url))
+
+	match = COLLECTION_PATH_REGEX.fullmatch(parsed.path)
+	if match is None:
+		return Err(GrabError.BadCollectionUrl(url))
+
+	member_id = int(match[1])
+	if match[2] == "tunebook":
+		if match[3] is not None:
+			return Err(GrabError.BadCollectionUrl(url))
+		return Ok(TuneCollection(CollectionKind.TUNEBOOK, member_id))
+	elif match[3] is None:
+		return Ok(TuneCollection(CollectionKind.SETS, member_id))
+	else:
+		return Ok(TuneCollection(CollectionKind.SET, member_id, int(match[3])))
+
+
+# (tune id, setting id). A setting id of None means the tune's first setting.
+_TuneRef = Tuple[int, Optional[int]]
+
+# A page lists tune refs, or urls of sets that still need fetching to find their tunes.
+_PageEntry = Union[_TuneRef, str]
+
+
+def _tune_ref(entry_json: Any) -> _TuneRef:
+	"Works for tunebook entries (which are tunes) and set entries (which are settings)."
+	parsed = load_from_session._parse_thesession_url(entry_json["url"])
+	if isinstance(parsed, Err):
+		raise ValueError(f"bad tune url {entry_json['url']}")
+	return parsed.value
+
+
+def _set_url(url: str) -> str:
+	"The API url for a set, from the link a sets listing gives for it."
+	collection = parse_collection_url(url)
+	if isinstance(collection, Err) or collection.value.kind != CollectionKind.SET:
+		raise ValueError(f"bad set url {url}")
+	return collection.value.page_url(1)
+
+
+def _parse_page(
+	kind: CollectionKind, url: str, page_json: Any
+) -> Result[Tuple[int, List[_PageEntry]], _GrabError]:
+	"Returns (number of pages, entries)."
+	try:
+		if kind == CollectionKind.SET:
+			return Ok((1, [_tune_ref(s) for s in page_json["settings"]]))
+
+		pages = int(page_json.get("pages", 1))
+		entries: List[_PageEntry] = []
+		if kind == CollectionKind.TUNEBOOK:
+			entries = [_tune_ref(t) for t in page_json["tunes"]]
+		else:
+			for set_json in page_json["sets"]:
+				if "settings" in set_json:
+					entries.extend(_tune_ref(s) for s in set_json["settings"])
+				else:
+					entries.append(_set_url(set_json["url"]))
+		return Ok((pages, entries))
+	except (KeyError, ValueError, TypeError, AttributeError) as e:
+		return Err(GrabError.APISpecError(url, page_json, e))
+
+
+class _CollectionFetcher:
+	"Fetches everything for one collection through a shared pool, each setting only once."
+
+	_pool: ThreadPoolExecutor
+	_lock: threading.Lock
+	_tunes: Dict[_TuneRef, "Future[Result[TheSessionTune, _GrabError]]"]
+	_futures: List["Future[Any]"]
+	_cancelled: bool = False
+	_progress: Optional[Callable[[int, int], None]]
+	_done: int = 0
+
+	def __init__(
+		self, pool: ThreadPoolExecutor, progress: Optional[Callable[[int, int], None]]
+	) -> None:
+		self._pool = pool
+		self._lock = threading.Lock()
+		self._tunes = {}
+		self._futures = []
+		self._progress = progress
+
+	def submit(self, fn: Callable[..., Any], *args: Any) -> "Future[Any]":
+		with self._lock:
+			return self._submit_locked(fn, *args)
+
+	def _submit_locked(self, fn: Callable[..., Any], *args: Any) -> "Future[Any]":
+		if self._cancelled:
+			future: "Future[Any]" = Future()
+			future.cancel()
+			return future
+		future = self._pool.submit(fn, *args)
+		self._futures.append(future)
+		return future
+
+	def cancel(self) -> None:
+		"Drops everything that hasn't started, so leaving the pool doesn't wait for it."
+		with self._lock:
+			self._cancelled = True
+			futures = list(self._futures)
+		for future in futures:
+			future.cancel()
+
+	def want(self, entries: Iterable[_PageEntry]) -> List[Union[_TuneRef, "Future[Any]"]]:
+		"Starts fetching entries. Sets come back as futures of their own entries."
+		slots: List[Union[_TuneRef, "Future[Any]"]] = []
+		for entry in entries:
+			if isinstance(entry, str):
+				slots.append(self.submit(self._fetch_set, entry))
+			else:
+				self._want_tune(entry)
+				slots.append(entry)
+		return slots
+
+	def _fetch_set(self, url: str) -> Result[List[_TuneRef], _GrabError]:
+		set_result = load_from_session._get_thesession_json(url)
+		if isinstance(set_result, Err):
+			return set_result
+		page = _parse_page(CollectionKind.SET, url, set_result.value)
+		if isinstance(page, Err):
+			return page
+		_pages, entries = page.value
+		refs = cast(List[_TuneRef], entries)
+		for ref in refs:
+			self._want_tune(ref)
+		return Ok(refs)
+
+	def _want_tune(self, ref: _TuneRef) -> None:
+		tune_id, setting_id = ref
+		with self._lock:
+			# keyed by setting too, as the local index might have one setting but not another
+			if ref in self._tunes:
+				return
+			future = self._submit_locked(load_from_session._resolve_tune, tune_id, [setting_id])
+			self._tunes[ref] = future
+		future.add_done_callback(self._tune_done)
+		self._report()
+
+	def _tune_done(self, future: "Future[Any]") -> None:
+		with self._lock:
+			self._done += 1
+		self._report()
+
+	def _report(self) -> None:
+		if self._progress is not None:
+			with self._lock:
+				done, total = self._done, len(self._tunes)
+			self._progress(done, total)
+
+	def grab(self, ref: _TuneRef) -> GrabResult:
+		_tune_id, setting_id = ref
+		tune_result = self._tunes[ref].result()
+		if isinstance(tune_result, Err):
+			return tune_result
+		tune = tune_result.value
+		if setting_id is None and len(tune) > 0:
+			# a tunebook is a list of tunes, the first setting is the canonical one
+			setting_id = tune.setting_ids[0]
+		return load_from_session._grab_setting(tune, setting_id)
+
+
+def get_collection_from_thesession(
+	url: str,
+	max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+	progress: Optional[Callable[[int, int], None]] = None,
+) -> Result[List[GrabResult], _GrabError]:
+	"""Takes a tunebook or sets url and returns a result for every tune in it, in order.
+
+	progress is called with (tunes fetched, tunes found so far) from worker threads.
+	If any page can't be fetched, the whole thing fails."""
+
+	parse_result = parse_collection_url(url)
+	if isinstance(parse_result, Err):
+		return parse_result
+	collection = parse_result.value
+
+	with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+		fetcher = _CollectionFetcher(pool, progress)
+		try:
+			return _get_collection(collection, fetcher)
+		finally:
+			# an early return would otherwise wait for every fetch still queued
+			fetcher.cancel()
+
+
+def _get_collection(
+	collection: TuneCollection, fetcher: _CollectionFetcher
+) -> Result[List[GrabResult], _GrabError]:
+	first_url = collection.page_url(1)
+	first_json = load_from_session._get_thesession_json(first_url)
+	if isinstance(first_json, Err):
+		return first_json
+	first_page = _parse_page(collection.kind, first_url, first_json.value)
+	if isinstance(first_page, Err):
+		return first_page
+	pages, first_entries = first_page.value
+
+	# queue up the other pages before any tunes, so they jump the queue
+	page_futures = [
+		(
+			collection.page_url(n),
+			fetcher.submit(load_from_session._get_thesession_json, collection.page_url(n)),
+		)
+		for n in range(2, pages + 1)
+	]
+	slots = fetcher.want(first_entries)
+
+	for page_url, page_future in page_futures:
+		page_json = page_future.result()
+		if isinstance(page_json, Err):
+			return page_json
+		page = _parse_page(collection.kind, page_url, page_json.value)
+		if isinstance(page, Err):
+			return page
+		_pages, entries = page.value
+		slots.extend(fetcher.want(entries))
+
+	refs: List[_TuneRef] = []
+	for slot in slots:
+		if isinstance(slot, Future):
+			set_refs: Result[List[_TuneRef], _GrabError] = slot.result()
+			if isinstance(set_refs, Err):
+				return set_refs
+			refs.extend(set_refs.value)
+		else:
+			refs.append(slot)
+
+	# the same setting can be in several sets, only import it once.
+	return Ok([fetcher.grab(ref) for ref in dict.fromkeys(refs)])
+
+
+def note_fields(tune: GrabbedTune) -> NoteFields:
+	# protect us from ourselves - we need to update this if note schema changes
+	return {
+		"Name": tune.name,
+		"Key": tune.key,
+		"Tune Type": tune.type,
+		"ABC": tune.abc.replace("\n", "<br />\n"),
+		"Link": tune.uri,
+	}
+
+
+class AddedTunes(NamedTuple):
+	added: int
+	duplicates: int
+	errors: List[_GrabError]
+	changes: OpChanges
+
+
+UNDO_NAME = "Import Tunes from TheSession"
+
+
+def add_tunes(
+	col: AnkiCollection, results: Sequence[GrabResult], deck_id: "DeckId"
+) -> AddedTunes:
+	"""Adds a note for every successfully grabbed tune, as a single undo step.
+
+	Tunes that already have a note (going by their Link) are skipped."""
+
+	nt = col_note_type.get_ankitunes_nt(col.models)
+
+	assert col.db is not None
+	link_ord = next(f["ord"] for f in nt["flds"] if f["name"] == "Link")
+	existing_links = {
+		flds.split("\x1f")[link_ord]
+		for flds in col.db.list("select flds from notes where mid = ?", nt["id"])
+	}
+
+	errors: List[_GrabError] = []
+	duplicates = 0
+	notes: List[anki.notes.Note] = []
+	for result in results:
+		if isinstance(result, Err):
+			errors.append(result.err_value)
+			continue
+		tune = result.value
+		if tune.uri in existing_links:
+			duplicates += 1
+			continue
+		existing_links.add(tune.uri)
+
+		note = anki.notes.Note(col=col, model=nt)
+		for field, value in note_fields(tune).items():
+			assert isinstance(value, str)
+			note[field] = value
+		notes.append(note)
+
+	undo_pos = col.add_custom_undo_entry(UNDO_NAME)
+	for note in notes:
+		col.add_note(note, deck_id=deck_id)
+	changes = col.merge_undo_entries(undo_pos)
+
+	return AddedTunes(len(notes), duplicates, errors, changes)
+
+
+@dataclass
+class ImportedCollection:
+	result: Result[AddedTunes, _GrabError]
+	# CollectionOp wants these even when nothing was added
+	changes: OpChanges
+
+
+def import_collection(
+	col: AnkiCollection,
+	url: str,
+	deck_id: "DeckId",
+	progress: Optional[Callable[[int, int], None]] = None,
+) -> ImportedCollection:
+	"Fetches every tune in a tunebook or sets url and adds them to deck_id."
+	fetch_result = get_collection_from_thesession(url, progress=progress)
+	if isinstance(fetch_result, Err):
+		return ImportedCollection(fetch_result, OpChanges())
+	added = add_tunes(col, fetch_result.value, deck_id)
+	return ImportedCollection(Ok(added), added.changes)
@@ -1,3 +1,4 @@
+import os
 import aqt
 import aqt.main
 from typing import *
@@ -7,3 +8,10 @@ def mw() -> aqt.main.AnkiQt:
 	if not aqt.mw:
 		raise Exception("Main Window doesn't exist!")
 	return aqt.mw
+
+
+def user_files_dir() -> str:
+	"Anki keeps the user_files directory of an add-on when it gets updated."
+	path = os.path.join(os.path.dirname(__file__), "user_files")
+	os.makedirs(path, exist_ok=True)
+	return path
@@ -0,0 +1,223 @@
+"""
+Benchmarks for the note type migrations, onboarding and set building, against
+made up collections of 1k, 10k and 100k tunes.
+
+Run with
+	poetry run python -m tests.bench.bench_collection --output bench_collection.json
+
+Each benchmark runs in its own process, on its own copy of the collection, so
+that its peak RSS is its own. Wall times are in milliseconds, RSS in MiB.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict, field
+from typing import *
+
+import anki.collection
+
+from ankitunes import tune_reviewer, welcome_wizard
+from ankitunes.col_note_type import NT_FINGERPRINT_KEY, TNTMigrator, TNTVersion
+from .bench_load_from_session import summarise
+from .synthetic_collection import CollectionSpec, build_collection
+
+REPORT_VERSION = 1
+
+
+@dataclass
+class CollectionBenchConfig:
+	sizes: List[int] = field(default_factory=lambda: [1_000, 10_000, 100_000])
+	# sets built by the set_building benchmark
+	sets: int = 200
+	set_length: int = 3
+	seed: int = 0
+	# run each benchmark in a fresh process, so peak RSS means something
+	isolate: bool = True
+
+
+def peak_rss_mib() -> float:
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# kilobytes on Linux, bytes on macOS
+	return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def bench_migrate(
+	col: anki.collection.Collection, config: CollectionBenchConfig
+) -> Dict[str, Any]:
+	"v1 to v2, which rewrites every note."
+	migrator = TNTMigrator(col.models)
+	version_res = migrator.get_current_version().unwrap()
+	start = time.perf_counter()
+	migrator.migrate(version_res).unwrap()
+	return {"wall_ms": (time.perf_counter() - start) * 1000}
+
+
+def bench_migrate_template(
+	col: anki.collection.Collection, config: CollectionBenchConfig
+) -> Dict[str, Any]:
+	"Rewriting and saving the template, as when it changes in an update."
+	migrator = TNTMigrator(col.models)
+	_, nt = migrator.get_current_version().unwrap()
+	assert nt is not None
+	del nt["other"][NT_FINGERPRINT_KEY]
+	start = time.perf_counter()
+	migrator.migrate_template(nt)
+	return {"wall_ms": (time.perf_counter() - start) * 1000}
+
+
+def bench_setup_no_op(
+	col: anki.collection.Collection, config: CollectionBenchConfig
+) -> Dict[str, Any]:
+	"What every profile open costs, once the note type's up to date."
+	# the first call since the collection was opened, as at profile open
+	start = time.perf_counter()
+	TNTMigrator(col.models).setup_tune_note_type()
+	return {"wall_ms": (time.perf_counter() - start) * 1000}
+
+
+def bench_onboarding(
+	col: anki.collection.Collection, config: CollectionBenchConfig
+) -> Dict[str, Any]:
+	start = time.perf_counter()
+	welcome_wizard.onboard(col)
+	return {"wall_ms": (time.perf_counter() - start) * 1000}
+
+
+def bench_set_building(
+	col: anki.collection.Collection, config: CollectionBenchConfig
+) -> Dict[str, Any]:
+	"Building the set index, then sets for random focus cards."
+	_, nt = TNTMigrator(col.models).get_current_version().unwrap()
+	assert nt is not None
+	tune_reviewer.on_collection_will_change()
+
+	start = time.perf_counter()
+	tune_reviewer.get_set_index(col, nt)
+	index_ms = (time.perf_counter() - start) * 1000
+
+	rng = random.Random(config.seed)
+	card_ids = col.find_cards("")
+	samples = []
+	for _ in range(config.sets):
+		card = col.get_card(rng.choice(card_ids))
+		start = time.perf_counter()
+		tune_reviewer.turn_card_into_set(card, col, config.set_length)
+		samples.append(time.perf_counter() - start)
+	per_set = summarise(samples)
+
+	return {
+		"wall_ms": index_ms + sum(samples) * 1000,
+		"index_ms": index_ms,
+		"per_set": per_set,
+	}
+
+
+Bench = Callable[[anki.collection.Collection, CollectionBenchConfig], Dict[str, Any]]
+
+# name -> (version of collection it needs, benchmark)
+BENCHMARKS: Dict[str, Tuple[TNTVersion, Bench]] = {
+	"migrate_v1_to_v2": (TNTVersion.V1, bench_migrate),
+	"migrate_template": (TNTVersion.V2, bench_migrate_template),
+	"setup_no_op": (TNTVersion.V2, bench_setup_no_op),
+	"onboarding": (TNTVersion.V2, bench_onboarding),
+	"set_building": (TNTVersion.V2, bench_set_building),
+}
+
+
+def run_one(name: str, path: str, config: CollectionBenchConfig) -> Dict[str, Any]:
+	"Runs benchmark name against the collection at path, which it's free to change."
+	_, bench = BENCHMARKS[name]
+	col = anki.collection.Collection(path)
+	try:
+		result = bench(col, config)
+	finally:
+		col.close(downgrade=False)
+	result["peak_rss_mib"] = peak_rss_mib()
+	return result
+
+
+def run_benchmarks(
+	config: CollectionBenchConfig, only: Optional[Collection[str]] = None
+) -> Dict[str, Any]:
+	names = [name for name in BENCHMARKS if only is None or name in only]
+	results: Dict[str, Dict[str, Any]] = {name: {} for name in names}
+
+	with tempfile.TemporaryDirectory() as tmp:
+		for size in config.sizes:
+			# one collection of each version per size, and a fresh copy for every run
+			masters: Dict[TNTVersion, str] = {}
+			for version in {BENCHMARKS[name][0] for name in names}:
+				master = os.path.join(tmp, f"v{int(version)}_{size}.anki2")
+				spec = CollectionSpec(notes=size, version=version, seed=config.seed)
+				build_collection(master, spec).close(downgrade=False)
+				masters[version] = master
+
+			for name in names:
+				path = os.path.join(tmp, f"{name}_{size}.anki2")
+				shutil.copy(masters[BENCHMARKS[name][0]], path)
+				if config.isolate:
+					context = multiprocessing.get_context("spawn")
+					with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+						result = pool.submit(run_one, name, path, config).result()
+				else:
+					result = run_one(name, path, config)
+				results[name][str(size)] = result
+				os.unlink(path)
+
+	return {
+		"version": REPORT_VERSION,
+		"environment": {
+			"python": platform.python_version(),
+			"implementation": platform.python_implementation(),
+			"platform": platform.platform(),
+		},
+		"config": asdict(config),
+		"benchmarks": results,
+	}
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+	defaults = CollectionBenchConfig()
+	parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+	parser.add_argument(
+		"--size", type=int, action="append", help="notes in the collection (repeatable)"
+	)
+	parser.add_argument("--sets", type=int, default=defaults.sets)
+	parser.add_argument("--set-length", type=int, default=defaults.set_length)
+	parser.add_argument("--seed", type=int, default=defaults.seed)
+	parser.add_argument(
+		"--no-isolate", action="store_true", help="run everything in this process"
+	)
+	parser.add_argument("--only", action="append", help="run just this benchmark")
+	parser.add_argument("--output", help="write the JSON report here, not to stdout")
+	args = parser.parse_args(argv)
+
+	config = CollectionBenchConfig(
+		sizes=args.size or defaults.sizes,
+		sets=args.sets,
+		set_length=args.set_length,
+		seed=args.seed,
+		isolate=not args.no_isolate,
+	)
+	report = run_benchmarks(config, args.only)
+
+	if args.output is None:
+		json.dump(report, sys.stdout, indent=2)
+		sys.stdout.write("\n")
+	else:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,307 @@
+"""
+Benchmarks for the load_from_session pipeline, run against a local stand-in
+for TheSession so that numbers don't depend on the real network.
+
+Run with
+	poetry run python -m tests.bench.bench_load_from_session --output bench.json
+
+Every benchmark reports p50/p95/p99 (and friends) in milliseconds, as JSON,
+so that results from different commits can be compared by a script.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import *
+
+from ankitunes import load_from_session
+from ankitunes.http_pool import HTTPPool
+from ankitunes.load_from_session import (
+	TheSessionTune,
+	get_from_thesession,
+	get_from_thesession_many,
+)
+from ankitunes.result import Ok
+from ankitunes.tune_cache import TuneCache
+from ankitunes.tune_index import TuneIndex
+from ..fake_thesession import FakeTheSession, make_tune
+
+REPORT_VERSION = 1
+
+
+@dataclass
+class BenchConfig:
+	# seconds the fake server waits before answering each request
+	latency: float = 0.005
+	settings_per_tune: int = 4
+	# rough size of each setting's abc
+	abc_bytes: int = 500
+	repeat: int = 200
+	warmup: int = 5
+	bulk_size: int = 50
+	bulk_repeat: int = 10
+	max_concurrency: int = load_from_session.DEFAULT_MAX_CONCURRENCY
+
+
+def percentile(sorted_samples: Sequence[float], p: float) -> float:
+	"Linearly interpolated, like numpy's default."
+	if len(sorted_samples) == 0:
+		raise ValueError("no samples")
+	pos = (len(sorted_samples) - 1) * p / 100
+	lo = int(pos)
+	hi = min(lo + 1, len(sorted_samples) - 1)
+	return sorted_samples[lo] + (sorted_samples[hi] - sorted_samples[lo]) * (pos - lo)
+
+
+def summarise(samples: Sequence[float], **extra: Any) -> Dict[str, Any]:
+	"samples are in seconds, the summary is in milliseconds."
+	ms = sorted(s * 1000 for s in samples)
+	return {
+		"unit": "ms",
+		"n": len(ms),
+		"mean": sum(ms) / len(ms),
+		"min": ms[0],
+		"p50": percentile(ms, 50),
+		"p95": percentile(ms, 95),
+		"p99": percentile(ms, 99),
+		"max": ms[-1],
+		**extra,
+	}
+
+
+def measure(fn: Callable[[int], Any], repeat: int, warmup: int) -> List[float]:
+	"Times fn(i) for i in range(repeat), after warmup untimed calls with negative i."
+	for i in range(-warmup, 0):
+		fn(i)
+	samples = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		fn(i)
+		samples.append(time.perf_counter() - start)
+	return samples
+
+
+def check_ok(result: Any) -> None:
+	if not isinstance(result, Ok):
+		raise Exception(f"benchmark request failed: {result.err_value.msg}")
+
+
+@contextmanager
+def pointed_at(server: FakeTheSession) -> Iterator[None]:
+	"Points load_from_session at server, with no cache or index."
+	thesession = load_from_session.THESESSION
+	load_from_session.THESESSION = server.url
+	load_from_session.set_http_pool(HTTPPool())
+	load_from_session.set_tune_cache(None)
+	load_from_session.set_tune_index(None)
+	try:
+		yield
+	finally:
+		load_from_session.THESESSION = thesession
+		load_from_session.set_http_pool(HTTPPool())
+
+
+def tune_url(tune_id: int) -> str:
+	return f"https://thesession.org/tunes/{tune_id}#setting{tune_id * 100 + 1}"
+
+
+def bench_single_fetch(server: FakeTheSession, config: BenchConfig) -> Dict[str, Any]:
+	"One uncached tune at a time: the network round trip, parsing and formatting."
+	# warmup ids are negative, keep them clear of the timed ones
+	offset = config.warmup + 1
+	server.add_tunes(
+		range(1, config.repeat + offset), config.settings_per_tune, config.abc_bytes
+	)
+	samples = measure(
+		lambda i: check_ok(get_from_thesession(tune_url(i + offset))),
+		config.repeat,
+		config.warmup,
+	)
+	return summarise(samples)
+
+
+def bench_bulk_fetch(server: FakeTheSession, config: BenchConfig) -> Dict[str, Any]:
+	"get_from_thesession_many on bulk_size uncached tunes at once."
+	n = config.bulk_size
+	first_id = 100_000
+	rounds = config.bulk_repeat + 1
+	server.add_tunes(
+		range(first_id, first_id + n * rounds), config.settings_per_tune, config.abc_bytes
+	)
+
+	def fetch(i: int) -> None:
+		start = first_id + (i + 1) * n
+		urls = [tune_url(t) for t in range(start, start + n)]
+		for result in get_from_thesession_many(urls, config.max_concurrency):
+			check_ok(result)
+
+	samples = measure(fetch, config.bulk_repeat, 1)
+	summary = summarise(samples, tunes_per_batch=n)
+	summary["tunes_per_second"] = n / (summary["p50"] / 1000)
+	return summary
+
+
+def bench_cache_hit(server: FakeTheSession, config: BenchConfig) -> Dict[str, Any]:
+	"A tune that's fresh in the on disk cache, so never touches the network."
+	server.add_tunes([1], config.settings_per_tune, config.abc_bytes)
+	cache = TuneCache(":memory:")
+	load_from_session.set_tune_cache(cache)
+	try:
+		check_ok(get_from_thesession(tune_url(1)))
+		requests_before = len(server.requests)
+		samples = measure(
+			lambda i: check_ok(get_from_thesession(tune_url(1))),
+			config.repeat,
+			config.warmup,
+		)
+		assert len(server.requests) == requests_before, "cache hits went to the network"
+	finally:
+		load_from_session.set_tune_cache(None)
+		cache.close()
+	return summarise(samples)
+
+
+def bench_index_hit(server: FakeTheSession, config: BenchConfig) -> Dict[str, Any]:
+	"A tune that's in the local TheSession index."
+	tune = make_tune(1, config.settings_per_tune, config.abc_bytes)
+	index = TuneIndex(":memory:")
+	index.import_rows(
+		{
+			"tune_id": tune["id"],
+			"setting_id": setting["id"],
+			"name": tune["name"],
+			"type": tune["type"],
+			"mode": setting["key"],
+			"abc": setting["abc"],
+		}
+		for setting in tune["settings"]
+	)
+	load_from_session.set_tune_index(index)
+	try:
+		samples = measure(
+			lambda i: check_ok(get_from_thesession(tune_url(1))),
+			config.repeat,
+			config.warmup,
+		)
+	finally:
+		load_from_session.set_tune_index(None)
+		index.close()
+	return summarise(samples)
+
+
+def bench_parse(config: BenchConfig) -> Dict[str, Any]:
+	"json.loads plus the assert_str/assert_int validation of a tune response."
+	body = json.dumps(make_tune(1, config.settings_per_tune, config.abc_bytes)).encode()
+	url = tune_url(1)
+	samples = measure(
+		lambda i: check_ok(load_from_session._parse_thesession_tune(url, body)),
+		config.repeat,
+		config.warmup,
+	)
+	return summarise(samples, payload_bytes=len(body))
+
+
+def bench_format_abc(config: BenchConfig) -> Dict[str, Any]:
+	"_process_sessionapi_abc on one setting."
+	tune_json = make_tune(1, config.settings_per_tune, config.abc_bytes)
+	setting = TheSessionTune.Setting(
+		id=tune_json["settings"][0]["id"],
+		key=tune_json["settings"][0]["key"],
+		abc=tune_json["settings"][0]["abc"],
+	)
+	tune = TheSessionTune(
+		id=tune_json["id"], name=tune_json["name"], type=tune_json["type"], settings=[setting]
+	)
+	samples = measure(
+		lambda i: load_from_session._process_sessionapi_abc(tune, setting, 0),
+		config.repeat,
+		config.warmup,
+	)
+	return summarise(samples)
+
+
+def run_benchmarks(
+	config: BenchConfig, only: Optional[Collection[str]] = None
+) -> Dict[str, Any]:
+	server = FakeTheSession(latency=config.latency)
+	server.start()
+
+	network_benches: Dict[str, Callable[[FakeTheSession, BenchConfig], Dict[str, Any]]]
+	network_benches = {
+		"single_fetch": bench_single_fetch,
+		"bulk_fetch": bench_bulk_fetch,
+		"cache_hit": bench_cache_hit,
+		"index_hit": bench_index_hit,
+	}
+	local_benches: Dict[str, Callable[[BenchConfig], Dict[str, Any]]] = {
+		"parse_tune_json": bench_parse,
+		"format_abc": bench_format_abc,
+	}
+
+	results: Dict[str, Any] = {}
+	try:
+		with pointed_at(server):
+			for name, network_bench in network_benches.items():
+				if only is None or name in only:
+					results[name] = network_bench(server, config)
+		for name, local_bench in local_benches.items():
+			if only is None or name in only:
+				results[name] = local_bench(config)
+	finally:
+		server.stop()
+
+	return {
+		"version": REPORT_VERSION,
+		"environment": {
+			"python": platform.python_version(),
+			"implementation": platform.python_implementation(),
+			"platform": platform.platform(),
+		},
+		"config": asdict(config),
+		"benchmarks": results,
+	}
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+	defaults = BenchConfig()
+	parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+	parser.add_argument("--latency", type=float, default=defaults.latency)
+	parser.add_argument(
+		"--settings-per-tune", type=int, default=defaults.settings_per_tune
+	)
+	parser.add_argument("--abc-bytes", type=int, default=defaults.abc_bytes)
+	parser.add_argument("--repeat", type=int, default=defaults.repeat)
+	parser.add_argument("--warmup", type=int, default=defaults.warmup)
+	parser.add_argument("--bulk-size", type=int, default=defaults.bulk_size)
+	parser.add_argument("--bulk-repeat", type=int, default=defaults.bulk_repeat)
+	parser.add_argument("--max-concurrency", type=int, default=defaults.max_concurrency)
+	parser.add_argument("--only", action="append", help="run just this benchmark")
+	parser.add_argument("--output", help="write the JSON report here, not to stdout")
+	args = parser.parse_args(argv)
+
+	config = BenchConfig(
+		latency=args.latency,
+		settings_per_tune=args.settings_per_tune,
+		abc_bytes=args.abc_bytes,
+		repeat=args.repeat,
+		warmup=args.warmup,
+		bulk_size=args.bulk_size,
+		bulk_repeat=args.bulk_repeat,
+		max_concurrency=args.max_concurrency,
+	)
+	report = run_benchmarks(config, args.only)
+
+	if args.output is None:
+		json.dump(report, sys.stdout, indent=2)
+		sys.stdout.write("\n")
+	else:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+	main()
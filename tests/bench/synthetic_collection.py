@@ -0,0 +1,140 @@
+"""
+Builds big, made up AnkiTunes collections for benchmarks, quickly.
+
+Notes and cards are written straight into the database, as adding 100k notes
+one at a time through Anki takes longer than anything worth benchmarking.
+"""
+
+import random
+import time
+from dataclasses import dataclass
+from typing import *
+
+import anki.collection
+from anki.notes import NoteId
+from anki.consts import CARD_TYPE_NEW, CARD_TYPE_REV, QUEUE_TYPE_NEW, QUEUE_TYPE_REV
+
+from ankitunes.col_note_type import TNTMigrator, TNTVersion
+from ankitunes.welcome_wizard import DECK_NAME
+
+TUNE_TYPES = [
+	"reel",
+	"jig",
+	"hornpipe",
+	"polka",
+	"slide",
+	"waltz",
+	"mazurka",
+	"barndance",
+	"strathspey",
+	"march",
+]
+KEYS = ["D", "G", "A", "Em", "Bm", "Ador", "Edor", "Gmix", "Dmix", "C"]
+
+ABC = """X: 1
+T: {name}
+R: {tune_type}
+M: 4/4
+L: 1/8
+K: {key}
+|:D2|EBBA B2 EB|B2 AB dBAG|FDAD BDAD|FDAD dAFD|
+EBBA B2 EB|B2 AB defg|afec dBAF|DEFD E2:|
+"""
+
+# rows written per executemany
+_CHUNK = 5000
+
+
+@dataclass
+class CollectionSpec:
+	notes: int
+	# the AnkiTunes note type version to build
+	version: TNTVersion = TNTVersion.V2
+	# defaults to one deck per 250 notes
+	decks: Optional[int] = None
+	# share of cards that have been reviewed, the rest are new
+	reviewed: float = 0.7
+	seed: int = 0
+
+
+def build_collection(path: str, spec: CollectionSpec) -> anki.collection.Collection:
+	"Creates a collection at path, filled as spec says. The caller closes it."
+	rng = random.Random(spec.seed)
+	col = anki.collection.Collection(path)
+	migrator = TNTMigrator(col.models)
+
+	nt = None
+	for version in sorted(TNTVersion):
+		if version > spec.version:
+			break
+		nt = getattr(migrator, f"migrate_v{version - 1}_to_v{version}")(nt).unwrap()
+		col.models.save(nt)
+	assert nt is not None
+	migrator.migrate_template(nt)
+	nt = col.models.get(nt["id"])
+	assert nt is not None
+	ords = {f["name"]: f["ord"] for f in nt["flds"]}
+
+	n_decks = spec.decks or max(1, spec.notes // 250)
+	deck_ids = [
+		col.decks.id(f"{DECK_NAME}::Session {i + 1}", create=True) for i in range(n_decks)
+	]
+
+	today = col.sched.today
+	now = int(time.time())
+	# ids are millisecond timestamps, keep them in the past and unique
+	first_id = now * 1000 - 2 * spec.notes
+	assert col.db is not None
+
+	for start in range(0, spec.notes, _CHUNK):
+		notes = []
+		cards = []
+		for i in range(start, min(start + _CHUNK, spec.notes)):
+			name = f"Tune {i}"
+			tune_type = rng.choice(TUNE_TYPES)
+			key = rng.choice(KEYS)
+			fields = [""] * len(ords)
+			fields[ords["Name"]] = name
+			if spec.version >= TNTVersion.V2:
+				fields[ords["Key"]] = key
+				fields[ords["Tune Type"]] = tune_type
+			else:
+				fields[ords["Tune Type"]] = f"{key} {tune_type}"
+			fields[ords["ABC"]] = ABC.format(name=name, tune_type=tune_type, key=key)
+			fields[ords["Link"]] = f"https://thesession.org/tunes/{i}#setting{i}"
+
+			nid = cid = first_id + i
+			# sort field and checksum get filled in by after_note_updates
+			notes.append((nid, f"bench{i}", nt["id"], now, -1, "", "\x1f".join(fields)))
+
+			if rng.random() < spec.reviewed:
+				ivl = rng.randint(1, 60)
+				card = (
+					CARD_TYPE_REV,
+					QUEUE_TYPE_REV,
+					today + rng.randint(-30, ivl),
+					ivl,
+					rng.randint(1300, 2800),
+					rng.randint(1, 20),
+				)
+			else:
+				card = (CARD_TYPE_NEW, QUEUE_TYPE_NEW, i, 0, 0, 0)
+			cards.append((cid, nid, rng.choice(deck_ids), now, -1, *card))
+
+		col.db.executemany(
+			"insert into notes (id, guid, mid, mod, usn, tags, flds, sfld, csum, flags, data) "
+			"values (?, ?, ?, ?, ?, ?, ?, '', 0, 0, '')",
+			notes,
+		)
+		col.db.executemany(
+			"insert into cards (id, nid, did, ord, mod, usn, type, queue, due, ivl, factor, "
+			"reps, lapses, left, odue, odid, flags, data) "
+			"values (?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, 0, 0, 0, 0, 0, '')",
+			cards,
+		)
+		col.after_note_updates(
+			[NoteId(note[0]) for note in notes], mark_modified=False, generate_cards=False
+		)
+		col.save()
+
+	return col
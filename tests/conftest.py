@@ -9,6 +9,11 @@ import pytest
 from typing import *
 
 import anki.collection
+import anki.notes
+
+if TYPE_CHECKING:
+	from anki.models import NoteType
+	from .fake_thesession import FakeTheSession
 
 os.environ["ANKITUNES_TESTING"] = "1"  # warnings are now exceptions
 
@@ -47,6 +52,54 @@ def empty_collection() -> Generator[anki.collection.Collection, None, None]:
 	os.unlink(col.path)
 
 
+@pytest.fixture
+def nt(empty_collection: anki.collection.Collection) -> "NoteType":
+	"The AnkiTunes note type, set up in empty_collection."
+	import ankitunes.col_note_type as NT
+
+	return NT.migrate(empty_collection)
+
+
+def add_tune(
+	col: anki.collection.Collection,
+	nt: "NoteType",
+	name: str,
+	tune_type: str = "reel",
+	deck: Optional[str] = None,
+	key: str = "",
+	abc: str = "",
+) -> anki.notes.Note:
+	"Adds a tune to deck (by name, made if need be), or to the current deck."
+	note = anki.notes.Note(col=col, model=nt)
+	note["Name"] = name
+	note["Tune Type"] = tune_type
+	note["Key"] = key
+	note["ABC"] = abc
+	deck_id = col.decks.get_current_id() if deck is None else col.decks.id(deck)
+	assert deck_id is not None
+	col.add_note(note, deck_id=deck_id)
+	return note
+
+
+@pytest.fixture
+def fake_thesession(
+	monkeypatch: pytest.MonkeyPatch,
+) -> Generator["FakeTheSession", None, None]:
+	"Points ankitunes at a local stand-in for TheSession."
+	from ankitunes import load_from_session
+	from ankitunes.http_pool import HTTPPool
+	from .fake_thesession import FakeTheSession
+
+	server = FakeTheSession()
+	server.start()
+	monkeypatch.setattr(load_from_session, "THESESSION", server.url)
+	# a fresh pool, so no connections leak between tests
+	load_from_session.set_http_pool(HTTPPool())
+	yield server
+	load_from_session.set_http_pool(HTTPPool())
+	server.stop()
+
+
 import _pytest.config.argparsing
 
 
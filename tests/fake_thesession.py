@@ -0,0 +1,185 @@
+"""
+A stand-in for TheSession's JSON API, serving made up tunes from memory,
+so that tests can fetch over real HTTP without touching the network.
+"""
+
+import json
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+
+TUNE_TYPES = ["reel", "jig", "hornpipe", "polka", "slip jig"]
+
+TUNE_PATH = re.compile(r"/tunes/(\d+)")
+MEMBER_PATH = re.compile(r"/members/(\d+)/(tunebook|sets)(?:/(\d+))?")
+
+
+def make_tune(tune_id: int, n_settings: int = 2, abc_bytes: int = 0) -> Dict[str, Any]:
+	"abc_bytes pads each setting's abc out to roughly that size, for bigger payloads."
+	abc = f"|:ABcd efga|{tune_id}:|"
+	if len(abc) < abc_bytes:
+		abc += "!" + "|ABcd efga" * ((abc_bytes - len(abc)) // 10)
+	return {
+		"id": tune_id,
+		"name": f"Tune {tune_id}",
+		"url": f"https://thesession.org/tunes/{tune_id}",
+		"type": TUNE_TYPES[tune_id % len(TUNE_TYPES)],
+		"settings": [
+			{
+				"id": tune_id * 100 + i,
+				"url": f"https://thesession.org/tunes/{tune_id}#setting{tune_id * 100 + i}",
+				"key": "Dmajor",
+				"abc": abc,
+			}
+			for i in range(n_settings)
+		],
+	}
+
+
+class FakeSet(NamedTuple):
+	id: int
+	# (tune id, setting id)
+	settings: List[Tuple[int, int]]
+
+
+class FakeMember(NamedTuple):
+	tunebook: List[int]
+	sets: List[FakeSet]
+
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	# headers and body go out in separate writes, Nagle would hold the body back ~40ms
+	disable_nagle_algorithm = True
+	server: "FakeTheSession"
+
+	def do_GET(self) -> None:
+		parsed = urllib.parse.urlsplit(self.path)
+		query = dict(urllib.parse.parse_qsl(parsed.query))
+		self.server.log_request_path(parsed.path)
+
+		if self.server.latency > 0:
+			time.sleep(self.server.latency)
+
+		body = self.server.respond(parsed.path, query)
+		if body is None:
+			self.send_response(404)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+
+		data = json.dumps(body).encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, format: str, *args: Any) -> None:
+		pass
+
+
+class FakeTheSession(ThreadingHTTPServer):
+	daemon_threads = True
+
+	tunes: Dict[int, Dict[str, Any]]
+	members: Dict[int, FakeMember]
+	# seconds to wait before answering each request
+	latency: float
+	# whether sets listings include each set's settings, or just a link to the set
+	sets_include_settings: bool
+	requests: List[str]
+
+	_lock: threading.Lock
+	_thread: threading.Thread
+
+	def __init__(self, latency: float = 0.0) -> None:
+		super().__init__(("127.0.0.1", 0), Handler)
+		self.tunes = {}
+		self.members = {}
+		self.latency = latency
+		self.sets_include_settings = True
+		self.requests = []
+		self._lock = threading.Lock()
+
+	@property
+	def url(self) -> str:
+		host, port = self.server_address[:2]
+		return f"http://{host!s}:{port}"
+
+	def start(self) -> None:
+		self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self._thread.start()
+
+	def stop(self) -> None:
+		self.shutdown()
+		self.server_close()
+
+	def add_tunes(
+		self, tune_ids: Iterable[int], n_settings: int = 2, abc_bytes: int = 0
+	) -> None:
+		for tune_id in tune_ids:
+			self.tunes[tune_id] = make_tune(tune_id, n_settings, abc_bytes)
+
+	def log_request_path(self, path: str) -> None:
+		with self._lock:
+			self.requests.append(path)
+
+	def respond(self, path: str, query: Mapping[str, str]) -> Optional[Any]:
+		match = TUNE_PATH.fullmatch(path)
+		if match is not None:
+			return self.tunes.get(int(match[1]))
+
+		match = MEMBER_PATH.fullmatch(path)
+		if match is None:
+			return None
+		member_id = int(match[1])
+		member = self.members.get(member_id)
+		if member is None:
+			return None
+
+		if match[3] is not None:
+			for fake_set in member.sets:
+				if fake_set.id == int(match[3]):
+					return self._set_json(member_id, fake_set, True)
+			return None
+
+		perpage = int(query.get("perpage", 10))
+		page = int(query.get("page", 1))
+		items: List[Any]
+		if match[2] == "tunebook":
+			items = [self.tunes[t] for t in member.tunebook]
+			key = "tunes"
+		else:
+			items = [
+				self._set_json(member_id, s, self.sets_include_settings) for s in member.sets
+			]
+			key = "sets"
+
+		pages = max(1, (len(items) + perpage - 1) // perpage)
+		return {
+			"pages": pages,
+			"page": page,
+			"total": len(items),
+			key: items[(page - 1) * perpage : page * perpage],
+		}
+
+	def _set_json(self, member_id: int, fake_set: FakeSet, with_settings: bool) -> Any:
+		set_json: Dict[str, Any] = {
+			"id": fake_set.id,
+			"name": f"Set {fake_set.id}",
+			"url": f"https://thesession.org/members/{member_id}/sets/{fake_set.id}",
+		}
+		if with_settings:
+			set_json["settings"] = [
+				{
+					"id": setting_id,
+					"url": f"https://thesession.org/tunes/{tune_id}#setting{setting_id}",
+					"name": f"Tune {tune_id}",
+				}
+				for tune_id, setting_id in fake_set.settings
+			]
+		return set_json
@@ -13,6 +13,7 @@ from ankitunes.col_note_type import (
 	NoteFields,
 )
 from ankitunes.result import Result, Ok
+from ankitunes import col_note_type
 import functools
 import pytest
 
@@ -188,3 +189,78 @@ def test_migration_data_integrity(v1_collection_with_notes: ColFixture) -> None:
 
 	for card in cards:
 		assert card.ord == nt["tmpls"][0]["ord"]
+
+
+def test_migration_v1_to_v2_in_chunks(
+	empty_collection: ACollection, monkeypatch: pytest.MonkeyPatch
+) -> None:
+	notes: List[NoteFields_v1] = [
+		{**cooleys_v1, "Name": f"Cooleys {i}"} for i in range(5)  # type: ignore
+	]
+	col, v1nt, migrator = migrate_empty_to_v1(empty_collection, notes)
+	monkeypatch.setattr(col_note_type, "MIGRATION_CHUNK_SIZE", 2)
+	progress: List[Tuple[int, int]] = []
+	migrator.progress = lambda done, total: progress.append((done, total))
+
+	v2nt = migrator.migrate_v1_to_v2(v1nt).unwrap()
+
+	assert progress == [(2, 5), (4, 5), (5, 5)]
+	for nid in col.models.nids(v2nt["id"]):
+		note = col.get_note(nid)
+		assert (note["Key"], note["Tune Type"]) == ("em", "reel")
+	# searches see the new fields too
+	assert len(col.find_notes("Key:em")) == 5
+	assert len(col.find_notes("Cooleys*")) == 5
+
+
+def test_interrupted_migration_resumes(
+	empty_collection: ACollection, monkeypatch: pytest.MonkeyPatch
+) -> None:
+	notes: List[NoteFields_v1] = [
+		{**cooleys_v1, "Name": f"Cooleys {i}"} for i in range(5)  # type: ignore
+	]
+	col, v1nt, migrator = migrate_empty_to_v1(empty_collection, notes)
+	monkeypatch.setattr(col_note_type, "MIGRATION_CHUNK_SIZE", 2)
+
+	class Closed(Exception):
+		pass
+
+	def close_anki(done: int, total: int) -> None:
+		raise Closed()
+
+	# "Anki is closed" once the first chunk is committed
+	migrator.progress = close_anki
+	with pytest.raises(Closed):
+		migrator.migrate_v1_to_v2(v1nt)
+
+	col.close(save=False)
+	col = ACollection(col.path)
+	nt = col.models.get(v1nt["id"])
+	assert nt is not None
+	assert nt["other"][col_note_type.NT_CHECKPOINT_KEY]["version"] == 2
+	assert not TNTMigrator.is_up_to_date(nt)
+	assert len(col.find_notes("Key:em")) == 2
+
+	progress: List[Tuple[int, int]] = []
+	TNTMigrator(
+		col.models, lambda done, total: progress.append((done, total))
+	).setup_tune_note_type()
+
+	# only the notes that were left
+	assert progress == [(4, 5), (5, 5)]
+	nt = col.models.get(v1nt["id"])
+	assert nt is not None
+	assert col_note_type.NT_CHECKPOINT_KEY not in nt["other"]
+	assert TNTMigrator.is_up_to_date(nt)
+	for nid in col.models.nids(nt["id"]):
+		note = col.get_note(nid)
+		assert (note["Key"], note["Tune Type"]) == ("em", "reel")
+	col.close()
+
+
+def test_note_rewrite_is_idempotent() -> None:
+	ords = {"Name": 0, "Key": 1, "Tune Type": 2}
+	fields = col_note_type._split_v1_tune_type(["Cooleys", "", "em reel"], ords)
+	assert fields == ["Cooleys", "em", "reel"]
+	assert col_note_type._split_v1_tune_type(fields, ords) is None
+	assert col_note_type._split_v1_tune_type(["Keyless", "", "reel"], ords) is None
@@ -0,0 +1,57 @@
+from typing import *
+
+from ankitunes.col_note_type import TNTMigrator, TNTVersion
+from ..bench.bench_collection import BENCHMARKS, CollectionBenchConfig
+from ..bench.bench_collection import run_benchmarks as run_collection_benchmarks
+from ..bench.bench_load_from_session import BenchConfig, percentile, run_benchmarks
+from ..bench.synthetic_collection import CollectionSpec, build_collection
+
+
+def test_percentile() -> None:
+	samples = [1.0, 2.0, 3.0, 4.0, 5.0]
+	assert percentile(samples, 50) == 3.0
+	assert percentile(samples, 0) == 1.0
+	assert percentile(samples, 100) == 5.0
+	assert percentile(samples, 95) == 4.8
+
+
+def test_benchmarks_run() -> None:
+	"Keeps the benchmarks from rotting, the numbers themselves don't matter here."
+	config = BenchConfig(latency=0, repeat=3, warmup=1, bulk_size=3, bulk_repeat=1)
+	report = run_benchmarks(config)
+
+	assert set(report["benchmarks"]) == {
+		"single_fetch",
+		"bulk_fetch",
+		"cache_hit",
+		"index_hit",
+		"parse_tune_json",
+		"format_abc",
+	}
+	for summary in report["benchmarks"].values():
+		assert summary["n"] > 0
+		assert summary["p50"] <= summary["p95"] <= summary["p99"]
+
+
+def test_synthetic_collection(tmp_path: Any) -> None:
+	for version in (TNTVersion.V1, TNTVersion.V2):
+		path = str(tmp_path / f"v{int(version)}.anki2")
+		col = build_collection(path, CollectionSpec(notes=20, version=version))
+		try:
+			migrator = TNTMigrator(col.models)
+			current, nt = migrator.get_current_version().unwrap()
+			assert current == version
+			assert nt is not None
+			assert len(col.find_cards(f"mid:{nt['id']}")) == 20
+		finally:
+			col.close(downgrade=False)
+
+
+def test_collection_benchmarks_run() -> None:
+	config = CollectionBenchConfig(sizes=[50], sets=3, isolate=False)
+	report = run_collection_benchmarks(config)
+
+	assert set(report["benchmarks"]) == set(BENCHMARKS)
+	for by_size in report["benchmarks"].values():
+		assert by_size["50"]["wall_ms"] >= 0
+		assert by_size["50"]["peak_rss_mib"] > 0
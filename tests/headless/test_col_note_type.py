@@ -6,13 +6,16 @@ import anki.models
 import anki.collection
 
 from anki.models import NoteType, ModelManager
-from anki.collection import Collection as AnkiCollection
+from anki.collection import OpChanges, Collection as AnkiCollection
 
 import pytest
 
 import contextlib
+import unittest.mock
 
 import ankitunes.col_note_type as NT
+from ankitunes import timing
+from ankitunes.timing import Timings
 from ankitunes.result import Result, Ok, Err
 
 
@@ -133,3 +136,98 @@ def test_is_ankitunes_version(mn: ModelManager) -> None:
 	nt2 = mn.new("isn't ankitunes")
 
 	assert NT.is_ankitunes_nt(nt2) is False
+
+
+def test_is_ankitunes_nt_is_memoized(mn: ModelManager) -> None:
+	nt = NT.TNTMigrator(mn).setup_tune_note_type()
+	assert NT.is_ankitunes_nt(nt) is True
+
+	with unittest.mock.patch.object(NT.TNTMigrator, "_get_version") as get_version:
+		assert NT.is_ankitunes_nt(nt) is True
+		saved = mn.get(nt["id"])
+		assert saved is not None and NT.is_ankitunes_nt(saved) is True
+	assert get_version.call_count == 0
+
+	# changed within the same second, so only the op hook can tell
+	nt["other"][NT.NT_VER_KEY] = 1
+	mn.save(nt)
+	NT._on_operation_did_execute(OpChanges(notetype=True), None)
+	assert NT.is_ankitunes_nt(nt) is False
+
+
+def test_setup_is_a_no_op_when_up_to_date(
+	mn: ModelManager, monkeypatch: pytest.MonkeyPatch
+) -> None:
+	nt = NT.TNTMigrator(mn).setup_tune_note_type()
+	assert NT.TNTMigrator.is_up_to_date(nt)
+	mod = nt["mod"]
+
+	timings = Timings(enabled=True)
+	monkeypatch.setattr(timing, "timings", timings)
+	with unittest.mock.patch.object(mn, "save") as save:
+		assert NT.TNTMigrator(mn).setup_tune_note_type() == nt
+	assert save.call_count == 0
+	assert mn.get(nt["id"])["mod"] == mod  # type: ignore
+	assert timings.summary()["setup_tune_note_type"]["calls"] == 1
+
+	# a hand edited template gets put back
+	nt["tmpls"][0]["qfmt"] += "<p>mine</p>"
+	mn.save(nt)
+	assert not NT.TNTMigrator.is_up_to_date(nt)
+	nt = NT.TNTMigrator(mn).setup_tune_note_type()
+	assert "mine" not in nt["tmpls"][0]["qfmt"]
+	assert NT.TNTMigrator.is_up_to_date(nt)
+
+
+def test_remembers_note_type_id(mn: ModelManager) -> None:
+	col = mn.col
+	nt = NT.TNTMigrator(mn).setup_tune_note_type()
+	assert col.get_config(NT.NT_ID_CONFIG_KEY) == nt["id"]
+
+	with unittest.mock.patch.object(mn, "all") as all_note_types:
+		assert NT.TNTMigrator(mn).get_current_version() == Ok((NT.TNTVersion.V2, nt))
+	assert all_note_types.call_count == 0
+
+	# stale ids fall back to looking through them all
+	col.set_config(NT.NT_ID_CONFIG_KEY, 12345)
+	assert NT.TNTMigrator(mn).get_current_version() == Ok((NT.TNTVersion.V2, nt))
+	assert col.get_config(NT.NT_ID_CONFIG_KEY) == nt["id"]
+
+
+def test_clone_is_noticed(mn: ModelManager) -> None:
+	nt = NT.TNTMigrator(mn).setup_tune_note_type()
+	assert NT.TNTMigrator(mn).get_current_version() == Ok((NT.TNTVersion.V2, nt))
+
+	mn.copy(nt)
+	with pytest.raises(Exception, match="multiple note types"):
+		NT.TNTMigrator(mn).get_current_version()
+
+
+def test_reopening_doesnt_look_through_note_types(
+	empty_collection: AnkiCollection,
+) -> None:
+	NT.migrate(empty_collection)
+	path = empty_collection.path
+	empty_collection.close(downgrade=False)
+
+	col = AnkiCollection(path)
+	try:
+		with unittest.mock.patch.object(
+			col.models, "all", wraps=col.models.all
+		) as all_note_types:
+			NT.migrate(col)
+		assert all_note_types.call_count == 0
+
+		# a note type added from elsewhere means looking again
+		basic = col.models.by_name("Basic")
+		assert basic is not None
+		col.models.copy(basic)
+		with unittest.mock.patch.object(
+			col.models, "all", wraps=col.models.all
+		) as all_note_types:
+			NT.migrate(col)
+		assert all_note_types.call_count == 1
+	finally:
+		# the fixture closes the collection at this path again
+		col.close(downgrade=False)
+		empty_collection.reopen()
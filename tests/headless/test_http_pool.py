@@ -0,0 +1,188 @@
+from typing import *
+import gzip
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from ankitunes.http_pool import HTTPPool, ResponseTooLarge, TooManyRedirects
+
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	server: "Server"
+
+	def setup(self) -> None:
+		super().setup()
+		self.server.connections += 1
+
+	def do_GET(self) -> None:
+		self.server.requests.append(f"GET {self.path}")
+		if self.path in ("/moved", "/loop"):
+			self.send_response(301 if self.path == "/moved" else 302)
+			self.send_header("Location", "/tunes/1" if self.path == "/moved" else "/loop")
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+
+		if self.path == "/slow":
+			time.sleep(0.5)
+
+		body = f"hello {self.path}".encode("utf-8")
+		if self.path.startswith("/big"):
+			body = b"x" * 2000
+		gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+		if gzipped:
+			body = gzip.compress(body)
+
+		self.send_response(200 if self.path != "/missing" else 404)
+		if self.path == "/big-unknown-length":
+			self.send_header("Connection", "close")
+			self.close_connection = True
+		else:
+			self.send_header("Content-Length", str(len(body)))
+		if gzipped:
+			self.send_header("Content-Encoding", "gzip")
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_CONNECT(self) -> None:
+		self.server.requests.append(f"CONNECT {self.path}")
+		self.send_response(403)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def log_message(self, format: str, *args: Any) -> None:
+		pass
+
+
+class Server(ThreadingHTTPServer):
+	connections: int = 0
+	requests: List[str]
+	daemon_threads = True
+
+	def server_activate(self) -> None:
+		super().server_activate()
+		self.requests = []
+
+
+@pytest.fixture
+def server() -> Generator[Server, None, None]:
+	server = Server(("127.0.0.1", 0), Handler)
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+def url(server: Server, path: str) -> str:
+	host, port = server.server_address[:2]
+	return f"http://{host!s}:{port}{path}"
+
+
+def test_keep_alive(server: Server) -> None:
+	pool = HTTPPool()
+	for i in range(5):
+		response = pool.get(url(server, f"/tunes/{i}"))
+		assert response.status == 200
+		assert response.body == f"hello /tunes/{i}".encode("utf-8")
+	pool.close()
+
+	assert server.connections == 1
+
+
+def test_gzip(server: Server) -> None:
+	pool = HTTPPool()
+	response = pool.get(url(server, "/gz"))
+	pool.close()
+
+	assert response.headers["Content-Encoding"] == "gzip"
+	assert response.body == b"hello /gz"
+
+
+def test_error_status(server: Server) -> None:
+	pool = HTTPPool()
+	response = pool.get(url(server, "/missing"))
+	pool.close()
+
+	assert response.status == 404
+
+
+def test_read_timeout(server: Server) -> None:
+	pool = HTTPPool(read_timeout=0.1)
+	with pytest.raises(socket.timeout):
+		pool.get(url(server, "/slow"))
+	pool.close()
+
+
+def test_reconnects_after_server_closes(server: Server) -> None:
+	pool = HTTPPool()
+	pool.get(url(server, "/1"))
+
+	# pretend the server timed out our idle connection
+	for conns in pool._idle.values():
+		for conn in conns:
+			assert conn.sock is not None
+			conn.sock.shutdown(socket.SHUT_RDWR)
+
+	response = pool.get(url(server, "/2"))
+	pool.close()
+	assert response.body == b"hello /2"
+
+
+@pytest.mark.parametrize("path", ["/big", "/big-unknown-length"])
+def test_too_large(server: Server, path: str) -> None:
+	pool = HTTPPool(max_body_bytes=1000)
+	with pytest.raises(ResponseTooLarge):
+		pool.get(url(server, path), {"Accept-Encoding": "identity"})
+	pool.close()
+
+
+def test_gzip_too_large(server: Server) -> None:
+	pool = HTTPPool(max_body_bytes=1000)
+	# tiny on the wire, but too big once decompressed
+	with pytest.raises(ResponseTooLarge):
+		pool.get(url(server, "/big"))
+	pool.close()
+
+
+def test_follows_redirects(server: Server) -> None:
+	pool = HTTPPool()
+	response = pool.get(url(server, "/moved"))
+	assert response.status == 200
+	assert response.body == b"hello /tunes/1"
+
+	with pytest.raises(TooManyRedirects):
+		pool.get(url(server, "/loop"))
+	pool.close()
+
+
+def test_http_proxy(server: Server) -> None:
+	pool = HTTPPool(proxies={"http": url(server, "")})
+	response = pool.get("http://thesession.invalid/tunes/1?format=json")
+	pool.close()
+
+	assert response.body == b"hello http://thesession.invalid/tunes/1?format=json"
+
+
+def test_https_proxy_tunnels(server: Server) -> None:
+	host, port = server.server_address[:2]
+	pool = HTTPPool(proxies={"https": f"{host!s}:{port}"})
+	# the fake proxy won't open the tunnel, but it should have been asked to
+	with pytest.raises(OSError):
+		pool.get("https://thesession.invalid/tunes/1")
+	pool.close()
+
+	assert server.requests == ["CONNECT thesession.invalid:443"]
+
+
+def test_no_proxy(server: Server) -> None:
+	host, _ = server.server_address[:2]
+	pool = HTTPPool(proxies={"http": "http://proxy.invalid:3128", "no": str(host)})
+	response = pool.get(url(server, "/direct"))
+	pool.close()
+
+	assert response.body == b"hello /direct"
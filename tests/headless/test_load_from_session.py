@@ -1,33 +1,43 @@
 import ankitunes
-from ankitunes.load_from_session import get_from_thesession, GrabError, GrabbedTune
+from ankitunes import load_from_session
+from ankitunes.load_from_session import (
+	TheSessionTune,
+	get_from_thesession,
+	get_from_thesession_many,
+	GrabError,
+	GrabbedTune,
+)
 from typing import *
 import unittest.mock
-import urllib.request
+from http.client import HTTPMessage
+from ankitunes.http_pool import HTTPPool, HTTPResponse
 from ankitunes.result import Result, Ok, Err
 from contextlib import contextmanager
 from textwrap import dedent
 
 
+def ok_response(body: str) -> HTTPResponse:
+	return HTTPResponse(200, HTTPMessage(), body.encode("utf-8"))
+
+
 @contextmanager
-def mock_urlopen(
+def mock_http(
 	body: Optional[str] = None, raises: Optional[Exception] = None
-) -> Generator[None, None, None]:
+) -> Generator[unittest.mock.Mock, None, None]:
 	if not ((body is None) ^ (raises is None)):
 		raise TypeError("Exactly one of body or raises must be None")
-	unittest.mock.Mock(spec_set=urllib.request)
 	if body is not None:
-		urlopen_mock = unittest.mock.Mock(spec_set=urllib.request.urlopen)
-		urlopen_mock = unittest.mock.mock_open(urlopen_mock, read_data=body.encode("utf-8"))
+		get_mock = unittest.mock.Mock(spec_set=HTTPPool.get, return_value=ok_response(body))
 	elif raises is not None:
-		urlopen_mock = unittest.mock.Mock(spec_set=urllib.request.urlopen, side_effect=raises)
+		get_mock = unittest.mock.Mock(spec_set=HTTPPool.get, side_effect=raises)
 	else:
 		raise Exception("Impossible!")
-	with unittest.mock.patch("urllib.request.urlopen", urlopen_mock):
-		yield
+	with unittest.mock.patch.object(HTTPPool, "get", get_mock):
+		yield get_mock
 
 
 def test_successful_load() -> None:
-	with mock_urlopen(
+	with mock_http(
 		'{"id": 1, "name":"Some Tune", "type": "reel", "settings": [{"id": 2, "abc": "abc", "key": "Cmajor"}]}'
 	):
 		result = get_from_thesession("https://thesession.org/tunes/1")
@@ -37,7 +47,7 @@ def test_successful_load() -> None:
 
 
 def test_successful_load_setting() -> None:
-	with mock_urlopen(
+	with mock_http(
 		'{"id": 1, "name":"Some Tune", "type": "reel", "settings": [{"id": 2, "abc": "abc", "key": "Cmajor"}]}'
 	):
 		result = get_from_thesession("https://thesession.org/tunes/1#setting2")
@@ -47,7 +57,7 @@ def test_successful_load_setting() -> None:
 
 
 def test_successful_load_abc_transform() -> None:
-	with mock_urlopen(
+	with mock_http(
 		'{"id": 1, "name":"Some Tune", "type": "reel", "settings": [{"id": 10, "abc": "notthisone", "key": "Cmajor"}, {"id": 11, "abc": "abc!abc", "key": "Cmajor"}]}'
 	):
 		result = get_from_thesession("https://thesession.org/tunes/1#setting11")
@@ -68,7 +78,7 @@ def test_successful_load_abc_transform() -> None:
 
 
 def test_bad_uri() -> None:
-	with mock_urlopen(
+	with mock_http(
 		'{"id": 1, "name":"Some Tune", "type": "reel", "settings": [{"id": 2, "abc": "abc", "key": "Cmajor"}]}'
 	):
 		result = get_from_thesession("https:\\thesession.org/tunes/1")
@@ -78,7 +88,7 @@ def test_bad_uri() -> None:
 
 
 def test_bad_domain() -> None:
-	with mock_urlopen(
+	with mock_http(
 		'{"id": 1, "name":"Some Tune", "type": "reel", "settings": [{"id", 2, "abc": "abc", "key": "Cmajor"}]}'
 	):
 		result = get_from_thesession("https://thesession.borg/tunes/1")
@@ -88,7 +98,7 @@ def test_bad_domain() -> None:
 
 
 def test_bad_path() -> None:
-	with mock_urlopen(
+	with mock_http(
 		'{"id": 1, "name":"Some Tune", "type": "reel", "settings": [{"id": 2, "abc": "abc", "key": "Cmajor"}]}'
 	):
 		result = get_from_thesession("https://thesession.org/tunes/abc")
@@ -98,7 +108,7 @@ def test_bad_path() -> None:
 
 
 def test_bad_setting() -> None:
-	with mock_urlopen(
+	with mock_http(
 		'{"id": 0, "name":"Some Tune", "type": "reel", "settings": [{"id": 2, "abc": "abc", "key": "Cmajor"}]}'
 	):
 		result = get_from_thesession("https://thesession.org/tunes/1#set")
@@ -109,7 +119,7 @@ def test_bad_setting() -> None:
 
 def test_timeout() -> None:
 	e = Exception("bang")
-	with mock_urlopen(raises=e):
+	with mock_http(raises=e):
 		result = get_from_thesession("https://thesession.org/tunes/1#setting1")
 	assert isinstance(result, Err)
 	val = result.err_value
@@ -117,15 +127,26 @@ def test_timeout() -> None:
 
 
 def test_bad_json() -> None:
-	with mock_urlopen("{"):
+	with mock_http("{"):
+		result = get_from_thesession("https://thesession.org/tunes/1#setting1")
+	assert isinstance(result, Err)
+	val = result.err_value
+	assert val == GrabError.JSONError("https://thesession.org/tunes/1?format=json", b"{", 1)
+
+
+def test_bad_json_is_truncated() -> None:
+	with mock_http("<html>" + "x" * 1_000_000):
 		result = get_from_thesession("https://thesession.org/tunes/1#setting1")
 	assert isinstance(result, Err)
 	val = result.err_value
-	assert val == GrabError.JSONError("https://thesession.org/tunes/1?format=json", b"{")
+	assert isinstance(val, GrabError.JSONError)
+	assert len(val.body) == load_from_session.MAX_ERROR_BODY_BYTES
+	assert "of 1000006 bytes" in val.msg
+	assert len(val.msg) < 10_000
 
 
 def test_api_bad() -> None:
-	with mock_urlopen("{}"):
+	with mock_http("{}"):
 		result = get_from_thesession("https://thesession.org/tunes/1#setting1")
 	assert isinstance(result, Err)
 	val = result.err_value
@@ -133,7 +154,7 @@ def test_api_bad() -> None:
 
 
 def test_no_setting() -> None:
-	with mock_urlopen(
+	with mock_http(
 		'{"id": 1, "name":"Some Tune", "type": "reel", "settings": [{"id": 2, "abc": "abc", "key": "Cmajor"}]}'
 	):
 		result = get_from_thesession("https://thesession.org/tunes/1#setting333")
@@ -142,6 +163,115 @@ def test_no_setting() -> None:
 	assert isinstance(val, GrabError.NoSuchSetting)
 
 
+def test_settings_are_only_checked_when_used() -> None:
+	# the second setting is broken, but we never look at it
+	with mock_http(
+		'{"id": 1, "name":"Some Tune", "type": "reel", "settings": [{"id": 2, "abc": "abc", "key": "Cmajor"}, {"id": 3, "abc": 5}]}'
+	):
+		good = get_from_thesession("https://thesession.org/tunes/1#setting2")
+		bad = get_from_thesession("https://thesession.org/tunes/1#setting3")
+	assert isinstance(good, Ok)
+	assert isinstance(bad, Err)
+	assert isinstance(bad.err_value, GrabError.APISpecError)
+
+
+def test_tune_settings_by_id() -> None:
+	tune = load_from_session._parse_thesession_tune(
+		"https://thesession.org/tunes/1?format=json", tune_json(1, [5, 3, 9]).encode()
+	).unwrap()
+	assert tune.setting_ids == [5, 3, 9]
+	assert tune.position(9) == 2
+	assert tune.position(4) is None
+	assert tune.setting_at(1) == TheSessionTune.Setting(3, "Cmajor", "abc")
+
+
+def tune_json(tune_id: int, setting_ids: Sequence[int]) -> str:
+	settings = ", ".join(
+		f'{{"id": {s}, "abc": "abc", "key": "Cmajor"}}' for s in setting_ids
+	)
+	return f'{{"id": {tune_id}, "name":"Tune {tune_id}", "type": "reel", "settings": [{settings}]}}'
+
+
+@contextmanager
+def mock_http_many(
+	bodies: Dict[str, str], on_get: Optional[Callable[[], None]] = None
+) -> Generator[unittest.mock.Mock, None, None]:
+	"bodies maps urls to response bodies. Unknown urls 404."
+
+	def get(url: str, headers: Optional[Mapping[str, str]] = None) -> HTTPResponse:
+		if on_get is not None:
+			on_get()
+		if url not in bodies:
+			return HTTPResponse(404, HTTPMessage(), b"Not Found")
+		return ok_response(bodies[url])
+
+	get_mock = unittest.mock.Mock(side_effect=get)
+	with unittest.mock.patch.object(HTTPPool, "get", get_mock):
+		yield get_mock
+
+
+def test_many() -> None:
+	bodies = {
+		"https://thesession.org/tunes/1?format=json": tune_json(1, [10, 11]),
+		"https://thesession.org/tunes/2?format=json": tune_json(2, [20]),
+	}
+	urls = [
+		"https://thesession.org/tunes/2#setting20",
+		"https://thesession.org/tunes/1#setting11",
+		"https://thesession.org/tunes/abc",
+		"https://thesession.org/tunes/1#setting10",
+		"https://thesession.org/tunes/3",
+		"https://thesession.org/tunes/1#setting12",
+	]
+	with mock_http_many(bodies) as http_get:
+		results = get_from_thesession_many(urls, max_concurrency=2)
+
+	assert http_get.call_count == 3, "tune 1 should only be fetched once"
+	assert len(results) == len(urls)
+
+	assert [r.value.uri if isinstance(r, Ok) else None for r in results] == [
+		"https://thesession.org/tunes/2#setting20",
+		"https://thesession.org/tunes/1#setting11",
+		None,
+		"https://thesession.org/tunes/1#setting10",
+		None,
+		None,
+	]
+	assert results[2] == Err(GrabError.BadUrl("https://thesession.org/tunes/abc"))
+	assert isinstance(results[4], Err)
+	assert isinstance(results[4].err_value, GrabError.NetworkError)
+	assert isinstance(results[5], Err)
+	assert isinstance(results[5].err_value, GrabError.NoSuchSetting)
+
+
+def test_many_concurrency_is_bounded() -> None:
+	import threading
+	import time
+
+	lock = threading.Lock()
+	in_flight = 0
+	max_in_flight = 0
+
+	def on_get() -> None:
+		nonlocal in_flight, max_in_flight
+		with lock:
+			in_flight += 1
+			max_in_flight = max(max_in_flight, in_flight)
+		time.sleep(0.02)
+		with lock:
+			in_flight -= 1
+
+	bodies = {
+		f"https://thesession.org/tunes/{i}?format=json": tune_json(i, [i]) for i in range(12)
+	}
+	urls = [f"https://thesession.org/tunes/{i}" for i in range(12)]
+	with mock_http_many(bodies, on_get=on_get):
+		results = get_from_thesession_many(urls, max_concurrency=3)
+
+	assert all(isinstance(r, Ok) for r in results)
+	assert 1 < max_in_flight <= 3
+
+
 def test_real_cooleys() -> None:
 	result = get_from_thesession("https://thesession.org/tunes/1#setting12342")
 	assert isinstance(result, Ok)
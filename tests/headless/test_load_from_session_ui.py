@@ -0,0 +1,234 @@
+from typing import *
+import unittest.mock
+
+import pytest
+
+from ankitunes import load_from_session
+from ankitunes.http_pool import HTTPStatusError, ResponseTooLarge
+from ankitunes.load_from_session import GrabError, GrabbedTune, GrabResult
+from ankitunes.load_from_session_ui import GrabStats, TuneGrabber, TuneGrabRunnable
+from ankitunes.load_from_session_ui import TuneSearchWorker
+from ankitunes.result import Ok, Err
+from ankitunes.tune_index import TuneIndex, TuneMatch
+from .test_tune_index import COLUMNS, DUMP
+
+URI = "https://thesession.org/tunes/1"
+JSON_URI = "https://thesession.org/tunes/1?format=json"
+
+TUNE = GrabbedTune(name="Some Tune", key="Cmajor", type="reel", abc="abc", uri=URI)
+
+
+class Outcome(NamedTuple):
+	results: List[GrabResult]
+	cancelled: bool
+
+
+def run(
+	grabber: TuneGrabRunnable, responses: Sequence[GrabResult]
+) -> Tuple[Outcome, unittest.mock.Mock]:
+	results: List[GrabResult] = []
+	cancelled: List[bool] = []
+	grabber.done.connect(lambda g, r: results.append(r))
+	grabber.cancelled.connect(lambda g: cancelled.append(True))
+
+	get_mock = unittest.mock.Mock(side_effect=list(responses))
+	with unittest.mock.patch.object(load_from_session, "get_from_thesession", get_mock):
+		grabber.run()
+
+	return Outcome(results, len(cancelled) > 0), get_mock
+
+
+@pytest.fixture
+def grabber() -> TuneGrabRunnable:
+	grabber = TuneGrabRunnable(URI, (1, None))
+	grabber.BACKOFF_BASE = 0
+	return grabber
+
+
+def test_retries_transient_errors(grabber: TuneGrabRunnable) -> None:
+	outcome, get_mock = run(
+		grabber,
+		[
+			Err(GrabError.NetworkError(JSON_URI, ConnectionResetError())),
+			Err(GrabError.JSONError(JSON_URI, b"<html>captive portal</html>")),
+			Err(GrabError.NetworkError(JSON_URI, HTTPStatusError(JSON_URI, 503))),
+			Ok(TUNE),
+		],
+	)
+	assert outcome == Outcome([Ok(TUNE)], False)
+	assert get_mock.call_count == 4
+	assert grabber.retries == 3
+
+
+def test_gives_up_eventually(grabber: TuneGrabRunnable) -> None:
+	err = Err(GrabError.NetworkError(JSON_URI, ConnectionResetError()))
+	outcome, get_mock = run(grabber, [err] * 10)
+	assert outcome == Outcome([err], False)
+	assert get_mock.call_count == TuneGrabRunnable.MAX_RETRIES + 1
+
+
+@pytest.mark.parametrize(
+	"err",
+	[
+		GrabError.NetworkError(JSON_URI, HTTPStatusError(JSON_URI, 404)),
+		GrabError.BadUrl(URI),
+		GrabError.APISpecError(JSON_URI, {}, KeyError("id")),
+		GrabError.NetworkError(JSON_URI, ResponseTooLarge(JSON_URI, 1000)),
+	],
+)
+def test_doesnt_retry_permanent_errors(grabber: TuneGrabRunnable, err: Any) -> None:
+	outcome, get_mock = run(grabber, [Err(err), Ok(TUNE)])
+	assert outcome == Outcome([Err(err)], False)
+	assert get_mock.call_count == 1
+
+
+def test_cancelled_before_network(grabber: TuneGrabRunnable) -> None:
+	grabber.cancel()
+	outcome, get_mock = run(grabber, [Ok(TUNE)])
+	assert outcome == Outcome([], True)
+	assert get_mock.call_count == 0
+
+
+def test_cancelled_during_backoff(grabber: TuneGrabRunnable) -> None:
+	grabber.BACKOFF_BASE = 60
+
+	def fail_and_cancel(uri: str) -> GrabResult:
+		grabber.cancel()
+		return Err(GrabError.NetworkError(JSON_URI, ConnectionResetError()))
+
+	results: List[GrabResult] = []
+	cancelled: List[bool] = []
+	grabber.done.connect(lambda g, r: results.append(r))
+	grabber.cancelled.connect(lambda g: cancelled.append(True))
+	with unittest.mock.patch.object(
+		load_from_session, "get_from_thesession", fail_and_cancel
+	):
+		grabber.run()  # would take a while if the backoff didn't wake up
+
+	assert results == []
+	assert cancelled == [True]
+
+
+def test_backoff_is_bounded(grabber: TuneGrabRunnable) -> None:
+	grabber.BACKOFF_BASE = 0.5
+	for attempt in range(10):
+		delay = grabber.backoff(attempt)
+		assert 0 <= delay <= min(grabber.BACKOFF_CAP, 0.5 * 2**attempt)
+
+
+OTHER_URI = "https://thesession.org/tunes/2"
+OTHER_TUNE = GrabbedTune(
+	name="Other Tune", key="Dmajor", type="jig", abc="abc", uri=OTHER_URI
+)
+
+TUNES: Dict[str, GrabResult] = {URI: Ok(TUNE), OTHER_URI: Ok(OTHER_TUNE)}
+
+
+class PendingTuneGrabber(TuneGrabber):
+	"Stands in for the threads: grabs only run when the test says."
+
+	pending: List[TuneGrabRunnable]
+	results: List[GrabResult]
+
+	def __init__(self) -> None:
+		super().__init__(cast(Any, None), cast(Any, None))
+		self.pending = []
+		self.results = []
+		self.done.connect(self.results.append)
+
+	def _launch(self, grabber: TuneGrabRunnable) -> None:
+		self.pending.append(grabber)
+
+	def run_next(self, get: Callable[[str], GrabResult] = TUNES.__getitem__) -> None:
+		grabber = self.pending.pop(0)
+		grabber.BACKOFF_BASE = 0
+		with unittest.mock.patch.object(load_from_session, "get_from_thesession", get):
+			grabber.run()
+
+
+def test_grabber_coalesces_and_supersedes() -> None:
+	grabber = PendingTuneGrabber()
+	grabber.grab(URI)
+	grabber.grab(OTHER_URI)
+	# the same tune, spelt differently, is still on its way
+	grabber.grab(URI + "?format=json")
+	assert len(grabber.pending) == 2
+
+	grabber.run_next()
+	grabber.run_next()
+	# only the latest one gets through, and the other never hit the network
+	assert grabber.results == [Ok(TUNE)]
+	assert grabber.stats == GrabStats(
+		requested=3, coalesced=1, superseded=2, cancelled=1, succeeded=1
+	)
+
+
+def test_grabber_counts_each_superseded_grab_once() -> None:
+	grabber = PendingTuneGrabber()
+	for uri in (URI, OTHER_URI, URI, OTHER_URI):
+		grabber.grab(uri)
+
+	assert grabber.stats.superseded == 2
+	grabber.run_next()
+	grabber.run_next()
+	assert grabber.results == [Ok(OTHER_TUNE)]
+	assert grabber.stats.cancelled == 1
+
+
+def test_grabber_drops_results_superseded_in_flight() -> None:
+	grabber = PendingTuneGrabber()
+	grabber.grab(URI)
+
+	def fetch_while_user_types(uri: str) -> GrabResult:
+		# too late to cancel, it's already fetching
+		grabber.grab(OTHER_URI)
+		return TUNES[uri]
+
+	grabber.run_next(fetch_while_user_types)
+	assert grabber.results == []
+	grabber.run_next()
+	assert grabber.results == [Ok(OTHER_TUNE)]
+	assert grabber.stats.superseded == 1
+	assert grabber.stats.cancelled == 0
+
+
+def test_grabber_restarts_a_grab_wanted_again_after_it_gave_up() -> None:
+	grabber = PendingTuneGrabber()
+	grabber.grab(URI)
+	grabber.grab(OTHER_URI)
+
+	# it notices it's been cancelled, but the news is still on its way to the GUI
+	# thread (signals between threads are queued)
+	gave_up = grabber.pending.pop(0)
+	gave_up.blockSignals(True)
+	gave_up.run()
+	gave_up.blockSignals(False)
+
+	# meanwhile it's asked for again, so it gets uncancelled
+	grabber.grab(URI)
+	grabber._grabCancelled(gave_up)
+
+	# so it starts over, rather than nothing ever coming back
+	assert [g.uri for g in grabber.pending] == [OTHER_URI, URI]
+	grabber.run_next()
+	grabber.run_next()
+	assert grabber.results == [Ok(TUNE)]
+	assert grabber.stats.cancelled == 2
+
+
+def test_search_worker() -> None:
+	index = TuneIndex(":memory:")
+	index.import_rows(dict(zip(COLUMNS, row)) for row in DUMP)
+	worker = TuneSearchWorker(index)
+	found: List[Tuple[int, List[TuneMatch]]] = []
+	worker.found.connect(lambda generation, matches: found.append((generation, matches)))
+
+	# the user has typed more since this one was asked for
+	worker.latestGeneration = 2
+	worker.search(1, "coo")
+	worker.search(2, "cooley")
+	index.close()
+
+	assert [(g, [m.uri for m in matches]) for g, matches in found] == [
+		(2, ["https://thesession.org/tunes/1#setting1"])
+	]
@@ -0,0 +1,62 @@
+from typing import *
+
+from anki.collection import Collection as AnkiCollection
+from anki.models import NoteType
+
+from ankitunes.render_cache import RenderCache
+from tests.conftest import add_tune
+
+
+def test_hit(empty_collection: AnkiCollection, nt: NoteType) -> None:
+	col = empty_collection
+	card = add_tune(col, nt, "Cooley's", abc="|:EBBA B2EB|").cards()[0]
+	cache = RenderCache()
+
+	first = cache.render(card)
+	assert "Cooley's" in first.question
+	assert "__ABC_ID__" in first.answer
+
+	# a fresh copy of the card, that hasn't rendered anything itself
+	again = col.get_card(card.id)
+	assert cache.render(again) is first
+	assert again._render_output is None
+	assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+	assert cache.stats.hit_rate == 0.5
+
+
+def test_edited_note_misses(empty_collection: AnkiCollection, nt: NoteType) -> None:
+	col = empty_collection
+	card = add_tune(col, nt, "Cooley's").cards()[0]
+	cache = RenderCache()
+	cache.render(card)
+
+	note = card.note()
+	note["Name"] = "Cooley's Reel"
+	col.update_note(note)
+	# mtimes are in seconds, make sure this one has moved
+	assert col.db is not None
+	col.db.execute("update notes set mod = mod + 10 where id = ?", note.id)
+
+	rendered = cache.render(col.get_card(card.id))
+	assert "Cooley's Reel" in rendered.question
+	assert cache.stats.misses == 2
+
+
+def test_memory_budget(empty_collection: AnkiCollection, nt: NoteType) -> None:
+	col = empty_collection
+	cards = [
+		add_tune(col, nt, f"Tune {i}", abc="|:ABcd efga|" * 50).cards()[0]
+		for i in range(5)
+	]
+
+	size = RenderCache().render(cards[0]).size()
+	cache = RenderCache(max_bytes=size * 3)
+	for card in cards:
+		cache.render(card)
+
+	assert len(cache) == 3
+	assert cache.total_bytes <= cache.max_bytes
+	assert cache.stats.evictions == 2
+	# least recently used go first
+	assert cache.key(cards[0]) not in cache
+	assert cache.key(cards[4]) in cache
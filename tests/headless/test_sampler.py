@@ -0,0 +1,42 @@
+import random
+from typing import *
+
+import pytest
+
+from ankitunes.sampler import FenwickSampler
+
+
+def test_matches_a_list() -> None:
+	rng = random.Random(0)
+	sampler = FenwickSampler()
+	weights: List[int] = []
+	for _ in range(2000):
+		op = rng.random()
+		if op < 0.5 or not weights:
+			w = rng.randrange(5)
+			sampler.append(w)
+			weights.append(w)
+		elif op < 0.7:
+			assert sampler.pop() == weights.pop()
+		else:
+			i = rng.randrange(len(weights))
+			sampler[i] = weights[i] = rng.randrange(5)
+
+		assert sampler.total == sum(weights)
+		if sampler.total > 0:
+			x = rng.randrange(sampler.total)
+			i = sampler.find(x)
+			assert sum(weights[:i]) <= x < sum(weights[: i + 1])
+
+
+def test_sample() -> None:
+	sampler = FenwickSampler([0, 1, 0, 3])
+	rng = random.Random(1)
+	draws = [sampler.sample(rng) for _ in range(400)]
+	assert set(draws) == {1, 3}
+	assert draws.count(3) > 2 * draws.count(1)
+
+	with pytest.raises(IndexError):
+		FenwickSampler([0, 0]).sample(rng)
+	with pytest.raises(ValueError):
+		sampler[0] = -1
@@ -0,0 +1,179 @@
+import random
+import unittest.mock
+from typing import *
+
+import aqt.editor
+from anki.consts import CARD_TYPE_REV, QUEUE_TYPE_REV
+from anki.collection import OpChanges, Collection as AnkiCollection
+from anki.models import NoteType
+
+from ankitunes import tune_reviewer
+from ankitunes.set_index import SetIndex, companion_weight
+from tests.conftest import add_tune
+
+
+def names(col: AnkiCollection, card_ids: Iterable[int]) -> Set[str]:
+	return {col.get_card(cast(Any, cid)).note()["Name"] for cid in card_ids}
+
+
+def test_companion_weight() -> None:
+	today = 1000
+	on_time = companion_weight(2, 2, today, 10, 2500, today)
+	assert companion_weight(0, 0, 1, 0, 0, today) == 1.0
+	assert companion_weight(2, -1, today, 10, 2500, today) == 0.0
+	assert companion_weight(2, 2, today - 10, 10, 2500, today) > on_time
+	assert companion_weight(2, 2, today, 10, 1300, today) > on_time
+	assert companion_weight(2, 2, today, 300, 2500, today) > on_time
+
+
+def test_sample(empty_collection: AnkiCollection, nt: NoteType) -> None:
+	col = empty_collection
+	focus = add_tune(col, nt, "Cooley's", "reel", deck="Tunes")
+	add_tune(col, nt, "Silver Spear", "Reel", deck="Tunes")
+	add_tune(col, nt, "Merry Blacksmith", "reel", deck="Tunes")
+	add_tune(col, nt, "Kesh", "jig", deck="Tunes")
+	add_tune(col, nt, "Wise Maid", "reel", deck="Tunes::Hard")
+	add_tune(col, nt, "Sally Gardens", "reel", deck="Other")
+
+	index = SetIndex(col, nt)
+	assert len(index) == 6
+
+	tunes = col.decks.id("Tunes")
+	assert tunes is not None
+	deck_ids = col.decks.deck_and_child_ids(tunes)
+
+	sampled = index.sample(deck_ids, "reel", 10, exclude_nid=focus.id)
+	assert names(col, sampled) == {"Silver Spear", "Merry Blacksmith", "Wise Maid"}
+	assert len(sampled) == 3
+
+	assert len(index.sample(deck_ids, "reel", 2, exclude_nid=focus.id)) == 2
+	assert index.sample(deck_ids, "polka", 2) == []
+
+
+def test_sync(empty_collection: AnkiCollection, nt: NoteType) -> None:
+	col = empty_collection
+	kesh = add_tune(col, nt, "Kesh", "jig", deck="Tunes")
+	tunes = col.decks.id("Tunes")
+	assert tunes is not None
+	deck_ids = [tunes]
+
+	index = SetIndex(col, nt)
+	assert names(col, index.sample(deck_ids, "jig", 5)) == {"Kesh"}
+
+	# the index only looks for changes once it's told there might be some
+	butterfly = add_tune(col, nt, "Butterfly", "slip jig", deck="Tunes")
+	kesh["Tune Type"] = "reel"
+	col.update_note(kesh)
+	index.invalidate()
+	assert index.sample(deck_ids, "jig", 5) == []
+	assert names(col, index.sample(deck_ids, "reel", 5)) == {"Kesh"}
+	assert names(col, index.sample(deck_ids, "slip jig", 5)) == {"Butterfly"}
+
+	# just the cards it's told about
+	col.sched.suspend_cards(butterfly.card_ids())
+	index.mark_changed(butterfly.card_ids())
+	assert index.sample(deck_ids, "slip jig", 5) == []
+
+	kesh_ids = kesh.card_ids()
+	col.remove_notes([kesh.id])
+	index.mark_changed(kesh_ids)
+	assert index.sample(deck_ids, "reel", 5) == []
+	assert len(index) == 1
+
+
+def test_undo_rebuilds(empty_collection: AnkiCollection, nt: NoteType) -> None:
+	"Undo puts back old mtimes, so the index can't tell from them what changed."
+	col = empty_collection
+	kesh = add_tune(col, nt, "Kesh", "jig", deck="Tunes")
+	tunes = col.decks.id("Tunes")
+	assert tunes is not None
+	tune_reviewer.on_collection_will_change()
+	index = tune_reviewer.get_set_index(col, nt)
+
+	kesh["Tune Type"] = "reel"
+	tune_reviewer.on_operation_did_execute(col.update_note(kesh), None)
+	assert names(col, index.sample([tunes], "reel", 5)) == {"Kesh"}
+
+	tune_reviewer.on_operation_did_execute(col.undo().changes, None)
+	assert index.sample([tunes], "reel", 5) == []
+	assert names(col, index.sample([tunes], "jig", 5)) == {"Kesh"}
+	tune_reviewer.on_collection_will_change()
+
+
+def test_adds_and_edits_dont_rebuild(
+	empty_collection: AnkiCollection, nt: NoteType
+) -> None:
+	col = empty_collection
+	kesh = add_tune(col, nt, "Kesh", "jig", deck="Tunes")
+	tunes = col.decks.id("Tunes")
+	assert tunes is not None
+	tune_reviewer.on_collection_will_change()
+	index = tune_reviewer.get_set_index(col, nt)
+
+	with unittest.mock.patch.object(index, "rebuild", wraps=index.rebuild) as rebuild:
+		# as Add Cards does: the note's hook, then the op's changes
+		butterfly = add_tune(col, nt, "Butterfly", "slip jig", deck="Tunes")
+		tune_reviewer.on_add_cards_did_add_note(butterfly)
+		tune_reviewer.on_operation_did_execute(OpChanges(card=True, note_text=True), None)
+		assert names(col, index.sample([tunes], "slip jig", 5)) == {"Butterfly"}
+
+		# as the editor does, from the reviewer's Edit button or the browser
+		kesh["Tune Type"] = "reel"
+		editor = unittest.mock.Mock(spec=aqt.editor.Editor, note=kesh)
+		tune_reviewer.on_operation_did_execute(col.update_note(kesh), editor)
+		assert index.sample([tunes], "jig", 5) == []
+		assert names(col, index.sample([tunes], "reel", 5)) == {"Kesh"}
+
+		# starting to review doesn't throw it away either
+		tune_reviewer.on_state_did_change("review", "overview")
+		index.sample([tunes], "reel", 5)
+	assert rebuild.call_count == 0
+
+	# but an op from anywhere else, or a reset, does
+	tune_reviewer.on_operation_did_execute(OpChanges(card=True), None)
+	with unittest.mock.patch.object(index, "rebuild", wraps=index.rebuild) as rebuild:
+		index.sample([tunes], "reel", 5)
+		tune_reviewer.on_state_did_reset()
+		index.sample([tunes], "reel", 5)
+	assert rebuild.call_count == 2
+	tune_reviewer.on_collection_will_change()
+
+
+def test_weighted_sample(empty_collection: AnkiCollection, nt: NoteType) -> None:
+	col = empty_collection
+	add_tune(col, nt, "Silver Spear", "reel", deck="Tunes")
+	overdue = add_tune(col, nt, "Merry Blacksmith", "reel", deck="Tunes")
+	suspended = add_tune(col, nt, "Wise Maid", "reel", deck="Tunes")
+	(overdue_card,) = overdue.cards()
+	overdue_card.type = CARD_TYPE_REV
+	overdue_card.queue = QUEUE_TYPE_REV
+	overdue_card.ivl = 1
+	overdue_card.due = col.sched.today - 30
+	col.update_card(overdue_card)
+	col.sched.suspend_cards(suspended.card_ids())
+
+	tunes = col.decks.id("Tunes")
+	assert tunes is not None
+	index = SetIndex(col, nt, seed=1)
+	counts = {"Silver Spear": 0, "Merry Blacksmith": 0}
+	for _ in range(200):
+		(cid,) = index.sample([tunes], "reel", 1)
+		counts[col.get_card(cid).note()["Name"]] += 1
+	assert counts["Merry Blacksmith"] > 2 * counts["Silver Spear"]
+
+	# and all of them come out, when asked for
+	assert names(col, index.sample([tunes], "reel", 5)) == {
+		"Silver Spear",
+		"Merry Blacksmith",
+	}
+
+
+def test_seeded_sample(empty_collection: AnkiCollection, nt: NoteType) -> None:
+	col = empty_collection
+	for i in range(20):
+		add_tune(col, nt, f"Reel {i}", "reel", deck="Tunes")
+	tunes = col.decks.id("Tunes")
+	assert tunes is not None
+
+	samples = [SetIndex(col, nt, seed=7).sample([tunes], "reel", 3) for _ in range(2)]
+	assert samples[0] == samples[1]
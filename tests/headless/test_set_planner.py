@@ -0,0 +1,79 @@
+import random
+from typing import *
+
+from anki.cards import CardId
+from anki.collection import Collection as AnkiCollection
+from anki.models import NoteType
+
+from ankitunes.set_planner import SessionPlan, plan_session, session_card_ids
+from tests.conftest import add_tune
+
+
+def test_session_plan() -> None:
+	ids = cast(List[CardId], [1, 2, 3, 4])
+	plan = SessionPlan([ids[:3], ids[3:]])
+	assert plan.companions(ids[0]) == [2, 3]
+	assert plan.companions(ids[3]) == []
+	assert plan.companions(cast(CardId, 5)) is None
+	assert plan.sets() == [[1, 2, 3], [4]]
+	assert len(plan) == 4
+
+	plan.serve(ids[1])
+	assert plan.companions(ids[0]) is None
+	assert plan.companions(ids[2]) is None
+	assert plan.sets() == [[4]]
+
+
+def test_plan_by_tune_type(empty_collection: AnkiCollection, nt: NoteType) -> None:
+	col = empty_collection
+	reels = [
+		add_tune(col, nt, f"Reel {i}", "reel" if i % 2 else "Reel").card_ids()[0]
+		for i in range(5)
+	]
+	jigs = [add_tune(col, nt, f"Jig {i}", "jig").card_ids()[0] for i in range(3)]
+	polka = add_tune(col, nt, "Polka", "polka").card_ids()[0]
+	unknown = add_tune(col, nt, "Who knows", "").card_ids()[0]
+
+	plan = plan_session(
+		col, nt, [*reels, *jigs, polka, unknown], lambda: 2, rng=random.Random(1)
+	)
+
+	sets = plan.sets()
+	assert sorted(len(s) for s in sets) == [2, 2, 2]
+	for planned_set in sets:
+		assert set(planned_set) <= set(reels) or set(planned_set) <= set(jigs)
+	# the odd ones out get companions the usual way
+	assert len(plan) == 6
+	assert plan.companions(polka) is None
+	assert plan.companions(unknown) is None
+
+
+def test_plan_by_key(empty_collection: AnkiCollection, nt: NoteType) -> None:
+	col = empty_collection
+	d = [add_tune(col, nt, f"D {i}", key="Dmajor").card_ids()[0] for i in range(2)]
+	g = [add_tune(col, nt, f"G {i}", key="Gmajor").card_ids()[0] for i in range(2)]
+
+	plan = plan_session(col, nt, [*d, *g], lambda: 3, by_key=True)
+	assert sorted(sorted(s) for s in plan.sets()) == sorted([sorted(d), sorted(g)])
+
+	plan = plan_session(col, nt, [*d, *g], lambda: 4)
+	assert len(plan.sets()) == 1
+
+
+def test_session_card_ids(empty_collection: AnkiCollection, nt: NoteType) -> None:
+	col = empty_collection
+	reel = add_tune(col, nt, "Reel", "reel").card_ids()[0]
+	col.sched.reset()
+	assert list(session_card_ids(col)) == [reel]
+
+
+def test_session_card_ids_keeps_to_limits(
+	empty_collection: AnkiCollection, nt: NoteType
+) -> None:
+	col = empty_collection
+	conf = col.decks.config_dict_for_deck_id(col.decks.get_current_id())
+	conf["new"]["perDay"] = 2
+	col.decks.update_config(conf)
+	reels = [add_tune(col, nt, f"Reel {i}", "reel").card_ids()[0] for i in range(5)]
+	col.sched.reset()
+	assert list(session_card_ids(col)) == reels[:2]
@@ -0,0 +1,59 @@
+import json
+from typing import *
+
+import pytest
+
+from ankitunes import timing
+from ankitunes.timing import Timings, timed
+
+
+@pytest.fixture
+def timings(monkeypatch: pytest.MonkeyPatch) -> Timings:
+	t = Timings()
+	monkeypatch.setattr(timing, "timings", t)
+	return t
+
+
+def test_off_by_default(timings: Timings) -> None:
+	@timed("add")
+	def add(a: int, b: int) -> int:
+		return a + b
+
+	assert add(1, 2) == 3
+	assert timings.summary() == {}
+
+
+def test_summary(timings: Timings, tmp_path: Any) -> None:
+	timings.enabled = True
+
+	@timed("fails")
+	def fails() -> None:
+		raise ValueError()
+
+	with pytest.raises(ValueError):
+		fails()
+
+	for ms in [0.5, 3, 3, 700]:
+		timings.record("show", ms / 1000)
+
+	summary = timings.summary()
+	assert summary["fails"]["calls"] == 1
+	show = summary["show"]
+	assert show["n"] == 4
+	assert show["max"] == pytest.approx(700)
+	assert show["histogram"]["<=1"] == 1
+	assert show["histogram"]["<=5"] == 2
+	assert show["histogram"][">1000"] == 0
+	assert show["histogram"]["<=1000"] == 1
+
+	path = str(tmp_path / "timings.json")
+	timings.dump(path)
+	with open(path) as f:
+		assert json.load(f) == json.loads(json.dumps(summary))
+
+
+def test_window(timings: Timings) -> None:
+	for i in range(timing.WINDOW + 10):
+		timings.record("x", 0.001)
+	assert timings.summary()["x"]["n"] == timing.WINDOW
+	assert timings.summary()["x"]["calls"] == timing.WINDOW + 10
@@ -0,0 +1,150 @@
+from typing import *
+import unittest.mock
+from http.client import HTTPMessage
+
+import pytest
+
+from ankitunes import load_from_session
+from ankitunes.load_from_session import get_from_thesession
+from ankitunes.http_pool import HTTPPool, HTTPResponse
+from ankitunes.tune_cache import TuneCache
+from ankitunes.result import Ok
+
+TUNE_1 = b'{"id": 1, "name":"Some Tune", "type": "reel", "settings": [{"id": 2, "abc": "abc", "key": "Cmajor"}, {"id": 3, "abc": "def", "key": "Dmajor"}]}'
+
+
+class Clock:
+	now: float = 1000.0
+
+	def __call__(self) -> float:
+		return self.now
+
+
+@pytest.fixture
+def clock() -> Clock:
+	return Clock()
+
+
+@pytest.fixture
+def cache(clock: Clock) -> Generator[TuneCache, None, None]:
+	cache = TuneCache(":memory:", ttl=60, max_bytes=1000, clock=clock)
+	load_from_session.set_tune_cache(cache)
+	yield cache
+	load_from_session.set_tune_cache(None)
+	cache.close()
+
+
+def response(status: int, body: bytes, headers: Dict[str, str] = {}) -> HTTPResponse:
+	message = HTTPMessage()
+	for k, v in headers.items():
+		message[k] = v
+	return HTTPResponse(status, message, body)
+
+
+def test_ttl(cache: TuneCache, clock: Clock) -> None:
+	assert cache.get(1) is None
+
+	cache.put(1, b"body", etag='"abc"')
+	cached = cache.get(1)
+	assert cached is not None
+	assert cached.fresh
+	assert cached.body == b"body"
+	assert cached.etag == '"abc"'
+
+	clock.now += 61
+	cached = cache.get(1)
+	assert cached is not None
+	assert not cached.fresh
+
+	cache.refresh(1)
+	cached = cache.get(1)
+	assert cached is not None
+	assert cached.fresh
+
+	assert (cache.stats.hits, cache.stats.misses, cache.stats.stale) == (2, 1, 1)
+	assert cache.stats.revalidated == 1
+
+
+def test_lru_eviction(cache: TuneCache, clock: Clock) -> None:
+	for tune_id in range(4):
+		clock.now += 1
+		cache.put(tune_id, b"x" * 300)
+
+	# 4 * 300 > 1000, so the oldest one has to go
+	assert len(cache) == 3
+	assert cache.stats.evictions == 1
+	assert cache.get(0) is None
+
+	# touch 1, so that 2 is now the least recently used
+	clock.now += 1
+	assert cache.get(1) is not None
+	clock.now += 1
+	cache.put(4, b"x" * 300)
+
+	assert cache.get(2) is None
+	assert cache.get(1) is not None
+
+
+def test_persistent(tmp_path: Any) -> None:
+	path = str(tmp_path / "cache.sqlite3")
+	cache = TuneCache(path)
+	cache.put(1, TUNE_1)
+	cache.close()
+
+	cache = TuneCache(path)
+	cached = cache.get(1)
+	cache.close()
+	assert cached is not None
+	assert cached.body == TUNE_1
+
+
+def test_repeat_fetch_is_cached(cache: TuneCache) -> None:
+	http_get = unittest.mock.Mock(return_value=response(200, TUNE_1, {"ETag": '"v1"'}))
+	with unittest.mock.patch.object(HTTPPool, "get", http_get):
+		first = get_from_thesession("https://thesession.org/tunes/1#setting2")
+		second = get_from_thesession("https://thesession.org/tunes/1#setting3")
+
+	assert isinstance(first, Ok) and first.value.key == "Cmajor"
+	assert isinstance(second, Ok) and second.value.key == "Dmajor"
+	assert http_get.call_count == 1
+	assert cache.stats.hits == 1
+
+
+def test_stale_revalidates(cache: TuneCache, clock: Clock) -> None:
+	cache.put(1, TUNE_1, etag='"v1"', last_modified="Sat, 01 Jan 2022 00:00:00 GMT")
+	clock.now += 61
+
+	http_get = unittest.mock.Mock(return_value=response(304, b""))
+	with unittest.mock.patch.object(HTTPPool, "get", http_get):
+		result = get_from_thesession("https://thesession.org/tunes/1#setting2")
+
+	assert isinstance(result, Ok)
+	_url, headers = http_get.call_args[0]
+	assert headers["If-None-Match"] == '"v1"'
+	assert headers["If-Modified-Since"] == "Sat, 01 Jan 2022 00:00:00 GMT"
+	assert cache.stats.revalidated == 1
+
+	cached = cache.get(1)
+	assert cached is not None and cached.fresh
+
+
+def test_bad_responses_arent_cached(cache: TuneCache) -> None:
+	http_get = unittest.mock.Mock(return_value=response(200, b"{"))
+	with unittest.mock.patch.object(HTTPPool, "get", http_get):
+		get_from_thesession("https://thesession.org/tunes/1")
+
+	assert len(cache) == 0
+
+
+def test_corrupt_cache_starts_again(tmp_path: Any) -> None:
+	from ankitunes.load_from_session_ui import open_tune_cache
+
+	path = str(tmp_path / "thesession_cache.sqlite3")
+	with open(path, "wb") as f:
+		f.write(b"this is not a database" * 100)
+
+	cache = open_tune_cache(path)
+	assert cache is not None
+	cache.put(1, TUNE_1)
+	assert len(cache) == 1
+	cache.close()
@@ -0,0 +1,200 @@
+from typing import *
+import csv
+import io
+import json
+import sqlite3
+import unittest.mock
+
+import pytest
+
+from ankitunes import load_from_session
+from ankitunes.http_pool import HTTPPool
+from ankitunes.load_from_session import get_from_thesession, get_from_thesession_many
+from ankitunes.result import Ok, Err
+from ankitunes.tune_index import NAMES_SCHEMA, SCHEMA, SCHEMA_VERSION, TuneIndex
+from ankitunes.tune_index import _iter_json_array
+
+COLUMNS = "tune_id setting_id name type meter mode abc date username".split()
+
+DUMP = [
+	["1", "1", "Cooley's", "reel", "4/4", "Edorian", "|:D2|EBBA|", "2001-01-01", "x"],
+	["1", "12342", "Cooley's", "reel", "4/4", "Eminor", "|:F|CGGC|", "2002-01-01", "y"],
+	["20", "20", "The Cup Of Tea", "reel", "4/4", "Edorian", "|:BAGF|", "2001-02-01", "z"],
+	["2", "2", "The Banshee", "reel", "4/4", "Gmajor", "|:G2 GD|", "2001-03-01", "x"],
+]
+
+
+def write_csv(path: Any, rows: List[List[str]], columns: List[str] = COLUMNS) -> str:
+	with open(path, "w", newline="") as f:
+		writer = csv.writer(f)
+		writer.writerow(columns)
+		writer.writerows(rows)
+	return str(path)
+
+
+@pytest.fixture
+def index() -> Generator[TuneIndex, None, None]:
+	index = TuneIndex(":memory:")
+	load_from_session.set_tune_index(index)
+	yield index
+	load_from_session.set_tune_index(None)
+	index.close()
+
+
+@pytest.fixture
+def no_network() -> Generator[unittest.mock.Mock, None, None]:
+	get_mock = unittest.mock.Mock(side_effect=Exception("no network in here"))
+	with unittest.mock.patch.object(HTTPPool, "get", get_mock):
+		yield get_mock
+
+
+def test_import_csv(index: TuneIndex, tmp_path: Any) -> None:
+	stats = index.import_dump(write_csv(tmp_path / "tunes.csv", DUMP), batch_size=3)
+	assert stats.rows == 4
+	assert stats.settings_written == 4
+	assert len(index) == 3
+
+	tune = index.get_tune(1)
+	assert tune is not None
+	assert tune.name == "Cooley's"
+	assert [s.id for s in tune.settings] == [1, 12342]
+	assert tune.settings[1].key == "Eminor"
+
+	assert index.get_tune(3) is None
+
+
+def test_import_json(index: TuneIndex, tmp_path: Any) -> None:
+	path = tmp_path / "tunes.json"
+	path.write_text(json.dumps([dict(zip(COLUMNS, row)) for row in DUMP]))
+
+	stats = index.import_dump(str(path))
+	assert stats.settings_written == 4
+	tune = index.get_tune(20)
+	assert tune is not None and tune.name == "The Cup Of Tea"
+
+
+def test_json_streaming() -> None:
+	rows = [{"tune_id": i, "abc": "|:abc:|" * i} for i in range(50)]
+	text = " [ " + " ,\n".join(json.dumps(r) for r in rows) + " ]\n"
+	# tiny chunks, so objects and numbers get split across reads
+	assert list(_iter_json_array(io.StringIO(text), chunk_size=7)) == rows
+
+	with pytest.raises(ValueError):
+		list(_iter_json_array(io.StringIO(text[:-5]), chunk_size=7))
+
+
+def test_import_is_incremental(index: TuneIndex, tmp_path: Any) -> None:
+	index.import_dump(write_csv(tmp_path / "old.csv", DUMP))
+
+	kesh = ["3", "3", "The Kesh", "jig", "6/8", "Gmajor", "|:GAG GAB|", "2003-01-01", "x"]
+	newer = [*DUMP, kesh]
+	newer[0] = [*newer[0][:6], "|:D2|EBBA|changed", *newer[0][7:]]
+
+	stats = index.import_dump(write_csv(tmp_path / "new.csv", newer))
+	assert stats.rows == 5
+	assert stats.settings_written == 2
+	assert stats.tunes_written == 1
+
+	tune = index.get_tune(1)
+	assert tune is not None
+	assert tune.settings[0].abc.endswith("changed")
+
+
+def test_bad_rows(index: TuneIndex, tmp_path: Any) -> None:
+	rows = [*DUMP, ["nope", "5", "Bad", "reel", "4/4", "Gmajor", "", "", ""]]
+	stats = index.import_dump(write_csv(tmp_path / "tunes.csv", rows))
+	assert stats.bad_rows == 1
+	assert stats.settings_written == 4
+
+
+def test_aliases(index: TuneIndex, tmp_path: Any) -> None:
+	path = write_csv(
+		tmp_path / "aliases.csv",
+		[["1", "Cooley's Reel", "Cooley's"], ["1", "Cooleys", "Cooley's"]],
+		["tune_id", "alias", "name"],
+	)
+	stats = index.import_dump(path)
+	assert stats.aliases_written == 2
+	assert index.import_dump(path).aliases_written == 0
+
+
+def test_get_from_thesession_offline(
+	index: TuneIndex, tmp_path: Any, no_network: unittest.mock.Mock
+) -> None:
+	index.import_dump(write_csv(tmp_path / "tunes.csv", DUMP))
+
+	result = get_from_thesession("https://thesession.org/tunes/1#setting12342")
+	assert isinstance(result, Ok)
+	assert result.value.key == "Eminor"
+	assert result.value.abc.startswith("X: 2\nT: Cooley's\n")
+
+	results = get_from_thesession_many(
+		["https://thesession.org/tunes/20", "https://thesession.org/tunes/1#setting1"]
+	)
+	assert all(isinstance(r, Ok) for r in results)
+
+	assert no_network.call_count == 0
+
+
+def test_unknown_setting_goes_to_network(
+	index: TuneIndex, tmp_path: Any, no_network: unittest.mock.Mock
+) -> None:
+	index.import_dump(write_csv(tmp_path / "tunes.csv", DUMP))
+
+	result = get_from_thesession("https://thesession.org/tunes/1#setting99999")
+	assert isinstance(result, Err)
+	assert no_network.call_count == 1
+
+
+def test_search(index: TuneIndex, tmp_path: Any) -> None:
+	index.import_dump(write_csv(tmp_path / "tunes.csv", DUMP))
+	index.import_dump(
+		write_csv(
+			tmp_path / "aliases.csv",
+			[["2", "The Fairies' Hornpipe", "The Banshee"], ["20", "Cupán Tae", "x"]],
+			["tune_id", "alias", "name"],
+		)
+	)
+
+	assert [m.id for m in index.search("cup tea")] == [20]
+	assert [m.id for m in index.search("OOLEY")] == [1], "should be case insensitive"
+
+	[banshee] = index.search("fairies")
+	assert banshee.name == "The Banshee"
+	assert banshee.matched == "The Fairies' Hornpipe"
+	assert banshee.uri == "https://thesession.org/tunes/2#setting2"
+	# the first setting, not whichever one get_from_thesession would pick
+	[cooleys] = index.search("cooley")
+	assert cooleys.uri == "https://thesession.org/tunes/1#setting1"
+
+	# a tune matching on its name and an alias only comes back once
+	assert [m.id for m in index.search("cup")] == [20]
+
+	assert index.search("ab") == []
+	assert index.search("nothing like this") == []
+	assert len(index.search("the", limit=1)) == 1
+
+
+def test_search_after_rename(index: TuneIndex) -> None:
+	row = dict(zip(COLUMNS, DUMP[0]))
+	index.import_rows([row])
+	index.import_rows([{**row, "name": "Cooley's Reel"}])
+
+	[match] = index.search("cooley")
+	assert match.name == "Cooley's Reel"
+	assert index.search("cooley's reel")[0].id == 1
+
+
+def test_search_existing_unicode61_index(tmp_path: Any) -> None:
+	"An index made where SQLite had no trigram tokenizer keeps working after an upgrade."
+	path = str(tmp_path / "index.sqlite3")
+	db = sqlite3.connect(path)
+	db.executescript(SCHEMA + NAMES_SCHEMA.format(tokenizer="unicode61"))
+	db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+	db.close()
+
+	index = TuneIndex(path)
+	index.import_rows([dict(zip(COLUMNS, DUMP[0]))])
+	assert not index.trigram
+	assert [m.id for m in index.search("coo")] == [1]
+	index.close()
@@ -9,17 +9,20 @@ import anki.models
 import anki.collection
 
 from anki.notes import Note
-from anki.cards import Card
+from anki.cards import Card, CardId
 from anki.models import NoteType, ModelManager
 from anki.collection import Collection as AnkiCollection
 
 import pytest
 
 import contextlib
+from concurrent.futures import Future
+import unittest.mock
 
 import ankitunes.col_note_type as NT
 import ankitunes.tune_reviewer as reviewer
 from ankitunes.result import Result, Ok, Err
+from ankitunes.set_planner import SessionPlan
 
 from ankitunes.tunes.data import cooleys, cup_of_tea
 
@@ -110,12 +113,43 @@ def test_create_set(initialized_collection: ColAndStuff) -> None:
 	assert "Cup of Tea" in html
 
 	html = reviewer.on_card_will_show_ans(
-		"<html>Cooleys</html>", initialized_collection.cooleys, "reviewAnswer"
+		"<html>Cooleys</html>",
+		initialized_collection.cooleys,
+		"reviewAnswer",
+		initialized_collection.col,
 	)
 	assert "Cooleys" in html
 	assert "Cup of Tea" in html
 
 
+def test_answer_survives_refetch(initialized_collection: ColAndStuff) -> None:
+	col = initialized_collection.col
+	cooleys = initialized_collection.cooleys
+	reviewer.is_reviewing_tunes = True
+	reviewer.on_card_will_show_qn("", cooleys, "reviewQuestion", col, 2)
+
+	# Anki might hand us a different Card object for the answer
+	html = reviewer.on_card_will_show_ans(
+		"", col.get_card(cooleys.id), "reviewAnswer", col
+	)
+	assert "Cooleys" in html
+	assert "Cup of Tea" in html
+
+	# and forgets them all once the session's over
+	reviewer.on_state_did_change("overview", "review")
+	assert len(reviewer.set_registry) == 0
+	assert reviewer.on_card_will_show_ans("x", cooleys, "reviewAnswer", col) == "x"
+
+
+def test_set_registry_is_bounded() -> None:
+	registry = reviewer.SetRegistry(max_sets=2)
+	for focus_id in [1, 2, 3]:
+		registry.add(focus_id, cast(List[CardId], [focus_id, 10 + focus_id]))
+	assert 1 not in registry
+	assert registry.get(3) == (3, 13)
+	assert len(registry) == 2
+
+
 def test_dont_crash_on_non_ankitunes_card(initialized_collection: ColAndStuff) -> None:
 	html = reviewer.on_card_will_show_qn(
 		"<html>Chao</html>",
@@ -126,6 +160,174 @@ def test_dont_crash_on_non_ankitunes_card(initialized_collection: ColAndStuff) -
 	)
 	assert "Chao" in html
 	html = reviewer.on_card_will_show_ans(
-		"<html>Chao</html>", initialized_collection.some_other_note, "reviewAnswer"
+		"<html>Chao</html>",
+		initialized_collection.some_other_note,
+		"reviewAnswer",
+		initialized_collection.col,
 	)
 	assert "Chao" in html
+
+
+def test_load_cards(initialized_collection: ColAndStuff) -> None:
+	col = initialized_collection.col
+	gone = initialized_collection.some_other_note
+	ids = [
+		initialized_collection.cup_of_tea.id,
+		gone.id,
+		initialized_collection.cooleys.id,
+	]
+	col.remove_notes([gone.nid])
+
+	cards = reviewer.load_cards(col, ids)
+	names = [card.note()["Name"] for card in cards]
+
+	assert names == ["The Cup of Tea", "Cooleys"]
+	for card in cards:
+		expected = col.get_card(card.id)
+		assert (card.nid, card.did, card.ord, card.due) == (
+			expected.nid,
+			expected.did,
+			expected.ord,
+			expected.due,
+		)
+		assert card.question() == expected.question()
+
+
+def test_prefetch(initialized_collection: ColAndStuff) -> None:
+	col = initialized_collection.col
+	cooleys = initialized_collection.cooleys
+	cup_of_tea = initialized_collection.cup_of_tea
+
+	# stands in for mw.taskman: jobs run when finish() says so, "on the main thread"
+	pending: List[Tuple[Callable[[], Any], Callable[["Future[Any]"], None]]] = []
+	prefetcher = reviewer.SetPrefetcher(
+		lambda task, on_done: pending.append((task, on_done))
+	)
+
+	def finish() -> None:
+		task, on_done = pending.pop(0)
+		future: "Future[Any]" = Future()
+		future.set_result(task())
+		on_done(future)
+
+	prefetcher.prefetch(col, cooleys.id, 2)
+	finish()
+	# wrong guess
+	assert prefetcher.take(cup_of_tea, col) is None
+
+	# not ready yet, and once it's dropped it doesn't touch the collection
+	prefetcher.prefetch(col, cooleys.id, 2)
+	assert prefetcher.take(cooleys, col) is None
+	reviewer.render_cache.clear()
+	finish()
+	assert len(reviewer.render_cache) == 0
+
+	# the collection's been swapped since
+	prefetcher.prefetch(col, cooleys.id, 2)
+	finish()
+	assert prefetcher.take(cooleys, cast(AnkiCollection, object())) is None
+
+	prefetcher.prefetch(col, cooleys.id, 2)
+	finish()
+	prepared = prefetcher.take(cooleys, col)
+	assert prepared is not None
+	set_length, companions = prepared
+	assert set_length == 2
+	assert [c.id for c in companions] == [cup_of_tea.id]
+	# already rendered
+	assert reviewer.render_cache.key(companions[0]) in reviewer.render_cache
+
+	assert (prefetcher.hits, prefetcher.misses) == (1, 3)
+
+
+def test_planned_set(initialized_collection: ColAndStuff) -> None:
+	col = initialized_collection.col
+	cooleys = initialized_collection.cooleys
+	cup_of_tea = initialized_collection.cup_of_tea
+
+	reviewer.is_reviewing_tunes = True
+	reviewer.set_session_plan(SessionPlan([[cooleys.id]]))
+	try:
+		# planned on its own, even though a set of 2 was asked for
+		html = reviewer.on_card_will_show_qn(
+			"<html>Cooleys</html>", cooleys, "reviewQuestion", col, 2
+		)
+		assert "Cooleys" in html
+		assert "Cup of Tea" not in html
+	finally:
+		reviewer.set_session_plan(None)
+
+	col.decks.select(cooleys.did)
+	reviewer.plan_practice_session(col)
+	try:
+		assert reviewer.planned_companions(cooleys.id) == [cup_of_tea.id]
+		reviewer.on_card_will_show_qn(
+			"<html>Cooleys</html>", cooleys, "reviewQuestion", col, 2
+		)
+		# played once already, The Cup of Tea doesn't bring it back
+		assert reviewer.planned_companions(cup_of_tea.id) is None
+	finally:
+		reviewer.set_session_plan(None)
+
+	# a plan only lasts the session it was made for
+	reviewer.plan_practice_session(col)
+	assert reviewer.planned_companions(cooleys.id) is not None
+	reviewer.on_state_did_change("overview", "review")
+	assert reviewer.planned_companions(cooleys.id) is None
+
+
+def test_grade_set(initialized_collection: ColAndStuff) -> None:
+	col = initialized_collection.col
+	col.set_v3_scheduler(True)
+	cooleys = initialized_collection.cooleys
+	cup_of_tea = initialized_collection.cup_of_tea
+
+	reviewer.is_reviewing_tunes = True
+	reviewer.on_card_will_show_qn("", cooleys, "reviewQuestion", col, 2)
+	cooleys.start_timer()
+	col.sched.answerCard(cooleys, 3)
+	assert reviewer.grade_set(col, cooleys, 3) == 1
+
+	cup_of_tea.load()
+	assert cup_of_tea.reps == 1
+
+	# one undo step for the whole set
+	col.undo()
+	cooleys.load()
+	cup_of_tea.load()
+	assert (cooleys.reps, cup_of_tea.reps) == (0, 0)
+
+	# newer Ankis have a public call for the states, and it wins
+	public = unittest.mock.Mock()
+	with unittest.mock.patch.object(
+		col.sched, "get_scheduling_states", public, create=True
+	):
+		assert reviewer._next_states_getter(col) is public
+	assert reviewer._next_states_getter(col) is not None
+
+	# an Anki without any way to get card states (it's moved before) just grades one
+	col.sched.answerCard(cooleys, 3)
+	with unittest.mock.patch.object(reviewer, "_next_states_getter", return_value=None):
+		assert reviewer.grade_set(col, cooleys, 3) == 0
+	col.undo()
+
+	# v2 can't undo them together, so leaves them alone
+	col.set_v3_scheduler(False)
+	assert reviewer.grade_set(col, cooleys, 3) == 0
+
+
+def test_predict_next_card(initialized_collection: ColAndStuff) -> None:
+	col = initialized_collection.col
+	deck_id = col.decks.id("Test Deck")
+	assert deck_id is not None
+	col.decks.select(deck_id)
+	col.sched.reset()
+
+	card = col.sched.getCard()
+	assert card is not None
+	predicted = reviewer.predict_next_card_id(col)
+	col.sched.answerCard(card, 3)
+
+	next_card = col.sched.getCard()
+	assert next_card is not None
+	assert predicted == next_card.id
@@ -0,0 +1,225 @@
+from typing import *
+import time
+
+import anki.collection
+import pytest
+
+from ankitunes import col_note_type, load_from_session
+from ankitunes.load_from_session import GrabError
+from ankitunes.result import Ok, Err
+from ankitunes.tunebook import (
+	CollectionKind,
+	TuneCollection,
+	add_tunes,
+	get_collection_from_thesession,
+	import_collection,
+	parse_collection_url,
+)
+from ankitunes.tune_index import TuneIndex
+from ..fake_thesession import FakeMember, FakeSet, FakeTheSession
+
+
+@pytest.mark.parametrize(
+	"url,expected",
+	[
+		(
+			"https://thesession.org/members/7/tunebook",
+			TuneCollection(CollectionKind.TUNEBOOK, 7),
+		),
+		("https://thesession.org/members/7/sets", TuneCollection(CollectionKind.SETS, 7)),
+		(
+			"https://www.thesession.org/members/7/sets/3/",
+			TuneCollection(CollectionKind.SET, 7, 3),
+		),
+	],
+)
+def test_parse_collection_url(url: str, expected: TuneCollection) -> None:
+	assert parse_collection_url(url) == Ok(expected)
+
+
+@pytest.mark.parametrize(
+	"url",
+	[
+		"https://thesession.org/tunes/1",
+		"https://thesession.org/members/7/tunebook/3",
+		"https://example.com/members/7/sets",
+	],
+)
+def test_parse_bad_collection_url(url: str) -> None:
+	result = parse_collection_url(url)
+	assert isinstance(result, Err)
+	assert isinstance(result.err_value, GrabError.BadCollectionUrl)
+
+
+def test_tunebook_pagination(fake_thesession: FakeTheSession) -> None:
+	tune_ids = list(range(1, 121))
+	fake_thesession.add_tunes(tune_ids)
+	fake_thesession.members[7] = FakeMember(tunebook=tune_ids, sets=[])
+
+	progress: List[Tuple[int, int]] = []
+	result = get_collection_from_thesession(
+		"https://thesession.org/members/7/tunebook",
+		progress=lambda done, total: progress.append((done, total)),
+	)
+
+	assert isinstance(result, Ok)
+	uris = [r.value.uri for r in result.value if isinstance(r, Ok)]
+	# in tunebook order, and the first setting of each
+	assert uris == [f"https://thesession.org/tunes/{t}#setting{t * 100}" for t in tune_ids]
+
+	pages = [p for p in fake_thesession.requests if "/members/" in p]
+	assert len(pages) == 3
+	assert len([p for p in fake_thesession.requests if "/tunes/" in p]) == 120
+	assert progress[-1] == (120, 120)
+
+
+def test_sets_are_fetched_and_deduped(fake_thesession: FakeTheSession) -> None:
+	fake_thesession.add_tunes([1, 2, 3])
+	fake_thesession.members[7] = FakeMember(
+		tunebook=[],
+		sets=[FakeSet(10, [(1, 101), (2, 200)]), FakeSet(11, [(2, 200), (3, 301)])],
+	)
+	fake_thesession.sets_include_settings = False
+
+	result = get_collection_from_thesession("https://thesession.org/members/7/sets")
+
+	assert isinstance(result, Ok)
+	uris = [r.value.uri for r in result.value if isinstance(r, Ok)]
+	assert uris == [
+		"https://thesession.org/tunes/1#setting101",
+		"https://thesession.org/tunes/2#setting200",
+		"https://thesession.org/tunes/3#setting301",
+	]
+	assert "/members/7/sets/10" in fake_thesession.requests
+	# tune 2 is in both sets, but only fetched once
+	assert fake_thesession.requests.count("/tunes/2") == 1
+
+
+def test_missing_tune(fake_thesession: FakeTheSession) -> None:
+	fake_thesession.add_tunes([1])
+	fake_thesession.members[7] = FakeMember(
+		tunebook=[], sets=[FakeSet(10, [(1, 100)])]
+	)
+	del fake_thesession.tunes[1]
+
+	result = get_collection_from_thesession("https://thesession.org/members/7/sets/10")
+
+	assert isinstance(result, Ok)
+	(tune_result,) = result.value
+	assert isinstance(tune_result, Err)
+	assert isinstance(tune_result.err_value, GrabError.NetworkError)
+
+
+def test_missing_member(fake_thesession: FakeTheSession) -> None:
+	result = get_collection_from_thesession("https://thesession.org/members/8/tunebook")
+	assert isinstance(result, Err)
+	assert isinstance(result.err_value, GrabError.NetworkError)
+
+
+def test_import_is_one_undo_step(
+	empty_collection: anki.collection.Collection, fake_thesession: FakeTheSession
+) -> None:
+	col = empty_collection
+	col_note_type.migrate(col)
+
+	fake_thesession.add_tunes([1, 2, 3])
+	fake_thesession.members[7] = FakeMember(tunebook=[1, 2, 3], sets=[])
+	deck_id = col.decks.get_current_id()
+
+	imported = import_collection(col, "https://thesession.org/members/7/tunebook", deck_id)
+	assert isinstance(imported.result, Ok)
+	assert imported.result.value.added == 3
+	assert col.note_count() == 3
+
+	status = col.undo_status()
+	assert status.undo == "Import Tunes from TheSession"
+	col.undo()
+	assert col.note_count() == 0
+
+
+def test_import_skips_existing(
+	empty_collection: anki.collection.Collection, fake_thesession: FakeTheSession
+) -> None:
+	col = empty_collection
+	col_note_type.migrate(col)
+
+	fake_thesession.add_tunes([1, 2])
+	fake_thesession.members[7] = FakeMember(tunebook=[1], sets=[])
+	deck_id = col.decks.get_current_id()
+	import_collection(col, "https://thesession.org/members/7/tunebook", deck_id)
+
+	fake_thesession.members[7] = FakeMember(tunebook=[1, 2], sets=[])
+	fetched = get_collection_from_thesession("https://thesession.org/members/7/tunebook")
+	assert isinstance(fetched, Ok)
+	added = add_tunes(col, fetched.value, deck_id)
+
+	assert (added.added, added.duplicates) == (1, 1)
+	assert col.note_count() == 2
+
+
+def test_two_settings_of_one_tune(fake_thesession: FakeTheSession) -> None:
+	fake_thesession.add_tunes([1, 2])
+	fake_thesession.members[7] = FakeMember(
+		tunebook=[], sets=[FakeSet(10, [(1, 100), (2, 200), (1, 101)])]
+	)
+	# the local index only knows tune 1's first setting
+	index = TuneIndex(":memory:")
+	stats = index.import_rows(
+		[
+			{
+				"tune_id": "1",
+				"setting_id": "100",
+				"name": "Tune 1",
+				"type": "jig",
+				"mode": "Dmajor",
+				"abc": "|:A:|",
+			}
+		]
+	)
+	assert stats.settings_written == 1
+	load_from_session.set_tune_index(index)
+	try:
+		result = get_collection_from_thesession("https://thesession.org/members/7/sets/10")
+	finally:
+		load_from_session.set_tune_index(None)
+		index.close()
+
+	assert isinstance(result, Ok)
+	assert [r.value.uri for r in result.value if isinstance(r, Ok)] == [
+		"https://thesession.org/tunes/1#setting100",
+		"https://thesession.org/tunes/2#setting200",
+		"https://thesession.org/tunes/1#setting101",
+	]
+
+
+def test_failed_page_cancels_queued_tunes(
+	fake_thesession: FakeTheSession, monkeypatch: pytest.MonkeyPatch
+) -> None:
+	tune_ids = list(range(1, 101))
+	fake_thesession.add_tunes(tune_ids)
+	fake_thesession.members[7] = FakeMember(tunebook=tune_ids, sets=[])
+
+	get_json = load_from_session._get_thesession_json
+
+	def page_2_fails(url: str) -> Any:
+		if "page=2" in url:
+			return Err(GrabError.NetworkError(url, Exception("page 2 is broken")))
+		return get_json(url)
+
+	resolved: List[int] = []
+
+	def slow_resolve(tune_id: int, setting_ids: Any) -> Any:
+		resolved.append(tune_id)
+		time.sleep(0.01)
+		return Err(GrabError.NetworkError("", Exception("not needed")))
+
+	monkeypatch.setattr(load_from_session, "_get_thesession_json", page_2_fails)
+	monkeypatch.setattr(load_from_session, "_resolve_tune", slow_resolve)
+
+	result = get_collection_from_thesession(
+		"https://thesession.org/members/7/tunebook", max_concurrency=1
+	)
+
+	assert isinstance(result, Err)
+	# the first page's 50 tunes were queued, but not waited for
+	assert len(resolved) < 10
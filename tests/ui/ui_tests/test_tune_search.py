@@ -0,0 +1,89 @@
+from PyQt5.QtCore import Qt
+from anki.collection import SearchNode
+
+import aqt
+import aqt.gui_hooks
+from pytestqt.qtbot import QtBot
+import ankitunes.col_note_type
+import ankitunes.load_from_session_ui
+from ankitunes import load_from_session
+from typing import *
+
+from .. import wait_hook
+
+TUNE_ROWS = [
+	{
+		"tune_id": "1",
+		"setting_id": "1",
+		"name": "Cooley's",
+		"type": "reel",
+		"meter": "4/4",
+		"mode": "Edorian",
+		"abc": "|:D2|EBBA B2 EB|",
+		"date": "2001-01-01",
+	},
+	{
+		"tune_id": "1",
+		"setting_id": "12342",
+		"name": "Cooley's",
+		"type": "reel",
+		"meter": "4/4",
+		"mode": "Eminor",
+		"abc": "|:F|CGGC|",
+		"date": "2002-01-01",
+	},
+]
+
+
+def test_tune_search_ui(anki_running: None, qtbot: QtBot) -> None:
+	mw = aqt.mw
+	assert mw is not None
+	col = mw.col
+	assert col is not None
+
+	index = load_from_session._tune_index
+	assert index is not None, "the local tune index wasn't opened at startup"
+	# as Tools > Import TheSession data dump would, and the tune is then found offline
+	index.import_rows(TUNE_ROWS)
+
+	nt = ankitunes.col_note_type.get_ankitunes_nt(col.models)
+	# so Add Cards opens on the AnkiTune note type
+	col.set_config("curModel", nt["id"])
+
+	with wait_hook(qtbot, aqt.gui_hooks.add_cards_did_init) as cb:
+		mw.onAddCard()
+	assert cb.args is not None
+	add_window: ankitunes.load_from_session_ui.MyAddCards = cb.args[0]
+
+	searchContainer = add_window.searchContainer
+	assert searchContainer is not None
+	qtbot.waitUntil(searchContainer.isVisible)
+
+	# type a query, and wait for the suggestions
+	qtbot.keyClicks(searchContainer.searchField, "cooley")  # type: ignore
+	popup = searchContainer.completer.popup()
+	assert popup is not None
+	qtbot.waitUntil(popup.isVisible)
+	model = popup.model()
+	assert model is not None
+	assert model.rowCount() == 1
+
+	# pick the first one
+	with wait_hook(qtbot, aqt.gui_hooks.editor_did_load_note):
+		popup.setCurrentIndex(model.index(0, 0))
+		qtbot.keyClick(popup, Qt.Key.Key_Return)  # type: ignore
+
+	note = add_window.editor.note
+	assert note is not None
+	assert note["Name"] == "Cooley's"
+	assert note["Key"] == "Edorian"
+	# the first setting, every time
+	assert note["Link"] == "https://thesession.org/tunes/1#setting1"
+
+	assert add_window.addButton is not None and add_window.closeButton is not None
+	with wait_hook(qtbot, aqt.gui_hooks.add_cards_did_add_note):
+		add_window.addButton.click()
+	add_window.closeButton.click()
+
+	note_ids = col.find_notes(col.build_search_string(SearchNode(note=nt["name"])))
+	assert "Cooley's" in [col.get_note(nid)["Name"] for nid in note_ids]